@@ -44,4 +44,8 @@ app.conf.beat_schedule = {
         "task": "unit_economics.periodic_tasks.action_article_price_to_db",
         "schedule": crontab(hour=3, minute=30)
     },
+    "unit_economics_profitability_snapshot": {
+        "task": "unit_economics.periodic_tasks.refresh_profitability_snapshots",
+        "schedule": crontab(hour=4, minute=30)
+    },
 }
@@ -1,9 +1,170 @@
+import logging
+import time
+from itertools import islice
+
+from django.db import connection, transaction
+
 from core.enums import FieldsTypes
 
+logger = logging.getLogger(__name__)
+
+# Предел параметров одного запроса PostgreSQL
+MAX_QUERY_PARAMS = 65535
+# Сколько параметров в одном запросе записи. По замерам (core/tests/test_bulk_benchmark.py)
+# быстрее всего пачки около 2500 параметров, большие пачки медленнее из-за разбора запроса
+BATCH_PARAMS = 2500
+# С какого количества ячеек (строки * поля) обновление идет через временную таблицу.
+# bulk_update строит CASE на каждое поле, и время растет быстрее числа строк
+TEMP_TABLE_UPDATE_CELLS = 200
+
+
+def batch_size_for(row_params, max_params=BATCH_PARAMS):
+    """
+    Возвращает размер пачки по ширине строки:
+    сколько строк помещается в запрос из max_params параметров
+
+    Входящие данные:
+        row_params - количество параметров запроса на одну строку
+        max_params - параметров на запрос, не больше MAX_QUERY_PARAMS
+    """
+    return max(1, min(max_params, MAX_QUERY_PARAMS) // max(row_params, 1))
+
+
+def report_bulk_write(model, strategy, rows, started):
+    """Пишет в лог скорость массовой записи модели (строк в секунду)"""
+    if not rows:
+        return
+    seconds = time.monotonic() - started
+    logger.info(
+        f'{model.__name__} {strategy}: {rows} строк за {seconds:.2f} с, '
+        f'{rows / seconds if seconds else rows:.0f} строк/с')
+
+
+def bulk_create_objects(model, objects, batch_size=None, ignore_conflicts=False):
+    """
+    Создает объекты через bulk_create пачками по ширине строки модели.
+    С ignore_conflicts строки, нарушающие уникальность, пропускаются.
+    Возвращает созданные объекты
+    """
+    started = time.monotonic()
+    created = model.objects.bulk_create(
+        objects, batch_size=batch_size or batch_size_for(len(model._meta.concrete_fields)),
+        ignore_conflicts=ignore_conflicts)
+    report_bulk_write(model, 'bulk_create', len(created), started)
+    return created
+
+
+def bulk_update_objects(model, objects, fields, batch_size=None):
+    """
+    Обновляет поля fields у объектов.
+
+    Небольшие обновления идут через bulk_update, от TEMP_TABLE_UPDATE_CELLS
+    ячеек - через временную таблицу
+    и один UPDATE ... FROM (bulk_update_from_temp_table).
+    С явным batch_size всегда используется bulk_update.
+    Сигналы post_save не отправляются. Возвращает количество обновленных строк
+    """
+    objects = list(objects)
+    fields = list(fields)
+    if not objects or not fields:
+        return 0
+    started = time.monotonic()
+    if batch_size is None and len(objects) * len(fields) >= TEMP_TABLE_UPDATE_CELLS:
+        updated = bulk_update_from_temp_table(model, objects, fields)
+        report_bulk_write(model, 'temp_table_update', updated, started)
+        return updated
+    updated = model.objects.bulk_update(
+        objects, fields,
+        batch_size=batch_size or batch_size_for(2 * len(fields) + 1))
+    report_bulk_write(model, 'bulk_update', updated, started)
+    return updated
+
+
+def bulk_update_from_temp_table(model, objects, fields):
+    """
+    Обновляет поля fields у объектов через временную таблицу:
+    значения вставляются в нее пачками, затем основная таблица
+    обновляется одним UPDATE ... FROM по первичному ключу.
+
+    Входящие данные:
+        model - модель Django
+        objects - объекты модели с заполненным первичным ключом
+        fields - названия обновляемых полей
+    Возвращает количество обновленных строк
+    """
+    opts = model._meta
+    db_fields = [opts.pk] + [opts.get_field(name) for name in fields]
+    quote = connection.ops.quote_name
+    table = quote(opts.db_table)
+    temp_table = quote(f'tmp_update_{opts.db_table}')
+    columns = ', '.join(quote(field.column) for field in db_fields)
+    row_placeholder = f'({", ".join(["%s"] * len(db_fields))})'
+    pk_column = quote(opts.pk.column)
+    assignments = ', '.join(
+        f'{quote(field.column)} = tmp.{quote(field.column)}' for field in db_fields[1:])
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {temp_table}')
+        cursor.execute(f'CREATE TEMPORARY TABLE {temp_table} AS SELECT {columns} FROM {table} WITH NO DATA')
+        objects = iter(objects)
+        batch_size = batch_size_for(len(db_fields))
+        while batch := list(islice(objects, batch_size)):
+            params = [field.get_db_prep_save(getattr(obj, field.attname), connection)
+                      for obj in batch for field in db_fields]
+            cursor.execute(
+                f'INSERT INTO {temp_table} ({columns}) VALUES {", ".join([row_placeholder] * len(batch))}',
+                params)
+        cursor.execute(
+            f'UPDATE {table} SET {assignments} FROM {temp_table} AS tmp '
+            f'WHERE {table}.{pk_column} = tmp.{pk_column}')
+        updated = cursor.rowcount
+        cursor.execute(f'DROP TABLE {temp_table}')
+    return updated
+
+
+def bulk_upsert(model, rows, unique_fields, update_fields=None, batch_size=None):
+    """
+    Вставляет или обновляет строки пачками через INSERT ... ON CONFLICT DO UPDATE.
+
+    Один запрос на пачку строк вместо update_or_create на каждую.
+    Без batch_size размер пачки считается по ширине строки.
+    Сигналы post_save не отправляются.
+
+    Входящие данные:
+        model - модель Django
+        rows - итерируемое словарей {поле: значение}, поля по attname (product_id)
+        unique_fields - поля уникального ограничения, по которому ищется конфликт
+        update_fields - поля для обновления при конфликте, по умолчанию все,
+            кроме unique_fields
+    Возвращает количество записанных строк
+    """
+    rows = iter(rows)
+    written = 0
+    started = time.monotonic()
+    while True:
+        first = next(rows, None)
+        if first is None:
+            report_bulk_write(model, 'upsert', written, started)
+            return written
+        # Одна строка не может обновиться дважды в одном INSERT, дубли по ключу схлопываем
+        batch = {}
+        for row in (first, *islice(rows, (batch_size or batch_size_for(len(first))) - 1)):
+            batch[tuple(row[field] for field in unique_fields)] = row
+        fields = update_fields or sorted(
+            {field for row in batch.values() for field in row} - set(unique_fields))
+        model.objects.bulk_create(
+            [model(**row) for row in batch.values()],
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=fields,
+        )
+        written += len(batch)
+
 
 class BaseIntegration:
 
-    MASS_OPERATIONS_BATCH_SIZE = 100
+    # None - размер пачки подбирается по ширине строки модели
+    MASS_OPERATIONS_BATCH_SIZE = None
     auth_fields_description = {
         "token": {"name": "Токен", "type": FieldsTypes.TEXT, "max_length": 255}}
 
@@ -11,33 +172,21 @@ class BaseIntegration:
         raise NotImplementedError
 
     def create_new_objects(self, model, objects_list):
-        create_batches_count = len(objects_list) // self.MASS_OPERATIONS_BATCH_SIZE + (
-            1 if len(objects_list) % self.MASS_OPERATIONS_BATCH_SIZE else 0
-        )
-
-        for i in range(create_batches_count):
-            model.objects.bulk_create(
-                objects_list[
-                    (0 + i * self.MASS_OPERATIONS_BATCH_SIZE): (
-                        self.MASS_OPERATIONS_BATCH_SIZE + i * self.MASS_OPERATIONS_BATCH_SIZE
-                    )
-                ]
-            )
+        bulk_create_objects(model, objects_list, batch_size=self.MASS_OPERATIONS_BATCH_SIZE)
 
     def update_existing_objects(self, model, objects_list):
-        update_batches_count = len(objects_list) // self.MASS_OPERATIONS_BATCH_SIZE + (
-            1 if len(objects_list) % self.MASS_OPERATIONS_BATCH_SIZE else 0
+        bulk_update_objects(
+            model, objects_list,
+            fields=self.get_object_available_fields().get(model, []),
+            batch_size=self.MASS_OPERATIONS_BATCH_SIZE,
         )
 
-        for i in range(update_batches_count):
-            model.objects.bulk_update(
-                objects_list[
-                    (0 + i * self.MASS_OPERATIONS_BATCH_SIZE): (
-                        self.MASS_OPERATIONS_BATCH_SIZE + i * self.MASS_OPERATIONS_BATCH_SIZE
-                    )
-                ],
-                fields=self.get_object_available_fields().get(model, []),
-            )
+    def upsert_objects(self, model, rows, unique_fields, update_fields=None):
+        return bulk_upsert(
+            model, rows, unique_fields,
+            update_fields=update_fields or self.get_object_available_fields().get(model),
+            batch_size=self.MASS_OPERATIONS_BATCH_SIZE,
+        )
 
     def __init__(self, account):
         self.account = account
@@ -164,7 +164,8 @@ CELERY_TIMEZONE = "Europe/Moscow"
 SESSION_COOKIE_AGE = 60 * 60 * 24  # один день
 REMEMBER_ME_SESSION_COOKIE_AGE = 60 * 60 * 24 * 31  # один месяц
 
-PRODUCT_MASS_CREATION_BATCH_SIZE = 100
+# Размер пачки данных из API, которую импорт обрабатывает за раз
+IMPORT_CHUNK_SIZE = 500
 
 CSRF_TRUSTED_ORIGINS = ["https://*.rau-place.ru",
                         "https://*.127.0.0.1", "http://0.0.0.0:8001"]
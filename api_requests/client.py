@@ -0,0 +1,162 @@
+import contextlib
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+WILDBERRIES = 'wildberries'
+OZON = 'ozon'
+YANDEX_MARKET = 'yandex_market'
+MOY_SKLAD = 'moy_sklad'
+
+# Ограничения API: (запросов в секунду, размер пачки запросов без ожидания)
+# для одного токена
+RATE_LIMITS = {
+    WILDBERRIES: (1.5, 10),
+    OZON: (10, 20),
+    YANDEX_MARKET: (5, 10),
+    MOY_SKLAD: (15, 45),
+}
+# Сколько запросов с одним токеном может выполняться одновременно,
+# для Моего Склада - не больше 5 параллельных запросов пользователя
+CONCURRENCY_LIMITS = {
+    MOY_SKLAD: 5,
+}
+POOL_MAXSIZE = 20
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+DEFAULT_TIMEOUT = 200
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов "ведро с токенами".
+
+    Позволяет сделать до capacity запросов подряд, дальше
+    не чаще rate запросов в секунду.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Ждет, пока в ведре появится токен, и забирает его"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+_slots = {}
+_sessions = threading.local()
+
+
+def get_bucket(marketplace, token):
+    """Ведро ограничителя для пары (маркетплейс, токен)"""
+    key = (marketplace, token)
+    with _buckets_lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(*RATE_LIMITS[marketplace])
+        return _buckets[key]
+
+
+def get_slot(marketplace, token):
+    """
+    Семафор одновременных запросов для пары (маркетплейс, токен).
+    Для маркетплейсов без ограничения в CONCURRENCY_LIMITS - пустой контекст
+    """
+    if marketplace not in CONCURRENCY_LIMITS:
+        return contextlib.nullcontext()
+    key = (marketplace, token)
+    with _buckets_lock:
+        if key not in _slots:
+            _slots[key] = threading.BoundedSemaphore(CONCURRENCY_LIMITS[marketplace])
+        return _slots[key]
+
+
+def get_session(marketplace):
+    """
+    Сессия с keep-alive пулом соединений для маркетплейса.
+    Одна на поток, чтобы не делить сессию requests между потоками
+    """
+    sessions = getattr(_sessions, 'sessions', None)
+    if sessions is None:
+        sessions = _sessions.sessions = {}
+    if marketplace not in sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip'
+        sessions[marketplace] = session
+    return sessions[marketplace]
+
+
+def _retry_delay(response, attempt):
+    """Пауза перед повтором: Retry-After из ответа или экспоненциальная с джиттером"""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1)
+
+
+def request(marketplace, method, url, token, max_retries=MAX_RETRIES, **kwargs):
+    """
+    Запрос к API маркетплейса через общий пул соединений.
+
+    Перед каждой попыткой ждет токен ограничителя (маркетплейс, token),
+    одновременных запросов с одним токеном не больше CONCURRENCY_LIMITS.
+    Ответы 429 и 5xx, а также ошибки соединения повторяются с паузой
+    из Retry-After или экспоненциальной паузой. Возвращает последний ответ,
+    ошибка соединения после всех попыток пробрасывается дальше.
+
+    Входящие переменные:
+        marketplace - WILDBERRIES, OZON, YANDEX_MARKET или MOY_SKLAD
+        method - HTTP метод
+        url - адрес запроса
+        token - токен учетной записи, по нему считается ограничение частоты
+        kwargs - параметры requests (headers, json, data, timeout...)
+    """
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    session = get_session(marketplace)
+    bucket = get_bucket(marketplace, token)
+    slot = get_slot(marketplace, token)
+    for attempt in range(max_retries + 1):
+        try:
+            # Слот занят только на время запроса, пауза перед повтором его не держит
+            with slot:
+                bucket.acquire()
+                response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f'{method} {url}: {e}, повтор {attempt + 1}')
+            time.sleep(_retry_delay(None, attempt))
+            continue
+        if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+            return response
+        logger.warning(f'{method} {url}: статус {response.status_code}, повтор {attempt + 1}')
+        time.sleep(_retry_delay(response, attempt))
+    return response
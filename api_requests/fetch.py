@@ -0,0 +1,221 @@
+import asyncio
+import collections
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Сколько страниц одного списка запрашивается одновременно
+PAGE_CONCURRENCY = 4
+# Сколько полученных страниц может ждать обработки в синхронном коде
+PREFETCH_PAGES = 2
+
+
+class FetchError(Exception):
+    """Страница не получена: API вернул ошибку"""
+
+
+async def _fetch_page(fetch_page, *args):
+    """
+    Выполняет синхронный запрос страницы в потоке.
+    Ограничение частоты соблюдается в api_requests.client
+    """
+    page = await asyncio.to_thread(fetch_page, *args)
+    if page is None:
+        raise FetchError(f'{getattr(fetch_page, "__name__", fetch_page)}{args}')
+    return page
+
+
+async def offset_pages(fetch_page, limit, concurrency=PAGE_CONCURRENCY):
+    """
+    Асинхронный итератор страниц API с пагинацией через offset.
+
+    Первая страница запрашивается отдельно, чтобы узнать общее количество,
+    дальше до concurrency страниц запрашиваются одновременно.
+    Страницы отдаются в порядке offset.
+
+    Входящие переменные:
+        fetch_page(offset, limit) - синхронная функция, возвращает
+            (items, total) или None при ошибке. total может быть None,
+            тогда список заканчивается на первой неполной странице
+        limit - размер страницы
+        concurrency - количество одновременных запросов
+    """
+    pending = collections.deque()
+    items, total = await _fetch_page(fetch_page, 0, limit)
+    next_offset = limit
+    try:
+        while True:
+            if items:
+                yield items
+            if len(items) < limit:
+                return
+            while len(pending) < concurrency and (total is None or next_offset < total):
+                pending.append(asyncio.ensure_future(_fetch_page(fetch_page, next_offset, limit)))
+                next_offset += limit
+            if not pending:
+                return
+            items, page_total = await pending.popleft()
+            if page_total is not None:
+                total = page_total
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def cursor_pages(fetch_page, cursor=None):
+    """
+    Асинхронный итератор страниц API с пагинацией через курсор (last_id, nmID...).
+    Следующую страницу нельзя запросить раньше предыдущей, поэтому запросы идут по очереди.
+
+    Входящие переменные:
+        fetch_page(cursor) - синхронная функция, возвращает (items, next_cursor)
+            или None при ошибке. next_cursor=None - последняя страница
+        cursor - начальный курсор
+    """
+    while True:
+        items, cursor = await _fetch_page(fetch_page, cursor)
+        if items:
+            yield items
+        if cursor is None:
+            return
+
+
+def collect(iterator):
+    """
+    Собирает все элементы асинхронного итератора страниц в список.
+    Для синхронного кода; при ошибке API возвращает None
+    """
+    async def run():
+        data = []
+        async for page in iterator:
+            data.extend(page)
+        return data
+
+    try:
+        return asyncio.run(run())
+    except FetchError as e:
+        logger.warning(f'Ошибка получения страницы {e}')
+        return None
+
+
+def collect_many(iterators):
+    """
+    Собирает несколько асинхронных итераторов страниц одновременно
+    (например, по разным акциям или аккаунтам).
+    Возвращает словарь {ключ: список элементов}, при ошибке API по ключу - None
+
+    Входящие переменные:
+        iterators - словарь {ключ: асинхронный итератор}
+    """
+    async def run_one(iterator):
+        data = []
+        async for page in iterator:
+            data.extend(page)
+        return data
+
+    async def run():
+        return await asyncio.gather(
+            *(run_one(iterator) for iterator in iterators.values()), return_exceptions=True)
+
+    results = {}
+    for key, result in zip(iterators, asyncio.run(run())):
+        if isinstance(result, FetchError):
+            logger.warning(f'Ошибка получения страницы {result}')
+            result = None
+        elif isinstance(result, BaseException):
+            raise result
+        results[key] = result
+    return results
+
+
+def iterate(iterator, prefetch=PREFETCH_PAGES):
+    """
+    Синхронный генератор страниц асинхронного итератора для задач импорта.
+
+    Цикл событий работает в отдельном потоке и кладет страницы в очередь
+    на prefetch страниц: пока импорт пишет в базу, следующие страницы
+    уже запрашиваются, но в памяти их не больше prefetch.
+    Ошибка API пробрасывается как FetchError.
+    """
+    pages = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def pump():
+        try:
+            async for page in iterator:
+                if not await asyncio.to_thread(put, page):
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(done)
+
+    thread = threading.Thread(target=asyncio.run, args=(pump(),), daemon=True)
+    thread.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is done:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop.set()
+        thread.join()
+
+
+def chunks(pages, size):
+    """
+    Перекладывает элементы страниц в списки не длиннее size,
+    чтобы импорт работал пачками постоянного размера независимо от размера каталога
+
+    Входящие переменные:
+        pages - итерируемое страниц (списков элементов)
+        size - размер пачки
+    """
+    chunk = []
+    for page in pages:
+        for item in page:
+            chunk.append(item)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_parallel(function, arguments, concurrency=PAGE_CONCURRENCY):
+    """
+    Выполняет синхронные запросы function(*args) для каждого набора аргументов,
+    не более concurrency одновременно. Возвращает результаты в порядке arguments
+
+    Входящие переменные:
+        function - функция запроса из api_requests
+        arguments - список кортежей аргументов
+        concurrency - количество одновременных запросов
+    """
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(args):
+            async with semaphore:
+                return await asyncio.to_thread(function, *args)
+
+        return await asyncio.gather(*(call(args) for args in arguments))
+
+    if not arguments:
+        return []
+    return asyncio.run(run())
@@ -1,6 +1,6 @@
+import functools
 import json
 import logging
-import time
 
 import requests
 from django.core.files.base import ContentFile
@@ -12,6 +12,7 @@ from rest_framework.viewsets import ModelViewSet
 
 from analyticalplatform.settings import (OZON_ID, TOKEN_MY_SKLAD, TOKEN_OZON,
                                          TOKEN_WB)
+from api_requests import client, fetch
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform
 from unit_economics.models import ProductPrice
@@ -20,77 +21,103 @@ from unit_economics.serializers import ProductPriceSerializer
 logger = logging.getLogger(__name__)
 
 
-def moy_sklad_assortment(TOKEN_MY_SKLAD, offset=0, iter_numb=0, products_data_list=None):
+MOY_SKLAD_ASSORTMENT_URL = "https://api.moysklad.ru/api/remap/1.2/entity/assortment?limit={limit}&offset={offset}&filter=archived=false;type=product;type=bundle"
+MOY_SKLAD_ASSORTMENT_ALL_URL = "https://api.moysklad.ru/api/remap/1.2/entity/assortment?limit={limit}&offset={offset}&filter=archived=true;archived=false;type=product;type=bundle"
+MOY_SKLAD_ENTER_URL = "https://api.moysklad.ru/api/remap/1.2/entity/enter?limit={limit}&offset={offset}&order=moment,desc"
+
+
+def moy_sklad_page(TOKEN_MY_SKLAD, url_template, offset, limit):
     """
-    Достает список всех товаров с учетной записи в моем складе
+    Достает одну страницу списка Моего Склада.
+    Возвращает (строки, общее количество) или None при ошибке
 
     Входящие переменные:
         TOKEN_MY_SKLAD - токен учетной записи
-        offset=0 - Начальная позиция
-        iter_numb=0 - Счетчик вызовов метода
-        products_data_list=[] - список с данными всех продуктов
+        url_template - шаблон адреса с {limit} и {offset}
+        offset - начальная позиция
+        limit - количество строк за один запрос
     """
-    if not products_data_list:
-        products_data_list = []
-    limit = 100  # Количество товаров за один запрос
-    api_url = f"https://api.moysklad.ru/api/remap/1.2/entity/assortment?limit={limit}&offset={offset}&filter=archived=false;type=product;type=bundle"
+    api_url = url_template.format(limit=limit, offset=offset)
     headers = {
         'Authorization': f'Bearer {TOKEN_MY_SKLAD}',
         'Accept-Encoding': 'gzip',
         'Content-Type': 'application/json'
     }
-    response = requests.get(api_url, headers=headers)
-    print(response.status_code)
+    response = client.request(client.MOY_SKLAD, "GET", api_url, TOKEN_MY_SKLAD, headers=headers)
     if response.status_code == 200:
         data = response.json()
-        products = data.get('rows', [])
-        for product in products:
-            products_data_list.append(product)
-        if len(products) == limit:
-            iter_numb += 1
-            offset = limit*iter_numb
-            return moy_sklad_assortment(TOKEN_MY_SKLAD, offset, iter_numb, products_data_list)
-        else:
-            return products_data_list
+        return data.get('rows', []), data.get('meta', {}).get('size')
     else:
         message = f'Ошибка при вызове метода {api_url}: {response.status_code}. {response.text}'
         print(message)
 
 
-def moy_sklad_enter(TOKEN_MY_SKLAD, offset=0, iter_numb=0, products_data_list=None):
+def moy_sklad_assortment_pages(TOKEN_MY_SKLAD, limit=100, updated_from=None):
+    """
+    Асинхронный итератор страниц ассортимента (товары и комплекты) Моего Склада.
+    Страницы запрашиваются параллельно по offset
+
+    Входящие переменные:
+        TOKEN_MY_SKLAD - токен учетной записи
+        limit - количество товаров за один запрос
+        updated_from - если задано, только товары с updated >= updated_from
+            (строка вида '2024-05-01 12:00:00.000' как в поле updated)
+    """
+    url_template = MOY_SKLAD_ASSORTMENT_URL
+    if updated_from:
+        url_template = f'{url_template};updated>={updated_from}'
+    return fetch.offset_pages(
+        functools.partial(moy_sklad_page, TOKEN_MY_SKLAD, url_template), limit)
+
+
+def moy_sklad_assortment_all_pages(TOKEN_MY_SKLAD, limit=1000):
+    """
+    Асинхронный итератор страниц всего ассортимента, включая архивные товары.
+    Нужен для сверки: товара нет в выдаче - значит он удален в Моем Складе
+
+    Входящие переменные:
+        TOKEN_MY_SKLAD - токен учетной записи
+        limit - количество товаров за один запрос
+    """
+    return fetch.offset_pages(
+        functools.partial(moy_sklad_page, TOKEN_MY_SKLAD, MOY_SKLAD_ASSORTMENT_ALL_URL), limit)
+
+
+def moy_sklad_enter_pages(TOKEN_MY_SKLAD, limit=1000, updated_from=None):
+    """
+    Асинхронный итератор страниц оприходований Моего Склада
+
+    Входящие переменные:
+        TOKEN_MY_SKLAD - токен учетной записи
+        limit - количество оприходований за один запрос
+        updated_from - если задано, только оприходования с updated >= updated_from
+            (строка вида '2024-05-01 12:00:00.000' как в поле updated)
+    """
+    url_template = MOY_SKLAD_ENTER_URL
+    if updated_from:
+        url_template = f'{url_template}&filter=updated>={updated_from}'
+    return fetch.offset_pages(
+        functools.partial(moy_sklad_page, TOKEN_MY_SKLAD, url_template), limit)
+
+
+def moy_sklad_assortment(TOKEN_MY_SKLAD):
+    """
+    Достает список всех товаров с учетной записи в моем складе
+
+    Входящие переменные:
+        TOKEN_MY_SKLAD - токен учетной записи
+    """
+    return fetch.collect(moy_sklad_assortment_pages(TOKEN_MY_SKLAD))
+
+
+def moy_sklad_enter(TOKEN_MY_SKLAD):
     """
     Достает список оприходований товаров
 
     Входящие переменные:
         TOKEN_MY_SKLAD - токен учетной записи
-        offset=0 - Начальная позиция
-        iter_numb=0 - Счетчик вызовов метода
-        products_data_list=[] - список с данными всех продуктов
     """
-    if not products_data_list:
-        products_data_list = []
-    limit = 1000  # Количество товаров за один запрос
-    api_url = f"https://api.moysklad.ru/api/remap/1.2/entity/enter?limit={limit}&offset={offset}"
-    headers = {
-        'Authorization': f'Bearer {TOKEN_MY_SKLAD}',
-        'Accept-Encoding': 'gzip',
-        'Content-Type': 'application/json'
-    }
-    response = requests.get(api_url, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
-        products = data.get('rows', [])
-        for product in products:
-            products_data_list.append(product)
-        if len(products) == limit:
-            iter_numb += 1
-            offset = limit*iter_numb
-            return moy_sklad_enter(TOKEN_MY_SKLAD, offset, iter_numb, products_data_list)
-        else:
-            return products_data_list
-    else:
-        message = f'Ошибка при вызове метода {api_url}: {response.status_code}. {response.text}'
-        print(message)
+    return fetch.collect(moy_sklad_enter_pages(TOKEN_MY_SKLAD))
 
 
 def moy_sklad_positions_enter(TOKEN_MY_SKLAD, enter_id):
@@ -108,7 +135,7 @@ def moy_sklad_positions_enter(TOKEN_MY_SKLAD, enter_id):
         'Accept-Encoding': 'gzip',
         'Content-Type': 'application/json'
     }
-    response = requests.get(api_url, headers=headers)
+    response = client.request(client.MOY_SKLAD, "GET", api_url, TOKEN_MY_SKLAD, headers=headers)
     if response.status_code == 200:
         data = response.json()
         products = data.get('rows', [])
@@ -126,7 +153,6 @@ def get_assortiment_info(TOKEN_MY_SKLAD, api_url):
         TOKEN_MY_SKLAD - токен учетной записи
         api_url - id ссылка для обращения
     """
-    time.sleep(1)
     api_url = f'{api_url}'
     headers = {
         'Authorization': f'Bearer {TOKEN_MY_SKLAD}',
@@ -134,11 +160,7 @@ def get_assortiment_info(TOKEN_MY_SKLAD, api_url):
         'Content-Type': 'application/json'
     }
     try:
-        try:
-            response = requests.get(url=api_url, headers=headers, timeout=200)
-        except:
-            time.sleep(10)
-        response = requests.get(url=api_url, headers=headers, timeout=500)
+        response = client.request(client.MOY_SKLAD, "GET", api_url, TOKEN_MY_SKLAD, headers=headers)
         if response.status_code == 200:
             data = response.json()
             return data
@@ -164,11 +186,7 @@ def get_stock_info(TOKEN_MY_SKLAD):
         'Accept-Encoding': 'gzip',
         'Content-Type': 'application/json'
     }
-    try:
-        response = requests.get(url=api_url, headers=headers, timeout=200)
-    except:
-        time.sleep(10)
-        response = requests.get(url=api_url, headers=headers, timeout=500)
+    response = client.request(client.MOY_SKLAD, "GET", api_url, TOKEN_MY_SKLAD, headers=headers)
     if response.status_code == 200:
         data = response.json()
         stocks = data.get('rows', [])
@@ -201,7 +219,7 @@ def change_product_price(TOKEN_MY_SKLAD, platform_id, account_name, new_price, p
         'Accept-Encoding': 'gzip',
         'Content-Type': 'application/json'
     }
-    response = requests.get(url=api_url, headers=headers, timeout=100)
+    response = client.request(client.MOY_SKLAD, "GET", api_url, TOKEN_MY_SKLAD, headers=headers, timeout=100)
     salePrices = response.json()['salePrices']
     for sp in salePrices:
         if platform_id != 4:
@@ -213,7 +231,7 @@ def change_product_price(TOKEN_MY_SKLAD, platform_id, account_name, new_price, p
     body = '{"salePrices":' + str(salePrices) + '}'
     body = body.replace("\'", "\"")
     body = json.loads(body)
-    response = requests.put(url=api_url, headers=headers, json=body)
+    response = client.request(client.MOY_SKLAD, "PUT", api_url, TOKEN_MY_SKLAD, headers=headers, json=body)
 
 
 def picture_href_request(token_moy_sklad, api_url):
@@ -224,17 +242,12 @@ def picture_href_request(token_moy_sklad, api_url):
         token_moy_sklad - токен учетной записи
         api_url - URL со ссылкой
     """
-    time.sleep(1)
     headers = {
         'Authorization': f'Bearer {token_moy_sklad}',
         'Accept-Encoding': 'gzip',
         'Content-Type': 'application/json'
     }
-    try:
-        response = requests.get(url=api_url, headers=headers, timeout=200)
-    except:
-        time.sleep(10)
-        response = requests.get(url=api_url, headers=headers, timeout=500)
+    response = client.request(client.MOY_SKLAD, "GET", api_url, token_moy_sklad, headers=headers)
     link = ''
     if response.status_code == 200:
         data = response.json()
@@ -255,17 +268,12 @@ def get_picture_from_moy_sklad(token_moy_sklad, api_url):
         token_moy_sklad - токен учетной записи
         api_url - URL со ссылкой
     """
-    time.sleep(0.5)
     headers = {
         'Authorization': f'Bearer {token_moy_sklad}',
         'Accept-Encoding': 'gzip',
         'Content-Type': 'application/json'
     }
-    try:
-        response = requests.get(url=api_url, headers=headers, timeout=200)
-    except:
-        time.sleep(10)
-        response = requests.get(url=api_url, headers=headers, timeout=500)
+    response = client.request(client.MOY_SKLAD, "GET", api_url, token_moy_sklad, headers=headers)
 
     if response.status_code == 200:
         # Создаем объект модели
@@ -291,11 +299,7 @@ def moy_sklad_bundle_components(TOKEN_MY_SKLAD, bundle_id):
         'Content-Type': 'application/json'
     }
     components_data_list = []
-    try:
-        response = requests.get(url=api_url, headers=headers, timeout=200)
-    except:
-        time.sleep(10)
-        response = requests.get(url=api_url, headers=headers, timeout=500)
+    response = client.request(client.MOY_SKLAD, "GET", api_url, TOKEN_MY_SKLAD, headers=headers)
     if response.status_code == 200:
         data = response.json()
         products = data.get('rows', [])
@@ -315,15 +319,14 @@ def moy_sklad_product_info(TOKEN_MY_SKLAD, product_link):
         TOKEN_MY_SKLAD - токен учетной записи
         product_link - ссылка на продукт
     """
-    time.sleep(0.5)
     api_url = f"{product_link}"
     headers = {
         'Authorization': f'Bearer {TOKEN_MY_SKLAD}',
         'Accept-Encoding': 'gzip',
         'Content-Type': 'application/json'
     }
-    
-    response = requests.get(api_url, headers=headers)
+
+    response = client.request(client.MOY_SKLAD, "GET", api_url, TOKEN_MY_SKLAD, headers=headers)
     if response.status_code == 200:
         data = response.json()
         return data
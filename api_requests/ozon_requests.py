@@ -1,8 +1,8 @@
+import functools
 import json
 import logging
 import time
 
-import requests
 from django.db import transaction
 from django.db.models import Count
 from rest_framework import status, viewsets
@@ -11,6 +11,7 @@ from rest_framework.viewsets import ModelViewSet
 
 from analyticalplatform.settings import (OZON_ID, TOKEN_MY_SKLAD, TOKEN_OZON,
                                          TOKEN_WB)
+from api_requests import client, fetch
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform
 from unit_economics.models import ProductPrice
@@ -19,19 +20,24 @@ from unit_economics.serializers import ProductPriceSerializer
 logger = logging.getLogger(__name__)
 
 
-def ozon_article_list_from_api(TOKEN_OZON, CLEINTID, limit=1000, last_id='', common_data=None):
+def _next_last_id(items, last_id, limit):
+    """Курсор следующей страницы OZON или None, если страница последняя"""
+    if len(items) == limit and last_id:
+        return last_id
+    return None
+
+
+def ozon_article_list_page(TOKEN_OZON, CLEINTID, last_id='', limit=1000):
     """
-    Получаем список всех артикулов OZON
+    Получаем страницу списка артикулов OZON.
+    Возвращает (артикулы, last_id следующей страницы или None) или None при ошибке
 
     Входящие данные:
         TOKEN_OZON - API токен польователя
         CLEINTID - номер Client_id кабинета пользователя
+        last_id - курсор страницы из предыдущего ответа
         limit - лимит на количество выдаваемых товаров в ответе
-        last_id - для работы с пагинацией, если число товаров в ответе равно лимиту
-        common_data - список для всех артикулов, включая работающую пагинацию
     """
-    if not common_data:
-        common_data = []
     url = 'https://api-seller.ozon.ru/v2/product/list'
     payload = json.dumps(
         {
@@ -40,7 +46,7 @@ def ozon_article_list_from_api(TOKEN_OZON, CLEINTID, limit=1000, last_id='', com
                 "product_id": [],
                 "visibility": "ALL"
             },
-            "last_id": "",
+            "last_id": last_id,
             "limit": limit
         }
     )
@@ -48,23 +54,29 @@ def ozon_article_list_from_api(TOKEN_OZON, CLEINTID, limit=1000, last_id='', com
         'Client-Id': CLEINTID,
         'Api-Key': TOKEN_OZON
     }
-    response = requests.request(
-        "POST", url, headers=headers, data=payload)
+    response = client.request(
+        client.OZON, "POST", url, TOKEN_OZON, headers=headers, data=payload)
     if response.status_code == 200:
-        all_data = json.loads(response.text)["result"]['items']
-        last_id = json.loads(response.text)["result"]['last_id']
-        total = json.loads(response.text)["result"]['total']
-        for data in all_data:
-            common_data.append(data)
-        if total == limit:
-            return ozon_article_list_from_api(TOKEN_OZON, CLEINTID, last_id, common_data)
-        else:
-            return common_data
+        result = json.loads(response.text)["result"]
+        items = result['items']
+        return items, _next_last_id(items, result.get('last_id'), limit)
     else:
-        message = f'статус код {response.status_code} у получения списка всех артикулов ozon_article_list_from_api'
+        message = f'статус код {response.status_code} у получения списка всех артикулов ozon_article_list_page'
         # bot.send_message(chat_id=CHAT_ID_ADMIN, text=message)
 
 
+def ozon_article_list_from_api(TOKEN_OZON, CLEINTID):
+    """
+    Получаем список всех артикулов OZON
+
+    Входящие данные:
+        TOKEN_OZON - API токен польователя
+        CLEINTID - номер Client_id кабинета пользователя
+    """
+    return fetch.collect(fetch.cursor_pages(
+        functools.partial(ozon_article_list_page, TOKEN_OZON, CLEINTID), ''))
+
+
 def ozon_article_info_from_api(TOKEN_OZON, CLEINTID, product_id):
     """
     Получаем информацию о входящем артикуле OZON
@@ -85,8 +97,8 @@ def ozon_article_info_from_api(TOKEN_OZON, CLEINTID, product_id):
         'Client-Id': CLEINTID,
         'Api-Key': TOKEN_OZON
     }
-    response = requests.request(
-        "POST", url, headers=headers, data=payload)
+    response = client.request(
+        client.OZON, "POST", url, TOKEN_OZON, headers=headers, data=payload)
     if response.status_code == 200:
         main_data = json.loads(response.text)["result"]
         return main_data
@@ -95,20 +107,17 @@ def ozon_article_info_from_api(TOKEN_OZON, CLEINTID, product_id):
         # bot.send_message(chat_id=CHAT_ID_ADMIN, text=message)
 
 
-def ozon_products_info_from_api(TOKEN_OZON, OZON_ID, limit=1000, last_id='', common_data=None):
+def ozon_products_info_page(TOKEN_OZON, OZON_ID, last_id='', limit=1000):
     """
-    Получаем список всех артикулов OZON
+    Получаем страницу артикулов OZON с характеристиками.
+    Возвращает (артикулы, last_id следующей страницы или None) или None при ошибке
 
     Входящие данные:
         TOKEN_OZON - API токен польователя
         OZON_ID - номер Client_id кабинета пользователя
+        last_id - курсор страницы из предыдущего ответа
         limit - лимит на количество выдаваемых товаров в ответе
-        last_id - для работы с пагинацией, если число товаров в ответе равно лимиту
-        common_data - список для всех артикулов, включая работающую пагинацию
     """
-    if not common_data:
-        common_data = []
-
     url = 'https://api-seller.ozon.ru/v3/products/info/attributes'
     payload = json.dumps(
         {
@@ -125,24 +134,39 @@ def ozon_products_info_from_api(TOKEN_OZON, OZON_ID, limit=1000, last_id='', com
         'Client-Id': OZON_ID,
         'Api-Key': TOKEN_OZON
     }
-    response = requests.request(
-        "POST", url, headers=headers, data=payload)
+    response = client.request(
+        client.OZON, "POST", url, TOKEN_OZON, headers=headers, data=payload)
     if response.status_code == 200:
-        all_data = json.loads(response.text)["result"]
-        total = json.loads(response.text)['total']
-        last_id = json.loads(response.text)['last_id']
-
-        for data in all_data:
-            common_data.append(data)
-        if total == limit:
-            return ozon_products_info_from_api(TOKEN_OZON, OZON_ID, last_id, common_data)
-        else:
-            return common_data
+        data = json.loads(response.text)
+        items = data["result"]
+        return items, _next_last_id(items, data.get('last_id'), limit)
     else:
-        message = f'статус код {response.status_code} у получения списка всех артикулов ozon_products_info_from_api'
+        message = f'статус код {response.status_code} у получения списка всех артикулов ozon_products_info_page'
         # bot.send_message(chat_id=CHAT_ID_ADMIN, text=message)
 
 
+def ozon_products_info_pages(TOKEN_OZON, OZON_ID):
+    """
+    Асинхронный итератор страниц артикулов OZON с характеристиками
+
+    Входящие данные:
+        TOKEN_OZON - API токен польователя
+        OZON_ID - номер Client_id кабинета пользователя
+    """
+    return fetch.cursor_pages(functools.partial(ozon_products_info_page, TOKEN_OZON, OZON_ID), '')
+
+
+def ozon_products_info_from_api(TOKEN_OZON, OZON_ID):
+    """
+    Получаем список всех артикулов OZON
+
+    Входящие данные:
+        TOKEN_OZON - API токен польователя
+        OZON_ID - номер Client_id кабинета пользователя
+    """
+    return fetch.collect(ozon_products_info_pages(TOKEN_OZON, OZON_ID))
+
+
 def ozon_product_info_with_sku_data(token_ozon, ozon_id, product_id):
     """
     Получаем артикул OZON по которому нужны данные
@@ -162,8 +186,8 @@ def ozon_product_info_with_sku_data(token_ozon, ozon_id, product_id):
         'Client-Id': ozon_id,
         'Api-Key': token_ozon
     }
-    response = requests.request(
-        "POST", api_url, headers=headers, data=payload)
+    response = client.request(
+        client.OZON, "POST", api_url, token_ozon, headers=headers, data=payload)
     if response.status_code == 200:
         all_data = json.loads(response.text)["result"]
         return all_data
@@ -171,19 +195,17 @@ def ozon_product_info_with_sku_data(token_ozon, ozon_id, product_id):
         message = f'статус код {response.status_code} у {api_url}. {response.text}'
 
 
-def ozon_products_comission_info_from_api(TOKEN_OZON, OZON_ID, limit=1000, last_id='', common_data=None):
+def ozon_products_comission_info_page(TOKEN_OZON, OZON_ID, last_id='', limit=1000):
     """
-    Получаем список всех артикулов OZON с информацией о комиссиях
+    Получаем страницу артикулов OZON с информацией о ценах и комиссиях.
+    Возвращает (артикулы, last_id следующей страницы или None) или None при ошибке
 
     Входящие данные:
         TOKEN_OZON - API токен польователя
         OZON_ID - номер Client_id кабинета пользователя
+        last_id - курсор страницы из предыдущего ответа
         limit - лимит на количество выдаваемых товаров в ответе
-        last_id - для работы с пагинацией, если число товаров в ответе равно лимиту
-        common_data - список для всех артикулов, включая работающую пагинацию
     """
-    if not common_data:
-        common_data = []
     url = 'https://api-seller.ozon.ru/v4/product/info/prices'
     payload = json.dumps(
         {
@@ -200,24 +222,40 @@ def ozon_products_comission_info_from_api(TOKEN_OZON, OZON_ID, limit=1000, last_
         'Client-Id': OZON_ID,
         'Api-Key': TOKEN_OZON
     }
-    response = requests.request(
-        "POST", url, headers=headers, data=payload)
+    response = client.request(
+        client.OZON, "POST", url, TOKEN_OZON, headers=headers, data=payload)
     if response.status_code == 200:
-        all_data = json.loads(response.text)["result"]['items']
-        total = json.loads(response.text)["result"]['total']
-        last_id = json.loads(response.text)["result"]['last_id']
-
-        for data in all_data:
-            common_data.append(data)
-        if total == limit:
-            return ozon_products_info_from_api(TOKEN_OZON, OZON_ID, last_id, common_data)
-        else:
-            return common_data
+        result = json.loads(response.text)["result"]
+        items = result['items']
+        return items, _next_last_id(items, result.get('last_id'), limit)
     else:
-        message = f'статус код {response.status_code} у получения списка всех артикулов ozon_products_info_from_api'
+        message = f'статус код {response.status_code} у получения списка всех артикулов ozon_products_comission_info_page'
         # bot.send_message(chat_id=CHAT_ID_ADMIN, text=message)
 
 
+def ozon_products_comission_info_pages(TOKEN_OZON, OZON_ID):
+    """
+    Асинхронный итератор страниц артикулов OZON с информацией о комиссиях
+
+    Входящие данные:
+        TOKEN_OZON - API токен польователя
+        OZON_ID - номер Client_id кабинета пользователя
+    """
+    return fetch.cursor_pages(
+        functools.partial(ozon_products_comission_info_page, TOKEN_OZON, OZON_ID), '')
+
+
+def ozon_products_comission_info_from_api(TOKEN_OZON, OZON_ID):
+    """
+    Получаем список всех артикулов OZON с информацией о комиссиях
+
+    Входящие данные:
+        TOKEN_OZON - API токен польователя
+        OZON_ID - номер Client_id кабинета пользователя
+    """
+    return fetch.collect(ozon_products_comission_info_pages(TOKEN_OZON, OZON_ID))
+
+
 def ozon_actions_list(TOKEN_OZON, OZON_ID):
     """
     Получаем список всех акций OZON, в которых можно участвовать
@@ -233,8 +271,8 @@ def ozon_actions_list(TOKEN_OZON, OZON_ID):
         'Client-Id': OZON_ID,
         'Api-Key': TOKEN_OZON
     }
-    response = requests.request(
-        "GET", api_url, headers=headers)
+    response = client.request(
+        client.OZON, "GET", api_url, TOKEN_OZON, headers=headers)
     if response.status_code == 200:
         all_data = json.loads(response.text)["result"]
         return all_data
@@ -243,20 +281,18 @@ def ozon_actions_list(TOKEN_OZON, OZON_ID):
         # bot.send_message(chat_id=CHAT_ID_ADMIN, text=message)
 
 
-def ozon_actions_product_price_info(TOKEN_OZON, OZON_ID, action_id, limit=1000, offset=0, counter=0, common_data=None):
+def ozon_actions_product_price_page(TOKEN_OZON, OZON_ID, action_id, offset=0, limit=1000):
     """
-    Получаем список всех артикулов OZON с информацией о комиссиях
+    Получаем страницу артикулов OZON, которые могут участвовать в акции.
+    Возвращает (артикулы, общее количество) или None при ошибке
 
     Входящие данные:
         TOKEN_OZON - API токен польователя
         OZON_ID - номер Client_id кабинета пользователя
         action_id - id акции
+        offset - количество пропускаемых товаров
         limit - лимит на количество выдаваемых товаров в ответе
-        offset - для работы с пагинацией, если число товаров в ответе равно лимиту
-        common_data - список для всех артикулов, включая работающую пагинацию
     """
-    if not common_data:
-        common_data = []
     api_url = 'https://api-seller.ozon.ru/v1/actions/candidates'
     payload = json.dumps(
         {
@@ -269,19 +305,38 @@ def ozon_actions_product_price_info(TOKEN_OZON, OZON_ID, action_id, limit=1000,
         'Client-Id': OZON_ID,
         'Api-Key': TOKEN_OZON
     }
-    response = requests.request(
-        "POST", api_url, headers=headers, data=payload)
+    response = client.request(
+        client.OZON, "POST", api_url, TOKEN_OZON, headers=headers, data=payload)
     if response.status_code == 200:
-        all_data = json.loads(response.text)["result"]['products']
-        total = json.loads(response.text)["result"]['total']
-        counter += 1
-        offset = limit * counter
-        for data in all_data:
-            common_data.append(data)
-        if total == limit:
-            return ozon_actions_product_price_info(TOKEN_OZON, OZON_ID, action_id, limit, offset, counter, common_data)
-        else:
-            return common_data
+        result = json.loads(response.text)["result"]
+        return result['products'], result.get('total')
     else:
         message = f'статус код {response.status_code} у {api_url}'
         # bot.send_message(chat_id=CHAT_ID_ADMIN, text=message)
+
+
+def ozon_actions_product_price_pages(TOKEN_OZON, OZON_ID, action_id, limit=1000):
+    """
+    Асинхронный итератор страниц артикулов OZON в акции.
+    Страницы запрашиваются параллельно по offset
+
+    Входящие данные:
+        TOKEN_OZON - API токен польователя
+        OZON_ID - номер Client_id кабинета пользователя
+        action_id - id акции
+        limit - лимит на количество выдаваемых товаров в ответе
+    """
+    return fetch.offset_pages(
+        functools.partial(ozon_actions_product_price_page, TOKEN_OZON, OZON_ID, action_id), limit)
+
+
+def ozon_actions_product_price_info(TOKEN_OZON, OZON_ID, action_id):
+    """
+    Получаем список всех артикулов OZON с информацией о возможной цене в акции
+
+    Входящие данные:
+        TOKEN_OZON - API токен польователя
+        OZON_ID - номер Client_id кабинета пользователя
+        action_id - id акции
+    """
+    return fetch.collect(ozon_actions_product_price_pages(TOKEN_OZON, OZON_ID, action_id))
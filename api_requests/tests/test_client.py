@@ -0,0 +1,92 @@
+import threading
+import time
+
+import requests
+
+from api_requests import client
+
+
+class FakeSession:
+    """Сессия, которая отдает заранее заданные статусы ответов"""
+
+    def __init__(self, statuses, headers=None):
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        response.headers.update(self.headers)
+        return response
+
+
+def test_request_retries_429_honouring_retry_after(monkeypatch):
+    session = FakeSession([429, 503, 200], headers={'Retry-After': '2'})
+    delays = []
+    monkeypatch.setattr(client, 'get_session', lambda marketplace: session)
+    monkeypatch.setattr(client.time, 'sleep', delays.append)
+
+    response = client.request(client.OZON, 'GET', 'https://example.com', 'token-retry')
+
+    assert response.status_code == 200
+    assert session.calls == 3
+    assert delays == [2.0, 2.0]
+
+
+def test_request_returns_last_response_after_max_retries(monkeypatch):
+    session = FakeSession([500, 500, 500])
+    monkeypatch.setattr(client, 'get_session', lambda marketplace: session)
+    monkeypatch.setattr(client.time, 'sleep', lambda delay: None)
+
+    response = client.request(client.WILDBERRIES, 'GET', 'https://example.com', 'token-fail', max_retries=2)
+
+    assert response.status_code == 500
+    assert session.calls == 3
+
+
+def test_token_bucket_waits_after_burst(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(client.time, 'monotonic', lambda: now[0])
+
+    def fake_sleep(delay):
+        now[0] += delay
+
+    monkeypatch.setattr(client.time, 'sleep', fake_sleep)
+    bucket = client.TokenBucket(rate=2, capacity=2)
+    for _ in range(4):
+        bucket.acquire()
+
+    assert now[0] == 1.0
+
+
+def test_request_limits_concurrent_moy_sklad_requests_per_token(monkeypatch):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    class SlowSession:
+        def request(self, method, url, **kwargs):
+            with lock:
+                running.append(url)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(url)
+            response = requests.Response()
+            response.status_code = 200
+            return response
+
+    monkeypatch.setattr(client, 'get_session', lambda marketplace: SlowSession())
+    limit = client.CONCURRENCY_LIMITS[client.MOY_SKLAD]
+    threads = [
+        threading.Thread(target=client.request, args=(
+            client.MOY_SKLAD, 'GET', f'https://example.com/{number}', 'token-concurrency'))
+        for number in range(limit * 3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == limit
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from api_requests import fetch
+
+
+def test_offset_pages_keeps_order_and_stops_at_total():
+    offsets = []
+    lock = threading.Lock()
+
+    def fetch_page(offset, limit):
+        with lock:
+            offsets.append(offset)
+        items = list(range(offset, min(offset + limit, 95)))
+        return items, 95
+
+    data = fetch.collect(fetch.offset_pages(fetch_page, limit=10, concurrency=3))
+
+    assert data == list(range(95))
+    assert sorted(offsets) == list(range(0, 100, 10))
+
+
+def test_offset_pages_without_total_stops_on_short_page():
+    def fetch_page(offset, limit):
+        return list(range(offset, min(offset + limit, 25))), None
+
+    data = fetch.collect(fetch.offset_pages(fetch_page, limit=10, concurrency=2))
+
+    assert data == list(range(25))
+
+
+def test_cursor_pages_is_not_recursive():
+    pages = 3000
+
+    def fetch_page(cursor):
+        next_cursor = cursor + 1 if cursor + 1 < pages else None
+        return [cursor], next_cursor
+
+    data = fetch.collect(fetch.cursor_pages(fetch_page, 0))
+
+    assert data == list(range(pages))
+
+
+def test_collect_many_returns_none_for_failed_iterator():
+    def good_page(offset, limit):
+        return [offset], 1
+
+    def bad_page(offset, limit):
+        return None
+
+    results = fetch.collect_many({
+        'good': fetch.offset_pages(good_page, limit=1),
+        'bad': fetch.offset_pages(bad_page, limit=1),
+    })
+
+    assert results == {'good': [0], 'bad': None}
+
+
+def test_iterate_streams_pages_into_bounded_chunks():
+    def fetch_page(offset, limit):
+        return list(range(offset, min(offset + limit, 45))), 45
+
+    pages = fetch.iterate(fetch.offset_pages(fetch_page, limit=10), prefetch=1)
+    chunks = list(fetch.chunks(pages, 20))
+
+    assert [len(chunk) for chunk in chunks] == [20, 20, 5]
+    assert sum(chunks, []) == list(range(45))
+
+
+def test_iterate_raises_fetch_error_and_stops_early():
+    def fetch_page(cursor):
+        if cursor == 2:
+            return None
+        return [cursor], cursor + 1
+
+    received = []
+    with pytest.raises(fetch.FetchError):
+        for page in fetch.iterate(fetch.cursor_pages(fetch_page, 0)):
+            received.extend(page)
+
+    assert received == [0, 1]
+
+    pages = fetch.iterate(fetch.cursor_pages(lambda cursor: ([cursor], cursor + 1), 0))
+    assert next(pages) == [0]
+    pages.close()
@@ -1,11 +1,11 @@
 import calendar
 import datetime
+import functools
 import json
 import logging
 import time
 from datetime import datetime
 
-import requests
 from django.db import transaction
 from django.db.models import Count
 from rest_framework import status, viewsets
@@ -14,6 +14,7 @@ from rest_framework.viewsets import ModelViewSet
 
 from analyticalplatform.settings import (OZON_ID, TOKEN_MY_SKLAD, TOKEN_OZON,
                                          TOKEN_WB)
+from api_requests import client, fetch
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform
 from unit_economics.models import ProductPrice
@@ -22,25 +23,27 @@ from unit_economics.serializers import ProductPriceSerializer
 logger = logging.getLogger(__name__)
 
 
-def wb_article_data_from_api(TOKEN_WB, update_date=None, mn_id=0, common_data=None, counter=0):
-    """Получаем данные всех артикулов в ВБ"""
-    if not common_data:
-        common_data = []
-    if update_date:
-        cursor = {
-            "limit": 100,
-            "updatedAt": update_date,
-            "nmID": mn_id
-        }
-    else:
-        cursor = {
-            "limit": 100,
-            "nmID": mn_id
-        }
+WB_CARDS_LIMIT = 100
+
+
+def wb_article_data_page(TOKEN_WB, cursor=None):
+    """
+    Получаем страницу карточек артикулов ВБ.
+    Возвращает (карточки, курсор следующей страницы или None) или None при ошибке
+
+    Входящие переменные:
+        TOKEN_WB - токен учетной записи ВБ
+        cursor - словарь {"updatedAt", "nmID"} из предыдущего ответа
+    """
+    cursor = {"limit": WB_CARDS_LIMIT, **(cursor or {})}
     url = 'https://suppliers-api.wildberries.ru/content/v2/get/cards/list'
     payload = json.dumps(
         {
             "settings": {
+                # По возрастанию updatedAt: курсор последней страницы - отметка для следующей загрузки
+                "sort": {
+                    "ascending": True
+                },
                 "cursor": cursor,
                 "filter": {
                     "withPhoto": -1
@@ -51,55 +54,69 @@ def wb_article_data_from_api(TOKEN_WB, update_date=None, mn_id=0, common_data=No
     headers = {
         'Authorization': f'{TOKEN_WB}'
     }
-    response = requests.request(
-        "POST", url, headers=headers, data=payload)
-    counter += 1
+    response = client.request(
+        client.WILDBERRIES, "POST", url, TOKEN_WB, headers=headers, data=payload)
     if response.status_code == 200:
-        all_data = json.loads(response.text)["cards"]
-        check_amount = json.loads(response.text)['cursor']
-        for data in all_data:
-            common_data.append(data)
-        if len(json.loads(response.text)["cards"]) == 100:
-            return wb_article_data_from_api(TOKEN_WB,
-                                            check_amount['updatedAt'], check_amount['nmID'], common_data, counter)
-        else:
-            return common_data
-    elif response.status_code != 200 and counter <= 50:
-        return wb_article_data_from_api(TOKEN_WB, update_date, mn_id, common_data, counter)
+        data = json.loads(response.text)
+        cards = data["cards"]
+        next_cursor = None
+        if len(cards) == WB_CARDS_LIMIT:
+            next_cursor = {
+                "updatedAt": data['cursor']['updatedAt'],
+                "nmID": data['cursor']['nmID']
+            }
+        return cards, next_cursor
     else:
-        message = f'статус код {response.status_code} у получения инфы всех артикулов api_request.wb_article_data'
+        message = f'статус код {response.status_code} у получения инфы всех артикулов api_request.wb_article_data_page'
         # bot.send_message(chat_id=CHAT_ID_ADMIN, text=message)
 
 
-def wb_price_data_from_api(TOKEN_WB, limit=1000, offset='', common_data=None, counter=0):
-    """Получаем данные с ценой и скидкой всех артикулов в ВБ"""
-    if not common_data:
-        common_data = []
+def wb_article_data_pages(TOKEN_WB, cursor=None):
+    """
+    Асинхронный итератор страниц карточек ВБ в порядке возрастания updatedAt.
+    API отдает страницы только по курсору, поэтому запросы идут по очереди
+
+    Входящие переменные:
+        TOKEN_WB - токен учетной записи ВБ
+        cursor - курсор {"updatedAt", "nmID"}: только карточки, измененные после него
+    """
+    return fetch.cursor_pages(functools.partial(wb_article_data_page, TOKEN_WB), cursor)
+
+
+def wb_article_data_from_api(TOKEN_WB):
+    """Получаем данные всех артикулов в ВБ"""
+    return fetch.collect(wb_article_data_pages(TOKEN_WB))
+
+
+def wb_price_data_page(TOKEN_WB, offset=0, limit=1000):
+    """
+    Получаем страницу цен и скидок артикулов ВБ.
+    Возвращает (товары, None) или None при ошибке: общее количество API не отдает
+    """
     url = f'https://discounts-prices-api.wildberries.ru/api/v2/list/goods/filter?limit={limit}&offset={offset}'
 
     headers = {
         'Authorization': f'{TOKEN_WB}'
     }
-    response = requests.request(
-        "GET", url, headers=headers)
-    counter += 1
+    response = client.request(client.WILDBERRIES, "GET", url, TOKEN_WB, headers=headers)
     if response.status_code == 200:
         all_data = json.loads(response.text)["data"]
-        article_amount = all_data['listGoods']
-        for data in article_amount:
-            common_data.append(data)
-        if len(article_amount) == limit:
-            offset = limit * counter
-            return wb_price_data_from_api(TOKEN_WB, limit, offset, common_data, counter)
-        else:
-            return common_data
-    elif response.status_code != 200 and counter <= 50:
-        return wb_price_data_from_api(TOKEN_WB, limit, offset, common_data, counter)
+        return all_data['listGoods'], None
     else:
-        message = f'статус код {response.status_code} у получения инфы всех артикулов wb_price_data_from_api'
+        message = f'статус код {response.status_code} у получения инфы всех артикулов wb_price_data_page'
         # bot.send_message(chat_id=CHAT_ID_ADMIN, text=message)
 
 
+def wb_price_data_pages(TOKEN_WB, limit=1000):
+    """Асинхронный итератор страниц цен и скидок артикулов ВБ"""
+    return fetch.offset_pages(functools.partial(wb_price_data_page, TOKEN_WB), limit)
+
+
+def wb_price_data_from_api(TOKEN_WB, limit=1000):
+    """Получаем данные с ценой и скидкой всех артикулов в ВБ"""
+    return fetch.collect(wb_price_data_pages(TOKEN_WB, limit))
+
+
 def wb_comissions(TOKEN_WB):
     """
     Достает комиссии всех присутствующих категорий
@@ -111,7 +128,7 @@ def wb_comissions(TOKEN_WB):
     headers = {
         'Authorization': f'{TOKEN_WB}'
     }
-    response = requests.get(api_url, headers=headers)
+    response = client.request(client.WILDBERRIES, "GET", api_url, TOKEN_WB, headers=headers)
     if response.status_code == 200:
         data = response.json().get('report', [])
         return data
@@ -132,7 +149,7 @@ def wb_logistic(TOKEN_WB):
     headers = {
         'Authorization': f'{TOKEN_WB}'
     }
-    response = requests.get(api_url, headers=headers)
+    response = client.request(client.WILDBERRIES, "GET", api_url, TOKEN_WB, headers=headers)
     if response.status_code == 200:
 
         main_data = response.json().get('response', [])
@@ -162,7 +179,7 @@ def wb_actions_list(TOKEN_WB):
     headers = {
         'Authorization': f'{TOKEN_WB}'
     }
-    response = requests.get(api_url, headers=headers)
+    response = client.request(client.WILDBERRIES, "GET", api_url, TOKEN_WB, headers=headers)
     if response.status_code == 200:
         main_data = response.json()
         if main_data:
@@ -186,7 +203,7 @@ def wb_actions_product_price_info(TOKEN_WB, action_id):
     headers = {
         'Authorization': f'{TOKEN_WB}'
     }
-    response = requests.get(api_url, headers=headers)
+    response = client.request(client.WILDBERRIES, "GET", api_url, TOKEN_WB, headers=headers)
     if response.status_code == 200:
         main_data = response.json()
         if main_data:
@@ -1,10 +1,10 @@
 import datetime
+import functools
 import json
 import logging
 import time
 from datetime import datetime
 
-import requests
 from django.db import transaction
 from django.db.models import Count
 from rest_framework import status, viewsets
@@ -13,6 +13,7 @@ from rest_framework.viewsets import ModelViewSet
 
 from analyticalplatform.settings import (OZON_ID, TOKEN_MY_SKLAD, TOKEN_OZON,
                                          TOKEN_WB, TOKEN_YM)
+from api_requests import client, fetch
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform
 from unit_economics.models import ProductPrice
@@ -27,37 +28,51 @@ def yandex_campaigns_data(TOKEN_YM):
     headers = {
         'Authorization': f'Bearer {TOKEN_YM}'
     }
-    response = requests.get(api_url, headers=headers)
+    response = client.request(client.YANDEX_MARKET, "GET", api_url, TOKEN_YM, headers=headers)
     if response.status_code == 200:
         campaigns_list = response.json().get('campaigns', [])
         return campaigns_list
 
 
-def yandex_campaigns_from_business(TOKEN_YM, business_id, limit=100, page_token='', data_list=None):
-    """Возвращает список кампаний от входящего business_id
+def yandex_offer_mappings_page(TOKEN_YM, business_id, page_token='', limit=100):
+    """
+    Возвращает страницу товаров кабинета: (товары, nextPageToken или None)
+    или None при ошибке
 
     Входящие переменные:
         TOKEN_YM - Bearer токен с яндекс маркета
         business_id - кабинет, с которого нужно вытянуть товары
+        page_token - токен страницы из предыдущего ответа
     """
-    if not data_list:
-        data_list = []
     api_url = f"https://api.partner.market.yandex.ru/businesses/{business_id}/offer-mappings?limit={limit}&page_token={page_token}"
     headers = {
         'Authorization': f'Bearer {TOKEN_YM}'
     }
     payload = {}
-    response = requests.request("POST", api_url, headers=headers, data=payload)
+    response = client.request(client.YANDEX_MARKET, "POST", api_url, TOKEN_YM, headers=headers, data=payload)
     if response.status_code == 200:
-        all_data = json.loads(response.text)["result"]['offerMappings']
-        for data in all_data:
-            data_list.append(data)
-        if len(all_data) == limit:
-            page_token = json.loads(response.text)[
-                "result"]['paging']['nextPageToken']
-            return yandex_campaigns_from_business(TOKEN_YM, business_id, limit, page_token, data_list)
-        else:
-            return data_list
+        result = json.loads(response.text)["result"]
+        offers = result['offerMappings']
+        next_page_token = None
+        if len(offers) == limit:
+            next_page_token = result.get('paging', {}).get('nextPageToken')
+        return offers, next_page_token
+
+
+def yandex_offer_mappings_pages(TOKEN_YM, business_id):
+    """Асинхронный итератор страниц товаров кабинета business_id"""
+    return fetch.cursor_pages(
+        functools.partial(yandex_offer_mappings_page, TOKEN_YM, business_id), '')
+
+
+def yandex_campaigns_from_business(TOKEN_YM, business_id):
+    """Возвращает список товаров кабинета от входящего business_id
+
+    Входящие переменные:
+        TOKEN_YM - Bearer токен с яндекс маркета
+        business_id - кабинет, с которого нужно вытянуть товары
+    """
+    return fetch.collect(yandex_offer_mappings_pages(TOKEN_YM, business_id))
 
 
 def yandex_comission_calculate(TOKEN_YM: str, logistic_type: str, offers_list: list) -> list:
@@ -82,7 +97,7 @@ def yandex_comission_calculate(TOKEN_YM: str, logistic_type: str, offers_list: l
         "offers": offers_list
     })
 
-    response = requests.request("POST", api_url, headers=headers, data=payload)
+    response = client.request(client.YANDEX_MARKET, "POST", api_url, TOKEN_YM, headers=headers, data=payload)
 
     if response.status_code != 200:
         print(payload)
@@ -108,8 +123,8 @@ def yandex_actions_list(ya_token, business_id):
     headers = {
         'Authorization': f'Bearer {ya_token}'
     }
-    response = requests.request(
-        "POST", api_url, headers=headers)
+    response = client.request(
+        client.YANDEX_MARKET, "POST", api_url, ya_token, headers=headers)
     if response.status_code == 200:
         all_data = json.loads(response.text)["result"]["promos"]
         return all_data
@@ -138,8 +153,8 @@ def yandex_actions_product_price_info(ya_token, business_id, action_id, limit=50
     headers = {
         'Authorization': f'Bearer {ya_token}'
     }
-    response = requests.request(
-        "POST", api_url, headers=headers, data=payload)
+    response = client.request(
+        client.YANDEX_MARKET, "POST", api_url, ya_token, headers=headers, data=payload)
     if response.status_code == 200:
         all_data = json.loads(response.text)["result"]['offers']
         return all_data
@@ -32,3 +32,20 @@ def test_user_name():
 def test_user_password():
     """Возвращает тестового пользователя"""
     return "testtest"
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", default=False,
+                     help="Запустить бенчмарки (тесты с меткой benchmark)")
+    parser.addoption("--benchmark-save", action="store_true", default=False,
+                     help="Записать замеры бенчмарков как новые базовые значения")
+
+
+def pytest_collection_modifyitems(config, items):
+    """Бенчмарки долгие, без --benchmark они пропускаются"""
+    if config.getoption("--benchmark") or config.getoption("--benchmark-save"):
+        return
+    skip_benchmark = pytest.mark.skip(reason="бенчмарк, запуск с --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
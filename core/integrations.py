@@ -1,7 +1,6 @@
 from typing import List
 
 import requests
-from django.db.models import Q
 from requests import Session
 
 from analyticalplatform.integrations import BaseIntegration
@@ -21,34 +20,54 @@ class BaseProductsIntegration(BaseIntegration):
     def get_products(self) -> List[dict]:
         raise NotImplementedError
 
-    def refresh_products(self):
-        from core.models import Product
+    def refresh_products(self) -> int:
+        """
+        Сверяет товары аккаунта с товарами платформы по баркоду.
 
-        platform_products_data = self.get_products() or []
+        Товары платформы и БД раскладываются в словари по баркоду, после чего
+        вычисляются множества на удаление, обновление и создание. Строки, поля
+        которых не изменились, не обновляются.
+        Возвращает количество удаленных, обновленных и созданных товаров
+        """
+        from core.models import Product
 
-        platform_products_barcodes_list = [item["barcode"] for item in platform_products_data]
+        platform_products = {item["barcode"]: item for item in self.get_products() or []}
+        update_fields = self.get_object_available_fields()[Product]
 
-        self.get_db_products().exclude(
-            Q(barcode__in=platform_products_barcodes_list) | Q(has_manual_connection=True)
-        ).delete()
+        account_products = {}
+        delete_ids = []
+        for product_obj in self.get_db_products():
+            if product_obj.barcode in platform_products:
+                account_products.setdefault(product_obj.barcode, product_obj)
+            elif not product_obj.has_manual_connection:
+                delete_ids.append(product_obj.id)
 
-        account_products = self.get_db_products()
+        deleted_count = len(delete_ids)
+        if delete_ids:
+            Product.objects.filter(id__in=delete_ids).delete()
 
         bulk_update_objects = []
         bulk_create_objects = []
 
-        for product_data in platform_products_data:
-            product_obj = next((item for item in account_products if item.barcode == product_data["barcode"]), None)
-            if product_obj:
-                for key in product_data:
-                    if hasattr(product_obj, key):
-                        setattr(product_obj, key, product_data[key])
-                bulk_update_objects.append(product_obj)
-            else:
+        for barcode, product_data in platform_products.items():
+            product_obj = account_products.get(barcode)
+            if not product_obj:
                 bulk_create_objects.append(Product(account=self.account, **product_data))
+                continue
+            changed = False
+            for key in update_fields:
+                if key not in product_data:
+                    continue
+                value = Product._meta.get_field(key).to_python(product_data[key])
+                if getattr(product_obj, key) != value:
+                    setattr(product_obj, key, value)
+                    changed = True
+            if changed:
+                bulk_update_objects.append(product_obj)
 
         self.update_existing_objects(Product, bulk_update_objects)
         self.create_new_objects(Product, bulk_create_objects)
+        return deleted_count + len(bulk_update_objects) + len(bulk_create_objects)
 
 
 class WildBerriesIntegration(BaseProductsIntegration):
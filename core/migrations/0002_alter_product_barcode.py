@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='barcode',
+            field=models.CharField(db_index=True, max_length=255, verbose_name='Баркод'),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.contrib.auth.models import PermissionsMixin
 from django.db import models
+from django.db.models import OuterRef, Subquery
 
 from core.enums import MarketplaceChoices
 from core.integrations import (
@@ -52,6 +53,7 @@ class User(AbstractBaseUser, PermissionsMixin):
         verbose_name_plural = "Пользователи аналитической платформы"
 
     def refresh_user_products_connections(self):
+        """Связывает товары маркетплейсов с товарами Мой Склад по баркоду одним UPDATE"""
         moy_sklad_products = Product.objects.filter(
             account__in=self.accounts.all(),
             account__platform__platform_type=MarketplaceChoices.MOY_SKLAD,
@@ -60,18 +62,10 @@ class User(AbstractBaseUser, PermissionsMixin):
             account__platform__platform_type=MarketplaceChoices.MOY_SKLAD
         )
 
-        bulk_update_list = []
-
-        for item in other_products:
-            filtered_data = list(filter(lambda product: product.barcode == item.barcode, moy_sklad_products))
-            if len(filtered_data) != 0:
-                item.connection = filtered_data[0]
-            else:
-                item.connection = None
-            item.has_manual_connection = False
-            bulk_update_list.append(item)
-
-        Product.objects.bulk_update(bulk_update_list, fields=["connection", "has_manual_connection"])
+        other_products.update(
+            connection=Subquery(moy_sklad_products.filter(barcode=OuterRef("barcode")).order_by("id").values("id")[:1]),
+            has_manual_connection=False,
+        )
 
 
 def default_authorization_fields():
@@ -189,7 +183,7 @@ class Product(models.Model):
     brand = models.TextField(null=True, blank=True, verbose_name="Бренд")
     sku = models.CharField(max_length=255, verbose_name="Идентификатор товара на платформе")
     vendor = models.CharField(max_length=255, null=False, verbose_name="Артикул")
-    barcode = models.CharField(max_length=255, null=False, verbose_name="Баркод")
+    barcode = models.CharField(max_length=255, null=False, db_index=True, verbose_name="Баркод")
 
     connection = models.ForeignKey(
         "self",
@@ -1,22 +1,53 @@
+from itertools import groupby
+
+from celery import chain, chord, group
+
 from analyticalplatform.celery import app
-from core.models import Account
-from core.utils import skip_if_running
-from stock.tasks import periodic_orders_parse
+from core.models import Account, User
+from core.utils import run_account_sync, skip_if_running
+from stock.tasks import refresh_account_orders
 
 
 @app.task(bind=True)
 @skip_if_running
-def periodic_products_parse(*_):
-    accounts = Account.objects.all()
+def refresh_account_products(self, account_id):
+    """Обновляет товары одного аккаунта"""
+    return run_account_sync(
+        self, account_id, "refresh_products", lambda account: account.get_platform_processor().refresh_products()
+    )
 
-    users = []
 
-    for account in accounts:
-        if account.user not in users:
-            users.append(account.user)
-        account.get_platform_processor().refresh_products()
-
-    for user in users:
+@app.task()
+def refresh_user_connections(user_id):
+    """Пересобирает связи товаров пользователя после обновления всех его аккаунтов"""
+    user = User.objects.filter(id=user_id).first()
+    if user:
         user.refresh_user_products_connections()
 
-    periodic_orders_parse.apply_async()
+
+def products_parse_workflow(accounts):
+    """
+    Граф задач синхронизации: для каждого пользователя chord из обновлений
+    товаров его аккаунтов, после которого пересобираются связи товаров
+    и параллельно обновляются заказы этих аккаунтов
+    """
+    workflows = []
+    for user_id, user_accounts in groupby(accounts, key=lambda account: account.user_id):
+        account_ids = [account.id for account in user_accounts]
+        workflows.append(
+            chord(
+                group(refresh_account_products.si(account_id) for account_id in account_ids),
+                chain(
+                    refresh_user_connections.si(user_id),
+                    group(refresh_account_orders.si(account_id) for account_id in account_ids),
+                ),
+            )
+        )
+    return group(workflows)
+
+
+@app.task(bind=True)
+@skip_if_running
+def periodic_products_parse(*_):
+    accounts = Account.objects.order_by("user_id", "id")
+    products_parse_workflow(accounts).apply_async()
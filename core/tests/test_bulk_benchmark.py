@@ -0,0 +1,64 @@
+"""
+Сравнение стратегий массовой записи на 10k-500k строк.
+
+Долгий тест с меткой benchmark, по умолчанию пропускается. Запуск:
+    python -m pytest --benchmark core/tests/test_bulk_benchmark.py -s
+Размеры можно задать через BULK_WRITE_BENCHMARK_ROWS=10000,100000
+"""
+import os
+import time
+
+import pytest
+
+from analyticalplatform.integrations import (batch_size_for,
+                                             bulk_update_from_temp_table)
+from core.enums import MarketplaceChoices
+from core.models import Product
+from core.tests.test_integrations import get_or_create_test_account
+
+BENCHMARK_ROWS = [
+    int(rows) for rows in os.environ.get("BULK_WRITE_BENCHMARK_ROWS", "10000,100000,500000").split(",")
+]
+UPDATE_FIELDS = ["name", "brand", "vendor", "sku"]
+
+pytestmark = pytest.mark.benchmark
+
+
+def measure(function):
+    started = time.monotonic()
+    function()
+    return time.monotonic() - started
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("rows", BENCHMARK_ROWS)
+def test_bulk_write_strategies(rows, django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    account, created = get_or_create_test_account(user, MarketplaceChoices.MOY_SKLAD)
+
+    def new_products():
+        return [Product(account=account, sku=str(i), barcode=str(i), name=str(i), vendor=str(i))
+                for i in range(rows)]
+
+    results = {
+        "bulk_create, пачка 100": measure(lambda: Product.objects.bulk_create(new_products(), batch_size=100)),
+    }
+    Product.objects.all().delete()
+    results["bulk_create, пачка по ширине строки"] = measure(lambda: Product.objects.bulk_create(
+        new_products(), batch_size=batch_size_for(len(Product._meta.concrete_fields))))
+
+    products = list(Product.objects.all())
+    for strategy, update in (
+        ("bulk_update, пачка 100", lambda: Product.objects.bulk_update(products, UPDATE_FIELDS, batch_size=100)),
+        ("bulk_update, пачка 1000", lambda: Product.objects.bulk_update(products, UPDATE_FIELDS, batch_size=1000)),
+        ("временная таблица + UPDATE ... FROM",
+         lambda: bulk_update_from_temp_table(Product, products, UPDATE_FIELDS)),
+    ):
+        for product in products:
+            product.name = f"{strategy} {product.id}"
+        results[strategy] = measure(update)
+
+    assert Product.objects.filter(name__startswith="временная таблица").count() == rows
+    print(f"\n{rows} строк, {len(UPDATE_FIELDS)} поля в обновлении:")
+    for strategy, seconds in results.items():
+        print(f"    {strategy:<40} {seconds:8.2f} с {rows / seconds:10.0f} строк/с")
@@ -6,6 +6,9 @@ import pytest
 from django.db import transaction
 from rest_framework.test import APIClient
 
+from analyticalplatform.integrations import (BATCH_PARAMS, MAX_QUERY_PARAMS,
+                                             TEMP_TABLE_UPDATE_CELLS,
+                                             batch_size_for, bulk_update_objects)
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform, Product
 
@@ -265,3 +268,87 @@ def test_connections_creation(
 
     assert product_changed_dynamic.connection is not None
     assert old_product_wildberries_2_connection == product_changed_manual.connection.id
+
+
+@pytest.mark.django_db
+def test_products_refresh_touches_only_changed_rows(
+        django_user_model,
+        test_user_name,
+        test_user_password
+):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+
+    moy_sklad_account, created = get_or_create_test_account(user, MarketplaceChoices.MOY_SKLAD)
+    moy_sklad_processor = moy_sklad_account.get_platform_processor()
+    moy_sklad_processor.get_products = get_test_products_1
+
+    get_or_create_test_product(moy_sklad_account, barcode="1")
+    get_or_create_test_product(moy_sklad_account, barcode="3")
+
+    # удален "3", обновлен "1", создан "2"
+    assert moy_sklad_processor.refresh_products() == 3
+    assert moy_sklad_processor.refresh_products() == 0
+    assert sorted(moy_sklad_account.products.values_list("barcode", flat=True)) == ["1", "2"]
+
+
+@pytest.mark.django_db
+def test_products_parse_workflow_fans_out_per_user(
+        django_user_model,
+        test_user_name,
+        test_user_password
+):
+    from core.tasks import products_parse_workflow
+
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    other_user = django_user_model.objects.create_user(email="other@test.test", password=test_user_password)
+    moy_sklad_account, created = get_or_create_test_account(user, MarketplaceChoices.MOY_SKLAD)
+    wildberries_account, created = get_or_create_test_account(user, MarketplaceChoices.WILDBERRIES)
+    other_account, created = get_or_create_test_account(other_user, MarketplaceChoices.WILDBERRIES)
+
+    workflow = products_parse_workflow(Account.objects.order_by("user_id", "id"))
+
+    user_chord, other_user_chord = workflow.tasks
+    assert [task.args for task in user_chord.tasks] == [(moy_sklad_account.id,), (wildberries_account.id,)]
+    assert [task.args for task in other_user_chord.tasks] == [(other_account.id,)]
+    connections_task, orders_group = user_chord.body.tasks
+    assert connections_task.args == (user.id,)
+    assert [task.args for task in orders_group.tasks] == [(moy_sklad_account.id,), (wildberries_account.id,)]
+
+
+def test_batch_size_for_fits_query_params():
+    assert batch_size_for(5) == BATCH_PARAMS // 5
+    assert batch_size_for(5, max_params=10 ** 6) == MAX_QUERY_PARAMS // 5
+    assert batch_size_for(10 ** 6) == 1
+
+
+@pytest.mark.django_db
+def test_bulk_update_objects_uses_temp_table_for_large_updates(
+        django_user_model,
+        test_user_name,
+        test_user_password,
+        django_assert_max_num_queries
+):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    account, created = get_or_create_test_account(user, MarketplaceChoices.MOY_SKLAD)
+    products = Product.objects.bulk_create([
+        Product(account=account, sku=str(i), barcode=str(i), name=f"Товар {i}", vendor=str(i))
+        for i in range(1000)
+    ])
+    for product in products:
+        product.name = f"Новый {product.sku}"
+        product.brand = "Бренд"
+
+    # DROP, CREATE, INSERT пачки, UPDATE ... FROM, DROP и точки сохранения транзакции
+    with django_assert_max_num_queries(8):
+        updated = bulk_update_objects(Product, products, ["name", "brand"])
+    assert len(products) * 2 >= TEMP_TABLE_UPDATE_CELLS
+
+    assert updated == len(products)
+    assert Product.objects.filter(brand="Бренд").count() == len(products)
+    assert Product.objects.get(id=products[10].id).name == f"Новый {products[10].sku}"
+
+    # Небольшое обновление идет через bulk_update
+    products[0].name = "Один"
+    with django_assert_max_num_queries(1):
+        assert bulk_update_objects(Product, products[:1], ["name"]) == 1
+    assert Product.objects.get(id=products[0].id).name == "Один"
@@ -0,0 +1,267 @@
+import logging
+import threading
+import time
+
+import pytest
+from redis.lock import Lock
+
+from core import utils
+
+
+class FakeRedis:
+    """
+    Redis в памяти с командами, которые используют skip_if_running и concurrency_slot.
+    Время можно сдвинуть вперед через shift, чтобы ключи истекли
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.sorted_sets = {}
+        self.shift = 0
+
+    def now(self):
+        return time.monotonic() + self.shift
+
+    def get(self, key):
+        value, expires = self.values.get(key, (None, None))
+        if expires is not None and expires <= self.now():
+            self.values.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and self.get(key) is not None:
+            return None
+        if px:
+            ex = px / 1000
+        self.values[key] = (value, self.now() + ex if ex else None)
+        return True
+
+    def getdel(self, key):
+        value = self.get(key)
+        self.values.pop(key, None)
+        return value
+
+    def delete(self, key):
+        return int(self.values.pop(key, None) is not None)
+
+    def lock(self, name, timeout=None, thread_local=True):
+        return Lock(self, name, timeout=timeout, thread_local=thread_local)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def zremrangebyscore(self, key, minimum, maximum):
+        members = self.sorted_sets.setdefault(key, {})
+        for member, score in list(members.items()):
+            if float(minimum) <= score <= float(maximum):
+                del members[member]
+
+    def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    def zrank(self, key, member):
+        members = self.sorted_sets.get(key, {})
+        if member not in members:
+            return None
+        return sorted(members, key=lambda name: (members[name], name)).index(member)
+
+    def zrem(self, key, member):
+        return int(self.sorted_sets.get(key, {}).pop(member, None) is not None)
+
+    def expire(self, key, ttl):
+        return True
+
+
+class FakeScript:
+    """
+    Lua-скрипт блокировки redis-py, выполняемый над FakeRedis.
+    Сама блокировка - настоящий redis.lock.Lock, поэтому хранение токена
+    (thread_local) работает так же, как с Redis
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, keys, args, client):
+        return self.function(client, keys[0], *args)
+
+
+def lua_release(client, name, token):
+    if client.get(name) != token:
+        return 0
+    return client.delete(name)
+
+
+def lua_extend(client, name, token, milliseconds, replace_ttl):
+    if client.get(name) != token:
+        return 0
+    return client.set(name, token, px=milliseconds)
+
+
+def lua_reacquire(client, name, token, milliseconds):
+    return lua_extend(client, name, token, milliseconds, '1')
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakeTask:
+    def __init__(self):
+        self.apply_async_calls = []
+
+    def apply_async(self, args=None, kwargs=None):
+        self.apply_async_calls.append((args, kwargs))
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    connection = FakeRedis()
+    monkeypatch.setattr(Lock, 'lua_release', FakeScript(lua_release))
+    monkeypatch.setattr(Lock, 'lua_extend', FakeScript(lua_extend))
+    monkeypatch.setattr(Lock, 'lua_reacquire', FakeScript(lua_reacquire))
+    monkeypatch.setattr(utils, 'get_redis_connection', lambda: connection)
+    return connection
+
+
+def test_skip_if_running_skips_same_arguments_and_runs_other(fake_redis):
+    calls = []
+
+    @utils.skip_if_running
+    def sync(self, account_id):
+        calls.append(account_id)
+        if account_id == 1:
+            # Пока первая задача работает, запускаются такая же и с другим аргументом
+            assert sync(task, 1) is None
+            assert sync(task, 2) == 2
+        return account_id
+
+    task = FakeTask()
+    assert sync(task, 1) == 1
+    assert calls == [1, 2]
+    # После завершения блокировка снята, задачу можно запустить снова
+    assert sync(task, 2) == 2
+    assert task.apply_async_calls == []
+
+
+def test_skip_if_running_coalesce_reruns_once_after_finish(fake_redis):
+    task = FakeTask()
+
+    @utils.skip_if_running(coalesce=True)
+    def sync(self, account_id):
+        assert task.apply_async_calls == []
+        sync(task, account_id)
+        sync(task, account_id)
+        return account_id
+
+    assert sync(task, 7) == 7
+    assert task.apply_async_calls == [((7,), {})]
+
+
+def test_skip_if_running_logs_lock_expired_before_release(fake_redis, caplog):
+    @utils.skip_if_running(ttl=5)
+    def sync(self, account_id):
+        # Задача работала дольше ttl, и heartbeat не успел продлить блокировку
+        fake_redis.shift += 6
+        return account_id
+
+    with caplog.at_level(logging.WARNING):
+        assert sync(FakeTask(), 3) == 3
+
+    assert 'lock expired before release' in caplog.text
+
+
+def test_task_lock_key_depends_on_arguments():
+    key = utils.task_lock_key('core.tasks.sync', (1,), {'full': True})
+
+    assert key == utils.task_lock_key('core.tasks.sync', (1,), {'full': True})
+    assert key != utils.task_lock_key('core.tasks.sync', (2,), {'full': True})
+    assert key != utils.task_lock_key('core.tasks.sync', (1,), {'full': False})
+    assert key != utils.task_lock_key('core.tasks.other', (1,), {'full': True})
+
+
+def test_skip_if_running_keeps_lock_longer_than_ttl_while_running(fake_redis):
+    task = FakeTask()
+    calls = []
+
+    @utils.skip_if_running(ttl=0.3)
+    def sync(self, account_id):
+        calls.append(account_id)
+        if len(calls) == 1:
+            # Задача работает дольше ttl, heartbeat из другого потока продлевает блокировку
+            time.sleep(0.8)
+            sync(task, account_id)
+        return account_id
+
+    assert sync(task, 1) == 1
+    assert calls == [1]
+
+
+def test_extend_lock_stops_on_any_error(fake_redis, caplog):
+    # Токен в thread-local не виден потоку heartbeat, extend падает с AttributeError
+    lock = fake_redis.lock('task_lock:thread_local', timeout=0.3)
+    assert lock.acquire(blocking=False)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=utils.extend_lock, args=(lock, 0.3, stop), daemon=True)
+
+    with caplog.at_level(logging.WARNING):
+        heartbeat.start()
+        heartbeat.join(timeout=1)
+
+    assert not heartbeat.is_alive()
+    assert 'is no longer extended' in caplog.text
+
+
+def test_lock_expires_after_ttl_when_heartbeat_stops(fake_redis):
+    ttl = 0.3
+    lock = fake_redis.lock('task_lock:heartbeat', timeout=ttl, thread_local=False)
+    assert lock.acquire(blocking=False)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=utils.extend_lock, args=(lock, ttl, stop), daemon=True)
+    heartbeat.start()
+
+    # Пока heartbeat работает, блокировка живет дольше ttl
+    time.sleep(ttl * 2)
+    assert not fake_redis.lock('task_lock:heartbeat', timeout=ttl).acquire(blocking=False)
+
+    stop.set()
+    heartbeat.join()
+    time.sleep(ttl * 1.5)
+    assert fake_redis.lock('task_lock:heartbeat', timeout=ttl).acquire(blocking=False)
+
+
+def test_concurrency_slot_limits_owners(fake_redis):
+    with utils.concurrency_slot('sync:wb', 2) as first, utils.concurrency_slot('sync:wb', 2) as second:
+        with utils.concurrency_slot('sync:wb', 2) as third:
+            assert (first, second, third) == (True, True, False)
+        with utils.concurrency_slot('sync:ozon', 2) as other:
+            assert other
+    # Места освобождаются при выходе
+    with utils.concurrency_slot('sync:wb', 1) as acquired:
+        assert acquired
+    assert fake_redis.sorted_sets['concurrency_slot:sync:wb'] == {}
+
+
+def test_concurrency_slot_frees_places_of_dead_owners_after_ttl(fake_redis, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, 'time', lambda: now[0])
+    # Владелец упал и не освободил место
+    fake_redis.zadd('concurrency_slot:sync:wb', {'dead-owner': now[0] - 1})
+
+    with utils.concurrency_slot('sync:wb', 1, ttl=60) as acquired:
+        assert not acquired
+
+    now[0] += 60
+    with utils.concurrency_slot('sync:wb', 1, ttl=60) as acquired:
+        assert acquired
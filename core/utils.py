@@ -1,6 +1,33 @@
+import hashlib
+import json
 import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from functools import wraps
 
+import redis
+from django.conf import settings
+from redis.exceptions import LockError
+
+from core.enums import MarketplaceChoices
+
+logger = logging.getLogger(__name__)
+
+# Сколько аккаунтов одной платформы синхронизируется одновременно
+PLATFORM_CONCURRENCY_LIMITS = {
+    MarketplaceChoices.WILDBERRIES: 3,
+    MarketplaceChoices.YANDEX_MARKET: 2,
+    MarketplaceChoices.MEGA_MARKET: 2,
+    MarketplaceChoices.OZON: 3,
+    MarketplaceChoices.MOY_SKLAD: 2,
+}
+PLATFORM_SLOT_RETRY_COUNTDOWN = 10
+PLATFORM_SLOT_MAX_RETRIES = 18
+# Время жизни блокировки skip_if_running без продления, секунд
+TASK_LOCK_TTL = 10 * 60
+
 
 def sort_products_key(sort_by, product: dict) -> str:
     if "market" in sort_by:
@@ -15,25 +42,144 @@ def sort_products_key(sort_by, product: dict) -> str:
     return product["moy_sklad"]["name"]
 
 
-def skip_if_running(func):
+def skip_if_running(func=None, *, ttl=TASK_LOCK_TTL, coalesce=False):
+    """
+    Пропускает запуск задачи, если такая же задача (имя и аргументы) уже выполняется.
+
+    Вместо опроса воркеров через inspect() берется lease-блокировка в Redis
+    брокера. Блокировка живет ttl секунд и продлевается фоновым heartbeat,
+    пока задача работает, поэтому после падения воркера она освобождается сама.
+    coalesce=True - пропущенный запуск не теряется: задача будет запущена
+    еще раз после завершения текущей.
+
+    Используется как @skip_if_running или @skip_if_running(ttl=..., coalesce=True)
+    """
+    if func is None:
+        return lambda task_func: skip_if_running(task_func, ttl=ttl, coalesce=coalesce)
+
     task_name = f"{func.__module__}.{func.__name__}"
 
     @wraps(func)
     def wrapped(self, *args, **kwargs):
-        workers = self.app.control.inspect().active()
+        connection = get_redis_connection()
+        lock_key = task_lock_key(task_name, args, kwargs)
+        rerun_key = f"{lock_key}:rerun"
+        # Токен блокировки не в thread-local: его продлевает поток heartbeat
+        lock = connection.lock(lock_key, timeout=ttl, thread_local=False)
 
-        for worker, tasks in workers.items():
-            for task in tasks:
-                if (
-                    task_name == task["name"]
-                    and tuple(args) == tuple(task["args"])
-                    and kwargs == task["kwargs"]
-                    and self.request.id != task["id"]
-                ):
-                    logging.warning(f"task {task_name} ({args}, {kwargs}) is running on {worker}, skipping")
+        if not lock.acquire(blocking=False):
+            if coalesce:
+                connection.set(rerun_key, 1, ex=ttl)
+            logging.warning(f"task {task_name} ({args}, {kwargs}) is running, skipping")
 
-                    return None
+            return None
 
-        return func(self, *args, **kwargs)
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=extend_lock, args=(lock, ttl, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            try:
+                lock.release()
+            except LockError:
+                logging.warning(f"task {task_name} ({args}, {kwargs}) lock expired before release")
+            if coalesce and connection.getdel(rerun_key):
+                self.apply_async(args=args, kwargs=kwargs)
 
     return wrapped
+
+
+def task_lock_key(task_name, args, kwargs):
+    """Ключ блокировки задачи с данными аргументами"""
+    arguments = json.dumps([args, kwargs], sort_keys=True, default=str)
+    return f"task_lock:{task_name}:{hashlib.sha1(arguments.encode()).hexdigest()}"
+
+
+def extend_lock(lock, ttl, stop_event):
+    """
+    Продлевает блокировку на ttl каждые ttl / 3 секунд, пока не выставлен stop_event.
+    При любой ошибке продление прекращается, блокировка истечет через ttl
+    """
+    while not stop_event.wait(ttl / 3):
+        try:
+            lock.extend(ttl, replace_ttl=True)
+        except Exception as e:
+            logger.warning(f"lock {lock.name} is no longer extended: {e!r}")
+            return
+
+
+def get_redis_connection():
+    """Подключение к Redis брокера Celery"""
+    return redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+
+@contextmanager
+def concurrency_slot(name, limit, ttl=60 * 60):
+    """
+    Семафор в Redis на limit одновременных владельцев.
+
+    Отдает True, если место получено, иначе False. Места упавших процессов
+    освобождаются через ttl секунд.
+    """
+    connection = get_redis_connection()
+    key = f"concurrency_slot:{name}"
+    token = uuid.uuid4().hex
+    now = time.time()
+
+    pipeline = connection.pipeline()
+    pipeline.zremrangebyscore(key, "-inf", now - ttl)
+    pipeline.zadd(key, {token: now})
+    pipeline.zrank(key, token)
+    pipeline.expire(key, ttl)
+    rank = pipeline.execute()[2]
+
+    acquired = rank is not None and rank < limit
+    if not acquired:
+        connection.zrem(key, token)
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            connection.zrem(key, token)
+
+
+def run_account_sync(task, account_id, sync_name, sync):
+    """
+    Выполняет sync(account) с ограничением числа одновременных задач платформы.
+
+    Если свободного места нет, задача повторяется позже. Длительность
+    синхронизации каждого аккаунта пишется в лог.
+    """
+    from core.models import Account
+
+    account = Account.objects.select_related("platform").filter(id=account_id).first()
+    if not account:
+        return None
+
+    platform_type = account.platform.platform_type
+    with concurrency_slot(
+        f"{sync_name}:{platform_type}", PLATFORM_CONCURRENCY_LIMITS.get(platform_type, 1)
+    ) as acquired:
+        if not acquired:
+            if task.request.retries >= PLATFORM_SLOT_MAX_RETRIES:
+                logger.warning(f"{sync_name}: no free slot for account {account_id}, skipping")
+                return None
+            raise task.retry(countdown=PLATFORM_SLOT_RETRY_COUNTDOWN, max_retries=PLATFORM_SLOT_MAX_RETRIES)
+
+        started = time.monotonic()
+        try:
+            touched = sync(account)
+        except Exception:
+            logger.exception(f"{sync_name}: account {account_id} failed")
+            return None
+        finally:
+            logger.info(
+                f"{sync_name}: account={account_id} platform={platform_type} "
+                f"duration={time.monotonic() - started:.2f}s"
+            )
+
+    return touched
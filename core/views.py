@@ -216,11 +216,15 @@ class ExportReportAPIView(views.APIView):
         index = marketplace_products.count()
         analogues = []
 
+        barcode_analogues = {}
+        for analogue in Product.objects.filter(
+            account__platform__platform_type=MarketplaceChoices.MOY_SKLAD,
+            barcode__in={item.barcode for item in marketplace_products},
+        ).order_by("-id"):
+            barcode_analogues[analogue.barcode] = analogue
+
         for idx, item in enumerate(marketplace_products):
-            analogue = Product.objects.filter(
-                account__platform__platform_type=MarketplaceChoices.MOY_SKLAD,
-                barcode=item.barcode,
-            ).first()
+            analogue = barcode_analogues.get(item.barcode)
 
             if analogue:
                 analogues.append(analogue.id)
@@ -19,101 +19,139 @@ class BaseOrdersIntegration(BaseIntegration):
             OrderItem: ["price", "quantity", "sticker"],
         }
 
-    @transaction.atomic
-    def refresh_orders(self):
+    def refresh_orders(self) -> int:
+        """
+        Сверяет заказы аккаунта с заказами платформы.
+
+        Запрос к API, чтение БД и поиск изменений выполняются вне транзакции:
+        заказы, статусы, товары и позиции раскладываются в словари по номеру
+        заказа, коду статуса и sku. В транзакции только записываются удаленные,
+        новые и действительно изменившиеся заказы и позиции.
+        Возвращает количество записанных строк
+        """
         from core.models import Product
         from stock.models import Order, OrderItem, Status
 
-        orders = self.get_orders()
-        account_order_numbers = [order["number"] for order in orders]
+        orders = {order["number"]: order for order in self.get_orders()}
+        statuses = {status.status_code: status for status in Status.objects.all()}
+        order_fields = self.get_object_available_fields()[Order]
+        order_item_fields = self.get_object_available_fields()[OrderItem]
 
-        account_orders = self.get_account_orders()
-        account_orders.exclude(number__in=account_order_numbers).delete()
+        account_orders = {}
+        delete_order_ids = []
+        for order_obj in self.get_account_orders():
+            if order_obj.number in orders:
+                account_orders.setdefault(order_obj.number, order_obj)
+            else:
+                delete_order_ids.append(order_obj.id)
+
+        products = {
+            product.sku: product
+            for product in Product.objects.filter(
+                sku__in={str(item["sku"]) for order in orders.values() for item in order["products"]},
+                account=self.account,
+            )
+        }
+        db_orders_items = {}
+        for db_order_item in OrderItem.objects.filter(
+            order__in=[order_obj.id for order_obj in account_orders.values()]
+        ).select_related("product"):
+            db_orders_items.setdefault((db_order_item.order_id, db_order_item.product.sku), db_order_item)
 
         bulk_update_orders = []
         bulk_create_orders = []
 
         bulk_update_order_items = []
-        bulk_create_order_items = []
+        new_order_items = []
 
-        product_skus = []
-        statuses = Status.objects.all()
-
-        for order in orders:
-            product_skus.extend(product["sku"] for product in order["products"])
-            order_obj = next((item for item in account_orders if item.number == order["number"]), None)
+        for number, order in orders.items():
+            order_obj = account_orders.get(number)
 
             if order_obj:
-                for key in order:
-                    if key == "products":
+                changed = False
+                for key in order_fields:
+                    if key not in order:
                         continue
 
                     if key == "status":
-                        status_obj = next(
-                            (status for status in statuses if status.status_code == order["status"]), None
-                        )
-                        setattr(order_obj, key, status_obj)
+                        status_obj = statuses.get(order["status"])
+                        if order_obj.status_id != getattr(status_obj, "id", None):
+                            order_obj.status = status_obj
+                            changed = True
                         continue
 
-                    if hasattr(order_obj, key):
-                        setattr(order_obj, key, order[key])
+                    value = Order._meta.get_field(key).to_python(order[key])
+                    if getattr(order_obj, key) != value:
+                        setattr(order_obj, key, value)
+                        changed = True
 
-                bulk_update_orders.append(order_obj)
+                if changed:
+                    bulk_update_orders.append(order_obj)
 
             else:
-                status_obj = next((status for status in statuses if status.status_code == order["status"]), None)
-                bulk_create_orders.append(
-                    Order(
-                        account=self.account,
-                        total_price=order["total_price"],
-                        status=status_obj,
-                        number=order["number"],
-                        shipped_dt=order["shipped_dt"],
-                        created_dt=order["created_dt"],
-                    )
+                order_obj = Order(
+                    account=self.account,
+                    total_price=order["total_price"],
+                    status=statuses.get(order["status"]),
+                    number=order["number"],
+                    shipped_dt=order["shipped_dt"],
+                    created_dt=order["created_dt"],
                 )
-
-        self.create_new_objects(Order, bulk_create_orders)
-        self.update_existing_objects(Order, bulk_update_orders)
-
-        db_orders = Order.objects.filter(number__in=account_order_numbers).values_list("number", "id")
-        db_products = Product.objects.filter(sku__in=product_skus, account=self.account)
-        db_orders_items = OrderItem.objects.filter(order__in=[item[1] for item in db_orders])
-
-        for order in orders:
-            order_id = next(filter(lambda x: x[0] == order["number"], db_orders), None)[1]
+                bulk_create_orders.append(order_obj)
 
             for order_item in order["products"]:
-                db_order_item = next((item for item in db_orders_items if item.product.sku == order_item["sku"]), None)
+                db_order_item = db_orders_items.get((order_obj.id, str(order_item["sku"])))
 
                 if db_order_item:
-                    for key in order_item:
-                        if key == "sku":
+                    changed = False
+                    for key in order_item_fields:
+                        if key not in order_item:
                             continue
 
-                        if hasattr(db_order_item, key):
-                            setattr(db_order_item, key, order_item[key])
+                        value = OrderItem._meta.get_field(key).to_python(order_item[key])
+                        if getattr(db_order_item, key) != value:
+                            setattr(db_order_item, key, value)
+                            changed = True
 
-                    bulk_update_order_items.append(db_order_item)
+                    if changed:
+                        bulk_update_order_items.append(db_order_item)
 
                 else:
-                    db_product = next(filter(lambda x: x.sku == order_item["sku"], db_products), None)
+                    db_product = products.get(str(order_item["sku"]))
 
                     if not db_product:
                         continue
 
-                    bulk_create_order_items.append(
-                        OrderItem(
-                            order_id=order_id,
-                            product=db_product,
-                            quantity=order_item["quantity"],
-                            price=order_item["price"],
-                            sticker=order_item.get("sticker", ""),
-                        )
-                    )
+                    new_order_items.append((order_obj, db_product, order_item))
+
+        with transaction.atomic():
+            if delete_order_ids:
+                Order.objects.filter(id__in=delete_order_ids).delete()
+
+            self.create_new_objects(Order, bulk_create_orders)
+            self.update_existing_objects(Order, bulk_update_orders)
 
-        self.create_new_objects(OrderItem, bulk_create_order_items)
-        self.update_existing_objects(OrderItem, bulk_update_order_items)
+            # id новых заказов известны только после bulk_create
+            bulk_create_order_items = [
+                OrderItem(
+                    order_id=order_obj.id,
+                    product=db_product,
+                    quantity=order_item["quantity"],
+                    price=order_item["price"],
+                    sticker=order_item.get("sticker", ""),
+                )
+                for order_obj, db_product, order_item in new_order_items
+            ]
+            self.create_new_objects(OrderItem, bulk_create_order_items)
+            self.update_existing_objects(OrderItem, bulk_update_order_items)
+
+        return (
+            len(delete_order_ids)
+            + len(bulk_create_orders)
+            + len(bulk_update_orders)
+            + len(bulk_create_order_items)
+            + len(bulk_update_order_items)
+        )
 
     def get_account_orders(self):
         return self.account.orders.all()
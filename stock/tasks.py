@@ -1,12 +1,22 @@
+from celery import group
+
 from analyticalplatform.celery import app
 from core.models import Account
-from core.utils import skip_if_running
+from core.utils import run_account_sync, skip_if_running
+
+
+@app.task(bind=True)
+@skip_if_running
+def refresh_account_orders(self, account_id):
+    """Обновляет заказы одного аккаунта"""
+    return run_account_sync(
+        self, account_id, "refresh_orders", lambda account: account.get_platform_orders_processor().refresh_orders()
+    )
 
 
 @app.task(bind=True)
 @skip_if_running
 def periodic_orders_parse(*_):
-    accounts = Account.objects.all()
+    account_ids = Account.objects.values_list("id", flat=True)
 
-    for account in accounts:
-        account.get_platform_orders_processor().refresh_orders()
+    group(refresh_account_orders.si(account_id) for account_id in account_ids).apply_async()
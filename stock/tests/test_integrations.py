@@ -0,0 +1,70 @@
+import pytest
+
+from core.enums import MarketplaceChoices
+from core.models import Product
+from core.tests.test_integrations import get_or_create_test_account
+from stock.models import Order, OrderItem, Status
+
+
+def get_test_orders():
+    return [
+        {
+            "number": "1",
+            "status": 1,
+            "total_price": 150.5,
+            "created_dt": "2024-09-01",
+            "shipped_dt": None,
+            "products": [
+                {"sku": "SKU 1", "quantity": 1, "price": 100.5},
+                {"sku": "SKU 2", "quantity": 2, "price": 25},
+            ],
+        },
+        {
+            "number": "2",
+            "status": 1,
+            "total_price": 100.5,
+            "created_dt": "2024-09-02",
+            "shipped_dt": None,
+            "products": [{"sku": "SKU 1", "quantity": 1, "price": 100.5}],
+        },
+    ]
+
+
+@pytest.mark.django_db
+def test_orders_refresh_writes_only_changed_rows(
+        django_user_model,
+        test_user_name,
+        test_user_password,
+        django_assert_max_num_queries,
+):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    account, created = get_or_create_test_account(user, MarketplaceChoices.WILDBERRIES)
+    for status_code in (1, 2):
+        Status.objects.create(
+            name=f"Status {status_code}", color="#000000", status_code=status_code,
+            position=status_code, my_stock_status_name=f"Status {status_code}",
+        )
+    for sku in ("SKU 1", "SKU 2"):
+        Product.objects.create(account=account, sku=sku, barcode=sku, name=sku, vendor=sku)
+    stale_order = Order.objects.create(
+        account=account, status=Status.objects.get(status_code=1), number="3",
+        created_dt="2024-08-01", total_price=10,
+    )
+
+    orders = get_test_orders()
+    processor = account.get_platform_orders_processor()
+    processor.get_orders = lambda: orders
+
+    # удален заказ "3", созданы 2 заказа и 3 позиции
+    assert processor.refresh_orders() == 6
+    assert not Order.objects.filter(id=stale_order.id).exists()
+    assert OrderItem.objects.filter(order__account=account).count() == 3
+
+    with django_assert_max_num_queries(6):
+        assert processor.refresh_orders() == 0
+
+    orders[0]["status"] = 2
+    orders[1]["products"][0]["quantity"] = 3
+    assert processor.refresh_orders() == 2
+    assert Order.objects.get(account=account, number="1").status.status_code == 2
+    assert OrderItem.objects.get(order__number="2").quantity == 3
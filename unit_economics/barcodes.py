@@ -0,0 +1,123 @@
+from unit_economics.models import (MarketplaceProduct,
+                                   MarketplaceProductBarcode, ProductBarcode,
+                                   ProductPrice)
+
+BARCODE_BATCH_SIZE = 1000
+
+
+def normalize_barcodes(value):
+    """
+    Приводит значение JSON поля barcode к множеству строк.
+    В поле может лежать список баркодов или один баркод
+    """
+    if value is None or value == '':
+        return set()
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return {str(barcode) for barcode in value if barcode is not None and barcode != ''}
+
+
+def _sync_barcodes(model, owner_field, owner_barcodes, created=False):
+    """
+    Приводит строки таблицы баркодов к значениям owner_barcodes.
+
+    Входящие данные:
+        model - ProductBarcode или MarketplaceProductBarcode
+        owner_field - имя внешнего ключа на владельца баркода
+        owner_barcodes - словарь {owner_id: значение JSON поля barcode}
+        created - владельцы только что созданы, сохраненных баркодов у них нет
+
+    Возвращает количество добавленных и удаленных строк
+    """
+    if not owner_barcodes:
+        return 0
+    fresh_barcodes = {
+        (owner_id, barcode)
+        for owner_id, value in owner_barcodes.items()
+        for barcode in normalize_barcodes(value)
+    }
+    saved_barcodes = {} if created else {
+        (owner_id, barcode): barcode_id
+        for barcode_id, owner_id, barcode in model.objects.filter(
+            **{f'{owner_field}_id__in': list(owner_barcodes)}).values_list(
+            'id', f'{owner_field}_id', 'barcode')
+    }
+    stale_ids = [barcode_id for key, barcode_id in saved_barcodes.items() if key not in fresh_barcodes]
+    if stale_ids:
+        model.objects.filter(id__in=stale_ids).delete()
+    new_objects = [
+        model(**{f'{owner_field}_id': owner_id, 'barcode': barcode})
+        for owner_id, barcode in fresh_barcodes if (owner_id, barcode) not in saved_barcodes
+    ]
+    model.objects.bulk_create(new_objects, batch_size=BARCODE_BATCH_SIZE, ignore_conflicts=True)
+    return len(new_objects) + len(stale_ids)
+
+
+def sync_product_barcodes(product_barcodes, created=False):
+    """Синхронизирует ProductBarcode. product_barcodes - {product_id: ProductPrice.barcode}"""
+    return _sync_barcodes(ProductBarcode, 'product', product_barcodes, created)
+
+
+def sync_marketplace_product_barcodes(mp_product_barcodes, created=False):
+    """Синхронизирует MarketplaceProductBarcode. mp_product_barcodes - {mp_product_id: MarketplaceProduct.barcode}"""
+    return _sync_barcodes(MarketplaceProductBarcode, 'mp_product', mp_product_barcodes, created)
+
+
+def rebuild_barcode_tables():
+    """Полностью перестраивает таблицы баркодов по JSON полям (первичное заполнение)"""
+    changed_count = 0
+    for model, sync_barcodes in ((ProductPrice, sync_product_barcodes),
+                                 (MarketplaceProduct, sync_marketplace_product_barcodes)):
+        owner_ids = list(model.objects.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(owner_ids), BARCODE_BATCH_SIZE):
+            changed_count += sync_barcodes(dict(model.objects.filter(
+                id__in=owner_ids[start:start + BARCODE_BATCH_SIZE]).values_list('id', 'barcode')))
+    return changed_count
+
+
+def fill_empty_barcode_tables():
+    """
+    Первичное заполнение таблиц баркодов после миграций.
+
+    Сопоставление карточек маркетплейсов читает только ProductBarcode,
+    поэтому пустая таблица при уже загруженных продуктах означает, что
+    новые товары маркетплейсов не создаются. Таблицы перестраиваются,
+    только если одна из них пуста, а ее продукты уже есть.
+    Возвращает количество добавленных и удаленных строк
+    """
+    products_without_barcodes = (ProductPrice.objects.exists()
+                                 and not ProductBarcode.objects.exists())
+    mp_products_without_barcodes = (MarketplaceProduct.objects.exists()
+                                    and not MarketplaceProductBarcode.objects.exists())
+    if not (products_without_barcodes or mp_products_without_barcodes):
+        return 0
+    return rebuild_barcode_tables()
+
+
+def product_ids_by_barcode(barcodes, account=None):
+    """
+    Находит продукты Мой Склад по баркодам одним запросом по индексу.
+
+    Входящие данные:
+        barcodes - список баркодов
+        account - аккаунт Мой Склад, которым ограничивается поиск
+
+    Возвращает словарь {barcode: [product_id, ...]}
+    """
+    queryset = ProductBarcode.objects.filter(barcode__in={str(barcode) for barcode in barcodes})
+    if account is not None:
+        queryset = queryset.filter(product__account=account)
+    result = {}
+    for barcode, product_id in queryset.order_by('product_id').values_list('barcode', 'product_id'):
+        result.setdefault(barcode, []).append(product_id)
+    return result
+
+
+def products_with_barcode(barcode):
+    """Продукты Мой Склад, у которых есть баркод barcode"""
+    return ProductPrice.objects.filter(product_barcodes__barcode=str(barcode)).distinct()
+
+
+def marketplace_products_with_barcode(barcode):
+    """Продукты маркетплейсов, у которых есть баркод barcode"""
+    return MarketplaceProduct.objects.filter(mp_product_barcodes__barcode=str(barcode)).distinct()
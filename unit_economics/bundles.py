@@ -0,0 +1,105 @@
+import logging
+
+from api_requests import client, fetch
+from api_requests.moy_sklad import moy_sklad_bundle_components, moy_sklad_product_info
+
+logger = logging.getLogger(__name__)
+
+# Сколько запросов компонентов и товаров Моего Склада выполняется одновременно:
+# общее ограничение токена из api_requests.client
+BUNDLE_FETCH_CONCURRENCY = client.CONCURRENCY_LIMITS[client.MOY_SKLAD]
+
+
+def moy_sklad_id_from_href(href):
+    """Возвращает id сущности Моего Склада из ссылки meta.href"""
+    return href.split('?')[0].rstrip('/').split('/')[-1]
+
+
+class BundleCostResolver:
+    """
+    Считает закупочную стоимость комплектов Моего Склада.
+
+    Закупочные цены товаров запоминаются по мере чтения ассортимента,
+    поэтому компоненты комплектов берутся из уже скачанных данных.
+    Отдельно запрашиваются только недостающие товары, параллельно.
+    Стоимость считается в копейках, как buyPrice в API.
+    """
+
+    def __init__(self, token, concurrency=BUNDLE_FETCH_CONCURRENCY):
+        self.token = token
+        self.concurrency = concurrency
+        self.buy_prices = {}
+        self.bundle_components = {}
+
+    def add_assortment_item(self, item):
+        """Запоминает закупочную цену товара из ответа ассортимента"""
+        if item['meta']['type'] == 'product':
+            self.buy_prices[item['id']] = item.get('buyPrice', {}).get('value', 0)
+
+    def _fetch_missing_prices(self, hrefs):
+        """Запрашивает товары, которых не было в ассортименте. Возвращает id неполученных"""
+        hrefs = list(hrefs)
+        failed = set()
+        results = fetch.run_parallel(
+            moy_sklad_product_info, [(self.token, href) for href in hrefs], self.concurrency)
+        for href, data in zip(hrefs, results):
+            product_id = moy_sklad_id_from_href(href)
+            if data is None:
+                failed.add(product_id)
+            else:
+                self.buy_prices[product_id] = data.get('buyPrice', {}).get('value', 0)
+        return failed
+
+    def components(self, bundle_ids):
+        """
+        Возвращает словарь {id комплекта: список компонентов или None, если не получен}.
+        Составы запрашиваются параллельно и запоминаются, повторно не запрашиваются
+
+        Входящие переменные:
+            bundle_ids - список id комплектов Моего Склада
+        """
+        missing = [bundle_id for bundle_id in bundle_ids if bundle_id not in self.bundle_components]
+        results = fetch.run_parallel(
+            moy_sklad_bundle_components, [(self.token, bundle_id) for bundle_id in missing],
+            self.concurrency)
+        for bundle_id, rows in zip(missing, results):
+            if rows is not None:
+                self.bundle_components[bundle_id] = rows
+        return {bundle_id: self.bundle_components.get(bundle_id) for bundle_id in bundle_ids}
+
+    def resolve(self, bundle_ids):
+        """
+        Возвращает словарь {id комплекта: стоимость в копейках}.
+        Если компоненты или один из товаров получить не удалось - стоимость None
+
+        Входящие переменные:
+            bundle_ids - список id комплектов Моего Склада
+        """
+        bundle_ids = list(bundle_ids)
+        components = list(self.components(bundle_ids).values())
+
+        missing = {}
+        for rows in components:
+            for component in rows or []:
+                href = component['assortment']['meta']['href']
+                product_id = moy_sklad_id_from_href(href)
+                if product_id not in self.buy_prices:
+                    missing[product_id] = href
+        failed = self._fetch_missing_prices(missing.values()) if missing else set()
+        if missing:
+            logger.info(f'Товаров комплектов не из ассортимента: {len(missing)}, не получено: {len(failed)}')
+
+        costs = {}
+        for bundle_id, rows in zip(bundle_ids, components):
+            if rows is None:
+                costs[bundle_id] = None
+                continue
+            cost = 0
+            for component in rows:
+                product_id = moy_sklad_id_from_href(component['assortment']['meta']['href'])
+                if product_id in failed:
+                    cost = None
+                    break
+                cost += self.buy_prices[product_id] * component.get('quantity', 0)
+            costs[bundle_id] = cost
+        return costs
@@ -0,0 +1,159 @@
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, NamedStyle, Side
+
+# Сколько товаров читается из базы одним запросом при выгрузке
+EXPORT_CHUNK_SIZE = 2000
+# Размер блока файла в потоковом ответе
+EXPORT_STREAM_BLOCK_SIZE = 64 * 1024
+
+TABLE_HEADERS = (
+    "Название на маркетплейсе",
+    "Название на 'Мой склад'",
+    "Артикул на маркетплейсе",
+    "Артикул на 'Мой склад'",
+    "SKU на маркетплейсе",
+    "SKU на 'Мой склад'",
+
+    "Баркод",
+    "Бренд",
+    "РРЦ",
+    "Цена",
+
+    "Себестоимость",
+    "Комиссия",
+    "Логистика",
+    "Прибыль/убыток",
+    "Рентабельность",
+)
+COLUMN_WIDTHS = {'A': 23, 'B': 20, **{column: 18 for column in 'CDEFGHIJKLMNO'}}
+TABLE_CELL_STYLE = 'table_cell'
+
+
+def table_cell_style():
+    """Стиль ячеек таблицы: тонкая рамка и выравнивание по центру"""
+    thin = Side(border_style="thin", color="000000")
+    return NamedStyle(
+        name=TABLE_CELL_STYLE,
+        border=Border(top=thin, left=thin, bottom=thin, right=thin),
+        alignment=Alignment(horizontal="center", vertical="center"),
+    )
+
+
+def excel_barcode(barcode):
+    """В поле barcode может лежать список баркодов или один баркод, в ячейку пишется строка"""
+    if isinstance(barcode, list):
+        return ', '.join(str(value) for value in barcode)
+    return barcode
+
+
+def marketplace_product_row(mp_product, data, price_toggle, costprice_flag, ff_type):
+    """
+    Возвращает значения строки таблицы для товара маркетплейса
+
+    Входящие переменные:
+        mp_product - товар маркетплейса (MarketplaceProduct) с загруженными product и platform
+        data - данные товара из MarketplaceProductSerializer
+        price_toggle - переключатель цены
+        costprice_flag - себестоимость: table - из таблицы, enter - методом оприходования
+        ff_type - тип доставки (fbs, fbo, dbs, fbs_express)
+    """
+    if not price_toggle and costprice_flag == 'table':
+        price = data['usual_price']
+    elif not price_toggle and costprice_flag == 'enter':
+        price = data['profit_price']
+    else:
+        price = data['price']
+
+    commission = 0
+    if data['commission']:
+        commission = data['commission']['fbs_commission']
+        if ff_type == 'fbo':
+            commission = data['commission']['fbo_commission']
+        elif ff_type == 'dbs':
+            commission = data['commission']['dbs_commission']
+        elif ff_type == 'fbs_express':
+            commission = data['commission']['fbs_express_commission']
+
+    logistic_cost = 0
+    if data['logistic_cost']:
+        if mp_product.platform_id == 4 and ff_type == 'fbs':
+            logistic_cost = data['logistic_cost']['cost_logistic_fbs']
+        elif mp_product.platform_id == 4 and ff_type == 'fbo':
+            logistic_cost = data['logistic_cost']['cost_logistic_fbo']
+        else:
+            logistic_cost = data['logistic_cost']['cost_logistic']
+
+    if costprice_flag == 'enter':
+        costprice = data['posting_costprice']
+    else:
+        costprice = data['cost_price']
+
+    return (
+        mp_product.name,
+        mp_product.product.name,
+        mp_product.seller_article,
+        mp_product.product.vendor,
+        mp_product.sku,
+        mp_product.product.code,
+
+        excel_barcode(data['barcode']),
+        data['brand'],
+        data['rrc'],
+        price,
+
+        costprice,
+        # Без цены комиссию в рублях не посчитать
+        (commission * price) / 100 if price is not None and commission is not None else None,
+        logistic_cost,
+        data['profit'],
+        data['profitability'],
+    )
+
+
+def write_marketplace_products_workbook(file, title_lines, mp_products, serializer,
+                                        price_toggle, costprice_flag, ff_type):
+    """
+    Записывает таблицу товаров маркетплейсов в file (xlsx).
+
+    Книга в режиме write-only: строки сразу уходят во временный файл openpyxl,
+    поэтому память не зависит от количества товаров, если mp_products - итератор.
+
+    Входящие переменные:
+        file - файл для записи
+        title_lines - строки над таблицей (маркетплейс, магазин, накладные расходы, тип ФФ)
+        mp_products - итератор товаров маркетплейса
+        serializer - MarketplaceProductSerializer для расчета значений товара
+        price_toggle, costprice_flag, ff_type - параметры таблицы (marketplace_product_row)
+    """
+    wb = Workbook(write_only=True)
+    wb.add_named_style(table_cell_style())
+    ws = wb.create_sheet()
+    for column, width in COLUMN_WIDTHS.items():
+        ws.column_dimensions[column].width = width
+
+    def table_row(values):
+        cells = []
+        for value in values:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.style = TABLE_CELL_STYLE
+            cells.append(cell)
+        return cells
+
+    for line in title_lines:
+        ws.append([line])
+    ws.append(table_row(TABLE_HEADERS))
+    for mp_product in mp_products:
+        data = serializer.to_representation(mp_product)
+        ws.append(table_row(marketplace_product_row(mp_product, data, price_toggle, costprice_flag, ff_type)))
+    wb.save(file)
+
+
+def file_blocks(file, block_size=EXPORT_STREAM_BLOCK_SIZE):
+    """Отдает файл с начала блоками по block_size и закрывает его"""
+    try:
+        file.seek(0)
+        while block := file.read(block_size):
+            yield block
+    finally:
+        file.close()
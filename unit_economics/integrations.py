@@ -1,25 +1,34 @@
 import asyncio
+import json
 import logging
 import traceback
 from functools import wraps
 
 import requests
 from asgiref.sync import sync_to_async
-from django.db.models import Count, Prefetch, Q, Case, When, Value, BooleanField, Sum, F
+from django.db.models import Prefetch, Q, Case, When, Value, BooleanField, Sum, F
 import telegram
 
+from analyticalplatform.integrations import (bulk_create_objects,
+                                             bulk_update_objects, bulk_upsert)
 from analyticalplatform.settings import ADMINS_CHATID_LIST, TELEGRAM_TOKEN
 from api_requests.moy_sklad import change_product_price
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform, User
+from unit_economics.barcodes import (product_ids_by_barcode,
+                                     sync_marketplace_product_barcodes)
+from unit_economics.invalidation import mark_profitability_changed
+from unit_economics.manager import profitability_groups_count
 from unit_economics.models import (MarketplaceAction, MarketplaceCategory,
                                    MarketplaceCommission, MarketplaceLogistic,
                                    MarketplaceProduct, MarketplaceProductInAction,
                                    MarketplaceProductPriceWithProfitability,
                                    ProductCostPrice,
                                    ProductForMarketplacePrice,
-                                   ProductOzonPrice, ProductPrice,
+                                   ProductOzonPrice,
                                    ProfitabilityMarketplaceProduct, StoreOverhead)
+from unit_economics.profitability import (profitability_bulk_calculate,
+                                          refresh_profitability_snapshot)
 from unit_economics.serializers import MarketplaceProductSerializer
 
 logger = logging.getLogger(__name__)
@@ -43,6 +52,126 @@ def sender_error_to_tg(func):
     return wrapper
 
 
+MARKETPLACE_PRODUCT_CARD_FIELDS = (
+    'name', 'seller_article', 'category', 'width', 'height', 'length', 'weight', 'ozonsku')
+
+
+def marketplace_categories_ids(platform, categories):
+    """
+    Находит или создает категории маркетплейса пачкой.
+
+    Входящие данные:
+        categories - множество пар (category_number, category_name)
+
+    Возвращает словарь {(category_number, category_name): category_id}
+    """
+    category_numbers = {number for number, _ in categories}
+    numbers_condition = Q(category_number__in=category_numbers - {None})
+    if None in category_numbers:
+        numbers_condition |= Q(category_number__isnull=True)
+    categories_ids = {
+        (category_number, category_name): category_id
+        for category_id, category_number, category_name in MarketplaceCategory.objects.filter(
+            numbers_condition, platform=platform).values_list('id', 'category_number', 'category_name')
+    }
+    new_categories = [
+        MarketplaceCategory(platform=platform, category_number=category_number, category_name=category_name)
+        for category_number, category_name in categories
+        if (category_number, category_name) not in categories_ids
+    ]
+    for category in MarketplaceCategory.objects.bulk_create(new_categories):
+        categories_ids[(category.category_number, category.category_name)] = category.id
+    return categories_ids
+
+
+def add_marketplace_products_to_db(account_sklad, account, platform, cards):
+    """
+    Записывает данные о продуктах маркетплейса пачкой после сопоставления
+    с основными продуктами по баркоду.
+
+    Входящие данные:
+        cards - список словарей с ключами barcode, name, sku, seller_article,
+            category_number, category_name, width, height, length, weight, ozon_sku
+
+    Новые товары создаются пачкой, у существующих обновляются
+    только изменившиеся поля (bulk_create_objects / bulk_update_objects).
+    Возвращает количество созданных и обновленных товаров
+    """
+    barcode_index = product_ids_by_barcode([card['barcode'] for card in cards], account_sklad)
+    categories_ids = marketplace_categories_ids(
+        platform, {(card['category_number'], card['category_name']) for card in cards})
+
+    card_values = {}
+    for card in cards:
+        values = {
+            'name': card['name'],
+            'seller_article': card['seller_article'],
+            'category_id': categories_ids[(card['category_number'], card['category_name'])],
+            'width': card['width'],
+            'height': card['height'],
+            'length': card['length'],
+            'weight': card['weight'],
+            'ozonsku': card.get('ozon_sku', ''),
+        }
+        for field_name in MARKETPLACE_PRODUCT_CARD_FIELDS:
+            field = MarketplaceProduct._meta.get_field(field_name)
+            values[field.attname] = field.to_python(values[field.attname])
+        for product_id in barcode_index.get(str(card['barcode']), []):
+            card_values[(product_id, str(card['sku']), json.dumps(card['barcode']))] = values
+
+    existing_products = {}
+    for product in MarketplaceProduct.objects.filter(
+            account=account, platform=platform,
+            product_id__in={key[0] for key in card_values}).only(
+            'id', 'product_id', 'sku', 'barcode', *MARKETPLACE_PRODUCT_CARD_FIELDS):
+        # barcode - JSON поле, в старых записях бывает списком
+        existing_products.setdefault(
+            (product.product_id, product.sku, json.dumps(product.barcode)), []).append(product)
+
+    objects_for_create = []
+    objects_for_update = []
+    for (product_id, sku, barcode), values in card_values.items():
+        products = existing_products.get((product_id, sku, barcode))
+        if not products:
+            objects_for_create.append(MarketplaceProduct(
+                account=account, platform=platform, product_id=product_id,
+                sku=sku, barcode=json.loads(barcode), **values))
+            continue
+        for product in products:
+            if any(getattr(product, attname) != value for attname, value in values.items()):
+                for attname, value in values.items():
+                    setattr(product, attname, value)
+                objects_for_update.append(product)
+
+    created_products = bulk_create_objects(MarketplaceProduct, objects_for_create)
+    bulk_update_objects(MarketplaceProduct, objects_for_update, MARKETPLACE_PRODUCT_CARD_FIELDS)
+    # bulk_create не отправляет post_save
+    sync_marketplace_product_barcodes(
+        {product.id: product.barcode for product in created_products}, created=True)
+    mark_profitability_changed(mp_product_ids=[product.id for product in created_products])
+    return len(created_products), len(objects_for_update)
+
+
+def update_marketplace_products_activity(account, api_skus, deactivate_missing=True):
+    """
+    Обновляет флаг is_active товаров аккаунта по списку SKU из API.
+    Меняются только строки с другим значением флага, двумя UPDATE.
+
+    Входящие данные:
+        account - аккаунт маркетплейса
+        api_skus - SKU, которые есть в API
+        deactivate_missing - снять флаг с товаров, которых нет в api_skus
+            (только когда api_skus - полный список товаров аккаунта)
+    Возвращает количество измененных товаров
+    """
+    api_skus = {str(sku) for sku in api_skus}
+    products = MarketplaceProduct.objects.filter(account=account)
+    changed = products.filter(is_active=False, sku__in=api_skus).update(is_active=True)
+    if deactivate_missing:
+        changed += products.filter(is_active=True).exclude(sku__in=api_skus).update(is_active=False)
+    return changed
+
+
 @sender_error_to_tg
 def add_marketplace_product_to_db(
         account_sklad, barcode,
@@ -53,44 +182,48 @@ def add_marketplace_product_to_db(
     """
     Записывает данные о продуктах маркетплейсов после сопоставления с основными продуктами в базу данных
     """
-    
-    category_obj, created = MarketplaceCategory.objects.get_or_create(
-        platform=platform,
-        category_number=category_number,
-        category_name=category_name
-    )
-    product_data = ProductPrice.objects.filter(account=account_sklad)
-    objects_for_create = []
-    for product in product_data:
-        bc_list = product.barcode
-        if str(barcode) in bc_list:
-            if not MarketplaceProduct.objects.filter(account=account, platform=platform, product=product, sku=sku, barcode=barcode):
-                MarketplaceProduct(
-                    account=account,
-                    platform=platform,
-                    product=product,
-                    name=name,
-                    sku=sku,
-                    seller_article=seller_article,
-                    barcode=barcode,
-                    category=category_obj,
-                    width=width,
-                    height=height,
-                    length=length,
-                    weight=weight,
-                    ozonsku=ozon_sku
-                ).save()
-            else:
-                MarketplaceProduct.objects.filter(account=account, platform=platform, product=product, sku=sku, barcode=barcode).update(
-                    name=name,
-                    seller_article=seller_article,
-                    category=category_obj,
-                    width=width,
-                    height=height,
-                    length=length,
-                    weight=weight,
-                    ozonsku=ozon_sku
-                )
+    add_marketplace_products_to_db(account_sklad, account, platform, [{
+        'barcode': barcode, 'name': name, 'sku': sku, 'seller_article': seller_article,
+        'category_number': category_number, 'category_name': category_name,
+        'width': width, 'height': height, 'length': length, 'weight': weight, 'ozon_sku': ozon_sku,
+    }])
+
+
+MARKETPLACE_COMMISSION_FIELDS = (
+    'fbs_commission', 'fbo_commission', 'dbs_commission', 'fbs_express_commission')
+MARKETPLACE_LOGISTIC_FIELDS = ('cost_logistic', 'cost_logistic_fbo', 'cost_logistic_fbs')
+
+
+def add_marketplace_comissions_to_db(comissions):
+    """
+    Записывает комиссии маркетплейсов в базу данных пачкой
+
+    Входящие данные:
+        comissions - итерируемое словарей с ключами marketplace_product_id
+            и полями MARKETPLACE_COMMISSION_FIELDS (отсутствующие равны 0)
+    """
+    rows = [{'marketplace_product_id': comission['marketplace_product_id'],
+             **{field: comission.get(field, 0) for field in MARKETPLACE_COMMISSION_FIELDS}}
+            for comission in comissions]
+    bulk_upsert(MarketplaceCommission, rows, ['marketplace_product_id'])
+    # bulk_upsert не отправляет post_save
+    mark_profitability_changed(mp_product_ids=[row['marketplace_product_id'] for row in rows])
+
+
+def add_marketplace_logistics_to_db(logistics):
+    """
+    Записывает затраты на логистику маркетплейсов в базу данных пачкой
+
+    Входящие данные:
+        logistics - итерируемое словарей с ключами marketplace_product_id
+            и полями MARKETPLACE_LOGISTIC_FIELDS (отсутствующие равны 0)
+    """
+    rows = [{'marketplace_product_id': logistic['marketplace_product_id'],
+             **{field: logistic.get(field, 0) for field in MARKETPLACE_LOGISTIC_FIELDS}}
+            for logistic in logistics]
+    bulk_upsert(MarketplaceLogistic, rows, ['marketplace_product_id'])
+    mark_profitability_changed(mp_product_ids=[row['marketplace_product_id'] for row in rows])
+
 
 @sender_error_to_tg
 def add_marketplace_comission_to_db(
@@ -98,16 +231,13 @@ def add_marketplace_comission_to_db(
     """
     Записывает комиссии маркетплейсов в базу данных
     """
-    search_params = {'marketplace_product': product_obj}
-    values_for_update = {
-        "fbs_commission": fbs_commission,
-        "fbo_commission": fbo_commission,
-        "dbs_commission": dbs_commission,
-        "fbs_express_commission": fbs_express_commission
-    }
-    
-    MarketplaceCommission.objects.update_or_create(
-        defaults=values_for_update, **search_params)
+    add_marketplace_comissions_to_db([{
+        'marketplace_product_id': product_obj.id,
+        'fbs_commission': fbs_commission,
+        'fbo_commission': fbo_commission,
+        'dbs_commission': dbs_commission,
+        'fbs_express_commission': fbs_express_commission,
+    }])
 
 
 @sender_error_to_tg
@@ -116,14 +246,12 @@ def add_marketplace_logistic_to_db(
     """
     Записывает затраты на логистику маркетплейсов в базу данных
     """
-    search_params = {'marketplace_product': product_obj}
-    values_for_update = {
-        "cost_logistic": cost_logistic,
-        "cost_logistic_fbo": cost_logistic_fbo,
-        "cost_logistic_fbs": cost_logistic_fbs
-    }
-    MarketplaceLogistic.objects.update_or_create(
-        defaults=values_for_update, **search_params)
+    add_marketplace_logistics_to_db([{
+        'marketplace_product_id': product_obj.id,
+        'cost_logistic': cost_logistic,
+        'cost_logistic_fbo': cost_logistic_fbo,
+        'cost_logistic_fbs': cost_logistic_fbs,
+    }])
 
 
 def profitability_part_template(product):
@@ -242,162 +370,23 @@ def profitability_calculate_only(queryset, costprice_flag='table', order_deliver
     Происходит, когда переключатель Цена находится на Мой Склад
     Срабатывает от ключа в фильтрах: price_toggle
     """
-    if order_delivery_type == None:
-        order_delivery_type = 'fbo'
-    mp_products_list = queryset.select_related(
-        'marketproduct_logistic', 'marketproduct_comission', 'product', 'platform', 'account')
-    products_to_update = []
-    products_to_create = []
-    comission_logistic_costs = {}
-    for product in mp_products_list:
-        try:
-            price, overheads, comission_logistic_costs = profitability_part_template(product)
-            logistic_cost = comission_logistic_costs[order_delivery_type]['logistic_cost']
-            comission = comission_logistic_costs[order_delivery_type]['comission']
-            cost_price = 0
-
-            if costprice_flag == 'table':
-                cost_price = product.product.cost_price
-            elif costprice_flag == 'enter':
-                if ProductCostPrice.objects.filter(
-                        product=product.product).exists():
-                    cost_price = ProductCostPrice.objects.get(
-                        product=product.product).cost_price
-                else:
-                    cost_price = 0
-
-            if price > 0:
-                if not comission:
-                    comission = 0            
-                profitability_product = ProfitabilityMarketplaceProduct.objects.filter(
-                    mp_product=product)
-                profit = round((price - float(cost_price) -
-                                logistic_cost - (comission * price/100) - (overheads * price)), 2)
-                profitability = round(((profit / price) * 100), 2)                
-                if profitability_product:
-                    # Обновляем существующий объект
-                    profitability_product = profitability_product.first()
-                    profitability_product.profit = profit
-                    profitability_product.profitability = profitability
-                    profitability_product.save()
-                else:
-                    # Создаем новый объект
-                    products_to_create.append(ProfitabilityMarketplaceProduct(
-                        mp_product=product, profit=profit,
-                    profitability=profitability))
-        except (ProductOzonPrice.DoesNotExist, ProductForMarketplacePrice.DoesNotExist):
-            # Пропускаем продукты, для которых нет цены
-            continue
-
-    if products_to_update:
-        ProfitabilityMarketplaceProduct.objects.bulk_update(
-            products_to_update, ['profit', 'profitability'])
-    if products_to_create:
-        ProfitabilityMarketplaceProduct.objects.bulk_create(products_to_create)
+    profitability_bulk_calculate(
+        queryset, costprice_flag=costprice_flag, order_delivery_type=order_delivery_type)
     return queryset
 
 
-
 def profitability_calculate(user_id, profitability_group=None, costprice_flag='table', order_delivery_type='fbo'):
     """Расчет рентабельности по изменению для всей таблицы"""
-    if order_delivery_type == None:
-        order_delivery_type = 'fbo'
     user = User.objects.get(id=user_id)
-    mp_products_list = MarketplaceProduct.objects.filter(account__user=user).select_related(
-        'marketproduct_logistic', 'marketproduct_comission', 'product', 'platform', 'account')
-    products_to_update = []
-    products_to_create = []
-    filtered_products = []
-    comission_logistic_costs = {}
-    for product in mp_products_list:
-        try:
-            price, overheads, comission_logistic_costs = profitability_part_template(product)
-
-            logistic_cost = comission_logistic_costs[order_delivery_type]['logistic_cost']
-            comission = comission_logistic_costs[order_delivery_type]['comission']
-            cost_price = 0
-            if costprice_flag == 'table':
-                cost_price = product.product.cost_price
-            elif costprice_flag == 'enter':
-                if ProductCostPrice.objects.filter(
-                        product=product.product).exists():
-                    cost_price = ProductCostPrice.objects.get(
-                        product=product.product).cost_price
-                else:
-                    cost_price = 0
-
-            if price > 0:
-                if not comission:
-                    comission = 0
-                search_params = {'mp_product': product}
-                try:
-                    profitability_product = ProfitabilityMarketplaceProduct.objects.get(
-                        **search_params)
-                except ProfitabilityMarketplaceProduct.DoesNotExist:
-                    pass
-                profit = round((price - float(cost_price) -
-                                logistic_cost - (comission* price/100) - (overheads * price)), 2)
-                profitability = round(((profit / price) * 100), 2)
-
-                # Добавляем фильтрацию по группе рентабельности
+    profitability_bulk_calculate(
+        user_id=user.id, costprice_flag=costprice_flag, order_delivery_type=order_delivery_type)
+    refresh_profitability_snapshot(user_id=user.id)
 
-                values_for_update = {
-                    "profit": profit,
-                    "profitability": profitability
-                }
-                if 'profitability_product' in locals():
-                    # Обновляем существующий объект
-                    profitability_product.profit = profit
-                    profitability_product.profitability = profitability
-                    products_to_update.append(profitability_product)
-                else:
-                    # Создаем новый объект
-                    products_to_create.append(ProfitabilityMarketplaceProduct(
-                        mp_product=product, **values_for_update))
-        except (ProductOzonPrice.DoesNotExist, ProductForMarketplacePrice.DoesNotExist):
-            # Пропускаем продукты, для которых нет цены
-            continue
-
-    if products_to_update:
-        ProfitabilityMarketplaceProduct.objects.bulk_update(
-            products_to_update, ['profit', 'profitability'])
-
-    if products_to_create:
-        ProfitabilityMarketplaceProduct.objects.bulk_create(products_to_create)
-
-    result = ProfitabilityMarketplaceProduct.objects.aggregate(
-        count_above_20=Count('id', filter=Q(profitability__gt=20)),
-        count_between_10_and_20=Count('id', filter=Q(
-            profitability__lte=20) & Q(profitability__gt=10)),
-        count_between_0_and_10=Count('id', filter=Q(
-            profitability__lte=10) & Q(profitability__gt=0)),
-        count_between_0_and_minus_10=Count('id', filter=Q(
-            profitability__lte=0) & Q(profitability__gt=-10)),
-        count_between_minus_10_and_minus_20=Count('id', filter=Q(
-            profitability__lte=-10) & Q(profitability__gt=-20)),
-        count_below_minus_20=Count('id', filter=Q(profitability__lte=-20)),
-    )
+    result = profitability_groups_count(
+        ProfitabilityMarketplaceProduct.objects.filter(mp_product__account__user=user))
     if profitability_group:
-        mp_products_list = MarketplaceProduct.objects.filter(
-            account__user=user)
-        for product in mp_products_list:
-            if ProfitabilityMarketplaceProduct.objects.filter(
-                    mp_product=product).exists():
-                profitability = ProfitabilityMarketplaceProduct.objects.get(
-                    mp_product=product).profitability
-                if profitability_group == 'count_above_20' and profitability > 20:
-                    filtered_products.append(product)
-                elif profitability_group == 'count_between_10_and_20' and 10 < profitability <= 20:
-                    filtered_products.append(product)
-                elif profitability_group == 'count_between_0_and_10' and 0 < profitability <= 10:
-                    filtered_products.append(product)
-                elif profitability_group == 'count_between_0_and_minus_10' and -10 < profitability <= 0:
-                    filtered_products.append(product)
-                elif profitability_group == 'count_between_minus_10_and_minus_20' and -20 < profitability <= -10:
-                    filtered_products.append(product)
-                elif profitability_group == 'count_below_minus_20' and profitability <= -20:
-                    filtered_products.append(product)
-        result['filtered_products'] = filtered_products
+        result['filtered_products'] = MarketplaceProduct.objects.filter(
+            account__user=user).profitability_group(profitability_group)
 
     return result
 
@@ -839,8 +828,8 @@ def calculate_quarantine_mp_products(quarantine_percent, queryset):
         yandex_price=F('product__price_product__yandex_price'),
         rrc=F('product__price_product__rrc')
     )
-    if queryset:
-        platform_id = queryset.first().platform.id
+    platform_id = queryset.values_list('platform_id', flat=True).first()
+    if platform_id is not None:
         if platform_id == 1:
             queryset = queryset.filter(
                 Q(wb_price__gt=F('rrc') * great) | Q( wb_price__lt=F('rrc') * less)
@@ -855,4 +844,4 @@ def calculate_quarantine_mp_products(quarantine_percent, queryset):
             )
         return queryset
     else:
-        return []
\ No newline at end of file
+        return queryset.none()
\ No newline at end of file
@@ -0,0 +1,87 @@
+import threading
+from contextlib import ContextDecorator
+
+from django.db import transaction
+
+
+class ProfitabilityChanges(threading.local):
+    """
+    Накопитель изменений входных данных рентабельности в текущем потоке.
+
+    Хранит ключи, по которым затем находятся затронутые товары MarketplaceProduct:
+        mp_product_ids - id товаров на маркетплейсе
+        product_ids - id товаров Мой Склад (ProductPrice)
+        account_ids - id магазинов (накладные расходы)
+    """
+
+    def __init__(self):
+        self.mp_product_ids = set()
+        self.product_ids = set()
+        self.account_ids = set()
+        self.batch_depth = 0
+
+    def is_empty(self):
+        return not (self.mp_product_ids or self.product_ids or self.account_ids)
+
+    def pop(self):
+        """Забирает накопленные ключи и очищает накопитель"""
+        changes = {
+            'mp_product_ids': sorted(self.mp_product_ids),
+            'product_ids': sorted(self.product_ids),
+            'account_ids': sorted(self.account_ids),
+        }
+        self.mp_product_ids = set()
+        self.product_ids = set()
+        self.account_ids = set()
+        return changes
+
+
+pending_changes = ProfitabilityChanges()
+
+
+def flush_profitability_changes():
+    """Отправляет одну задачу пересчета на все накопленные изменения"""
+    if pending_changes.is_empty():
+        return
+    from unit_economics.tasks import recalculate_changed_profitability
+
+    recalculate_changed_profitability.delay(**pending_changes.pop())
+
+
+def mark_profitability_changed(mp_product_ids=(), product_ids=(), account_ids=()):
+    """
+    Помечает входные данные рентабельности как измененные.
+
+    Пересчет запускается после коммита текущей транзакции (или сразу,
+    если транзакции нет). Внутри profitability_changes_batch пересчет
+    откладывается до выхода из самого внешнего блока.
+    Для bulk_create/update, которые не отправляют сигналы, функцию
+    нужно вызывать явно.
+    """
+    pending_changes.mp_product_ids.update(mp_product_ids)
+    pending_changes.product_ids.update(product_ids)
+    pending_changes.account_ids.update(account_ids)
+    if pending_changes.batch_depth:
+        return
+    # Все колбэки одной транзакции, кроме первого, найдут накопитель пустым.
+    # При откате транзакции ключи остаются и уйдут со следующим пересчетом
+    transaction.on_commit(flush_profitability_changes)
+
+
+class profitability_changes_batch(ContextDecorator):
+    """
+    Объединяет изменения всего блока (например ночного импорта)
+    в одну задачу пересчета рентабельности.
+
+    Используется как контекстный менеджер или декоратор.
+    """
+
+    def __enter__(self):
+        pending_changes.batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pending_changes.batch_depth -= 1
+        if not pending_changes.batch_depth and not pending_changes.is_empty():
+            transaction.on_commit(flush_profitability_changes)
+        return False
@@ -0,0 +1,62 @@
+from django.db import models
+from django.db.models import Count, F, FilteredRelation, Q
+
+# Группы рентабельности для бар-диаграммы: (нижняя граница, верхняя граница].
+# None - граница отсутствует
+PROFITABILITY_GROUPS = {
+    'count_above_20': (20, None),
+    'count_between_10_and_20': (10, 20),
+    'count_between_0_and_10': (0, 10),
+    'count_between_0_and_minus_10': (-10, 0),
+    'count_between_minus_10_and_minus_20': (-20, -10),
+    'count_below_minus_20': (None, -20),
+}
+
+
+def profitability_group_q(group, field='profitability'):
+    """
+    Условие фильтрации по группе рентабельности
+
+    Входящие данные:
+        group - ключ из PROFITABILITY_GROUPS
+        field - путь до поля рентабельности относительно фильтруемой модели
+    """
+    lower, upper = PROFITABILITY_GROUPS[group]
+    condition = Q()
+    if lower is not None:
+        condition &= Q(**{f'{field}__gt': lower})
+    if upper is not None:
+        condition &= Q(**{f'{field}__lte': upper})
+    return condition
+
+
+def profitability_groups_count(queryset, field='profitability'):
+    """Количество записей queryset в каждой группе рентабельности одним запросом"""
+    return queryset.aggregate(**{
+        group: Count('id', filter=profitability_group_q(group, field))
+        for group in PROFITABILITY_GROUPS
+    })
+
+
+class MarketplaceProductQuerySet(models.QuerySet):
+
+    def profitability_group(self, group, field='mp_profitability__profitability'):
+        """Товары, рентабельность которых попадает в группу group"""
+        if group not in PROFITABILITY_GROUPS:
+            return self.none()
+        return self.filter(profitability_group_q(group, field))
+
+    def with_profitability_snapshot(self, costprice_flag='table', order_delivery_type='fbo'):
+        """
+        Добавляет к товарам прибыль и рентабельность из ProfitabilitySnapshot
+        (поля snapshot_profit и snapshot_profitability) одним LEFT JOIN
+        """
+        return self.annotate(
+            snapshot=FilteredRelation(
+                'profitability_snapshots',
+                condition=Q(profitability_snapshots__costprice_flag=costprice_flag or 'table',
+                            profitability_snapshots__order_delivery_type=order_delivery_type or 'fbo'),
+            ),
+            snapshot_profit=F('snapshot__profit'),
+            snapshot_profitability=F('snapshot__profitability'),
+        )
@@ -1,6 +1,8 @@
 from django.db import models
+from django.utils import timezone
 
 from core.models import Account, Platform
+from unit_economics.manager import MarketplaceProductQuerySet
 
 
 class ProductPrice(models.Model):
@@ -30,6 +32,23 @@ class ProductPrice(models.Model):
         verbose_name_plural = "Продукты с ценами для Unit экономики"
 
 
+class ProductBarcode(models.Model):
+    """
+    Баркод продукта Мой Склад. Нормализованная копия ProductPrice.barcode
+    для поиска по индексу
+    """
+    product = models.ForeignKey(ProductPrice, related_name='product_barcodes',
+                                on_delete=models.CASCADE, verbose_name='Продукт')
+    barcode = models.CharField(max_length=255, db_index=True, verbose_name='Баркод')
+
+    class Meta:
+        verbose_name = "Баркод продукта"
+        verbose_name_plural = "Баркоды продуктов"
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'barcode'], name='unique_product_barcode'),
+        ]
+
+
 class ProductCostPrice(models.Model):
     """
     Описывает модель себестоимости Продукта
@@ -79,6 +98,9 @@ class ProductOzonPrice(models.Model):
     class Meta:
         verbose_name = "Цены для ОЗОН"
         verbose_name_plural = "Цены для ОЗОН"
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'account'], name='unique_ozon_price'),
+        ]
 
 
 class ProfitabilityMarketplaceProduct(models.Model):
@@ -87,7 +109,7 @@ class ProfitabilityMarketplaceProduct(models.Model):
                                       on_delete=models.CASCADE, verbose_name='Продукт c с маркетплейса')
     profit = models.FloatField(verbose_name='Прибыль', null=True, blank=True)
     profitability = models.FloatField(
-        verbose_name='Рентабельность', null=True, blank=True)
+        verbose_name='Рентабельность', null=True, blank=True, db_index=True)
     overheads = models.FloatField(
         verbose_name='Накладные расходы', default=0.2)
 
@@ -96,6 +118,47 @@ class ProfitabilityMarketplaceProduct(models.Model):
         verbose_name_plural = "Рентабельность товара на маркетплейсе"
 
 
+class ProfitabilitySnapshot(models.Model):
+    """
+    Снимок рентабельности товара на маркетплейсе для каждого сочетания
+    типа себестоимости и типа доставки. Пересчитывается только для
+    товаров, у которых изменились входные данные
+    """
+    COSTPRICE_FLAG_CHOICES = (
+        ('table', 'Себестоимость из Мой Склад'),
+        ('enter', 'Себестоимость по оприходованию'),
+    )
+    DELIVERY_TYPE_CHOICES = (
+        ('fbo', 'FBO'),
+        ('fbs', 'FBS'),
+        ('dbs', 'DBS'),
+        ('fbs_express', 'FBS Express'),
+    )
+
+    mp_product = models.ForeignKey('MarketplaceProduct', related_name='profitability_snapshots',
+                                   on_delete=models.CASCADE, verbose_name='Продукт c с маркетплейса')
+    costprice_flag = models.CharField(
+        max_length=10, choices=COSTPRICE_FLAG_CHOICES, verbose_name='Тип себестоимости')
+    order_delivery_type = models.CharField(
+        max_length=20, choices=DELIVERY_TYPE_CHOICES, verbose_name='Тип доставки')
+    # Пустые у товаров без цены: снимок есть, но считать нечего
+    profit = models.FloatField(null=True, blank=True, verbose_name='Прибыль')
+    profitability = models.FloatField(null=True, blank=True, verbose_name='Рентабельность')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата пересчета')
+
+    class Meta:
+        verbose_name = "Снимок рентабельности товара на маркетплейсе"
+        verbose_name_plural = "Снимки рентабельности товаров на маркетплейсе"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['mp_product', 'costprice_flag', 'order_delivery_type'],
+                name='unique_profitability_snapshot'),
+        ]
+        indexes = [
+            models.Index(fields=['costprice_flag', 'order_delivery_type', 'profitability']),
+        ]
+
+
 class PostingGoods(models.Model):
     """
     Описывает модель оприходования товара на склад
@@ -120,6 +183,9 @@ class PostingGoods(models.Model):
     class Meta:
         verbose_name = "Оприходование товара"
         verbose_name_plural = "Оприходование товара"
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'position_number'], name='unique_posting_position'),
+        ]
 
 
 class MarketplaceProduct(models.Model):
@@ -151,11 +217,30 @@ class MarketplaceProduct(models.Model):
         verbose_name='Показатель изменения цены', default=False)
     is_active = models.BooleanField(default=True, verbose_name='Активный товар')
 
+    objects = MarketplaceProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Продукт на Маркетплейсе"
         verbose_name_plural = "Продукт на Маркетплейсе"
 
 
+class MarketplaceProductBarcode(models.Model):
+    """
+    Баркод продукта на маркетплейсе. Нормализованная копия MarketplaceProduct.barcode
+    для поиска по индексу
+    """
+    mp_product = models.ForeignKey(MarketplaceProduct, related_name='mp_product_barcodes',
+                                   on_delete=models.CASCADE, verbose_name='Продукт на маркетплейсе')
+    barcode = models.CharField(max_length=255, db_index=True, verbose_name='Баркод')
+
+    class Meta:
+        verbose_name = "Баркод продукта на маркетплейсе"
+        verbose_name_plural = "Баркоды продуктов на маркетплейсе"
+        constraints = [
+            models.UniqueConstraint(fields=['mp_product', 'barcode'], name='unique_mp_product_barcode'),
+        ]
+
+
 class MarketplaceProductPriceWithProfitability(models.Model):
     """
     Цена для продукта на маркетплейсе на основании комиссий и рентабельности
@@ -238,6 +323,9 @@ class MarketplaceAction(models.Model):
     class Meta:
         verbose_name = "Акции на Маркетплейсе"
         verbose_name_plural = "Акции на Маркетплейсе"
+        constraints = [
+            models.UniqueConstraint(fields=['platform', 'account', 'action_number'], name='unique_marketplace_action'),
+        ]
 
 
 class MarketplaceProductInAction(models.Model):
@@ -253,6 +341,9 @@ class MarketplaceProductInAction(models.Model):
     class Meta:
         verbose_name = "Товары в акции"
         verbose_name_plural = "Товары в акции"
+        constraints = [
+            models.UniqueConstraint(fields=['action', 'marketplace_product'], name='unique_product_in_action'),
+        ]
 
 
 class StoreOverhead(models.Model):
@@ -262,3 +353,29 @@ class StoreOverhead(models.Model):
     name = models.CharField(max_length=100, verbose_name='Название расходов')
     overhead = models.FloatField(verbose_name='Значение накладных расходов', null=True, blank=True)
 
+
+
+class ImportWatermark(models.Model):
+    """
+    Отметка последней загрузки данных аккаунта из API
+    для инкрементальной синхронизации
+    """
+    account = models.ForeignKey(Account, related_name='import_watermarks', on_delete=models.CASCADE,
+                                verbose_name='Аккаунт')
+    source = models.CharField(max_length=100, verbose_name='Источник данных')
+    value = models.JSONField(null=True, blank=True,
+                             verbose_name='Отметка (дата изменения или курсор API)')
+    last_full_sync = models.DateTimeField(null=True, blank=True,
+                                          verbose_name='Последняя полная сверка')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
+
+    class Meta:
+        verbose_name = "Отметка загрузки из API"
+        verbose_name_plural = "Отметки загрузки из API"
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'source'], name='unique_import_watermark'),
+        ]
+
+    def full_sync_due(self, interval):
+        """Пора ли делать полную сверку: ее не было или прошло больше interval"""
+        return self.last_full_sync is None or self.last_full_sync < timezone.now() - interval
@@ -0,0 +1,88 @@
+import base64
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.settings import api_settings
+
+
+class KeysetPagination:
+    """
+    Постраничная выдача по ключу (keyset).
+
+    Страница начинается после последней строки предыдущей: условие
+    (поле сортировки, id) > (значения последней строки) вместо OFFSET,
+    поэтому время выдачи не зависит от номера страницы.
+    Курсор следующей страницы передается в параметре cursor,
+    размер страницы - в параметре limit.
+    Пустые значения поля сортировки идут в конце при любом направлении.
+    """
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: 'Ожидается число'})
+        return max(1, min(page_size, self.max_page_size))
+
+    @staticmethod
+    def encode_cursor(values):
+        return base64.urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode()).decode()
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise ValidationError({self.cursor_query_param: 'Неверный курсор'})
+        return value, last_id
+
+    @staticmethod
+    def after_condition(field, descending, value, last_id):
+        """Условие для строк после (value, last_id) в порядке (field, id)"""
+        if value is None:
+            return Q(**{f'{field}__isnull': True, 'id__gt': last_id})
+        return (Q(**{f'{field}__lt' if descending else f'{field}__gt': value})
+                | Q(**{field: value, 'id__gt': last_id})
+                | Q(**{f'{field}__isnull': True}))
+
+    def paginate_queryset(self, queryset, request, ordering=None):
+        """
+        Возвращает (строки страницы, курсор следующей страницы или None)
+
+        Входящие переменные:
+            queryset - выборка товаров
+            request - запрос с параметрами cursor и limit
+            ordering - поле сортировки, '-' в начале - по убыванию; без него сортировка по id
+        """
+        field = (ordering or 'id').lstrip('-')
+        descending = bool(ordering) and ordering.startswith('-')
+        cursor = self.decode_cursor(request)
+        if field == 'id':
+            queryset = queryset.order_by('-id' if descending else 'id')
+            if cursor is not None:
+                queryset = queryset.filter(**{'id__lt' if descending else 'id__gt': cursor[1]})
+        else:
+            # Значение сортировки может быть в связанной модели или аннотацией
+            queryset = queryset.annotate(keyset_value=F(field))
+            queryset = queryset.order_by(
+                F('keyset_value').desc(nulls_last=True) if descending
+                else F('keyset_value').asc(nulls_last=True), 'id')
+            if cursor is not None:
+                queryset = queryset.filter(self.after_condition('keyset_value', descending, *cursor))
+            field = 'keyset_value'
+
+        page_size = self.get_page_size(request)
+        rows = list(queryset[:page_size + 1])
+        if len(rows) <= page_size:
+            return rows, None
+        rows = rows[:page_size]
+        last_row = rows[-1]
+        return rows, self.encode_cursor([getattr(last_row, field), last_row.id])
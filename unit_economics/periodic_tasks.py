@@ -1,7 +1,10 @@
 from analyticalplatform.celery import app
-from core.models import Account
+from analyticalplatform.integrations import bulk_upsert
+from core.models import Account, User
+from unit_economics.invalidation import mark_profitability_changed, profitability_changes_batch
 from unit_economics.models import (MarketplaceAction, ProductCostPrice,
                                    ProductPrice)
+from unit_economics.profitability import refresh_profitability_snapshot
 from unit_economics.tasks_moy_sklad import (moy_sklad_add_data_to_db,
                                             moy_sklad_costprice_calculate, moy_sklad_costprice_calculate_for_bundle)
 from unit_economics.tasks_ozon import (ozon_action_article_price_to_db,
@@ -19,12 +22,14 @@ from unit_economics.tasks_yandex import (
 
 
 @app.task()
+@profitability_changes_batch()
 def update_moy_sklad_product_list():
     """Обновляет данные о продуктах c Мой Склад"""
     moy_sklad_add_data_to_db()
 
 
 @app.task()
+@profitability_changes_batch()
 def update_wildberries_product_list():
     """Обновляет данные о продуктах c Wildberries"""
     wb_products_data_to_db()
@@ -33,6 +38,7 @@ def update_wildberries_product_list():
 
 
 @app.task()
+@profitability_changes_batch()
 def update_ozon_product_list():
     """Обновляет данные о продуктах c Ozon"""
     ozon_products_data_to_db()
@@ -40,6 +46,7 @@ def update_ozon_product_list():
 
 
 @app.task()
+@profitability_changes_batch()
 def update_yandex_product_list():
     """Обновляет данные о продуктах c Yandex"""
     yandex_add_products_data_to_db()
@@ -47,25 +54,16 @@ def update_yandex_product_list():
 
 
 @app.task(time_limit=36000)
+@profitability_changes_batch()
 def moy_sklad_costprice_add_to_db():
     """
     Записывает себестоимость (методом оприходования) товара в базу данных
     """
-   
-    cost_price_data = moy_sklad_costprice_calculate()
-    for account, cost_price_list in cost_price_data.items():
-        print('len(cost_price_list)', len(cost_price_list))
-        for data in cost_price_list:
-            product = data['product']
-            cost_price = data['cost_price']
-            
-            search_params = {'product': product}
-            values_for_update = {
-                "cost_price": cost_price
-            }
-            ProductCostPrice.objects.update_or_create(
-                defaults=values_for_update, **search_params
-            )
+    # Оприходования читаются потоком, в памяти только по строке на артикул
+    rows = list(moy_sklad_costprice_calculate())
+    bulk_upsert(ProductCostPrice, rows, unique_fields=['product_id'])
+    # bulk_upsert не отправляет post_save
+    mark_profitability_changed(product_ids=[row['product_id'] for row in rows])
     moy_sklad_costprice_calculate_for_bundle()
 
 
@@ -95,3 +93,13 @@ def action_article_price_to_db():
             actions_data = MarketplaceAction.objects.filter(
                 account=account, platform=platform)
             yandex_action_article_price_to_db(account, actions_data, platform)
+
+
+@app.task()
+def refresh_profitability_snapshots():
+    """
+    Обновляет снимки рентабельности товаров всех пользователей
+    после ночной загрузки цен, комиссий и себестоимости
+    """
+    for user in User.objects.filter(accounts__isnull=False).distinct():
+        refresh_profitability_snapshot(user_id=user.id)
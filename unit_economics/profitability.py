@@ -0,0 +1,218 @@
+from django.db.models import Sum
+
+from unit_economics.models import (MarketplaceProduct, ProductOzonPrice,
+                                   ProfitabilityMarketplaceProduct,
+                                   ProfitabilitySnapshot, StoreOverhead)
+
+DELIVERY_TYPES = ('fbo', 'fbs', 'dbs', 'fbs_express')
+COSTPRICE_FLAGS = ('table', 'enter')
+DEFAULT_OVERHEADS = 0.2
+PROFITABILITY_UPSERT_BATCH_SIZE = 1000
+
+PROFITABILITY_INPUT_FIELDS = (
+    'id',
+    'account_id',
+    'product_id',
+    'platform__name',
+    'product__cost_price',
+    'product__costprice_product__cost_price',
+    'product__price_product__wb_price',
+    'product__price_product__yandex_price',
+    'marketproduct_comission__fbo_commission',
+    'marketproduct_comission__fbs_commission',
+    'marketproduct_comission__dbs_commission',
+    'marketproduct_comission__fbs_express_commission',
+    'marketproduct_logistic__cost_logistic',
+    'marketproduct_logistic__cost_logistic_fbo',
+    'marketproduct_logistic__cost_logistic_fbs',
+)
+
+
+def load_profitability_inputs(mp_products):
+    """
+    Загружает входные данные для расчета рентабельности пачкой.
+
+    Цены, комиссии, логистика и себестоимость достаются одним запросом
+    через JOIN, цены ОЗОН и накладные расходы магазинов - еще двумя.
+
+    Входящие данные:
+        mp_products - queryset модели MarketplaceProduct
+
+    Возвращает:
+        rows - список словарей с полями PROFITABILITY_INPUT_FIELDS
+        ozon_prices - словарь {(account_id, product_id): ozon_price}
+        overheads - словарь {account_id: накладные расходы в долях}
+    """
+    rows = list(mp_products.order_by().values(*PROFITABILITY_INPUT_FIELDS))
+    account_ids = {row['account_id'] for row in rows}
+
+    ozon_prices = {
+        (account_id, product_id): ozon_price
+        for account_id, product_id, ozon_price in ProductOzonPrice.objects.filter(
+            account_id__in=account_ids).values_list('account_id', 'product_id', 'ozon_price')
+    }
+    overheads = {
+        data['account_id']: data['overhead_sum'] / 100
+        for data in StoreOverhead.objects.filter(account_id__in=account_ids).values(
+            'account_id').annotate(overhead_sum=Sum('overhead'))
+        if data['overhead_sum']
+    }
+    return rows, ozon_prices, overheads
+
+
+def _row_price(row, ozon_prices):
+    """Цена товара на маркетплейсе для строки входных данных"""
+    platform_name = row['platform__name']
+    if platform_name == 'OZON':
+        return ozon_prices.get((row['account_id'], row['product_id']))
+    if platform_name == 'Wildberries':
+        return row['product__price_product__wb_price']
+    if platform_name == 'Yandex Market':
+        return row['product__price_product__yandex_price']
+    return None
+
+
+def _row_logistic_costs(row):
+    """Затраты на логистику по типам доставки для строки входных данных"""
+    if row['platform__name'] == 'OZON':
+        return {
+            'fbo': row['marketproduct_logistic__cost_logistic_fbo'] or 0,
+            'fbs': row['marketproduct_logistic__cost_logistic_fbs'] or 0,
+            'dbs': 0,
+            'fbs_express': 0,
+        }
+    logistic_cost = row['marketproduct_logistic__cost_logistic'] or 0
+    return {delivery_type: logistic_cost for delivery_type in DELIVERY_TYPES}
+
+
+def _row_cost_price(row, costprice_flag):
+    """Себестоимость товара в зависимости от costprice_flag"""
+    if costprice_flag == 'table':
+        return float(row['product__cost_price'] or 0)
+    if costprice_flag == 'enter':
+        return float(row['product__costprice_product__cost_price'] or 0)
+    return 0
+
+
+def compute_profitability(rows, ozon_prices, overheads, costprice_flag='table'):
+    """
+    Считает прибыль и рентабельность сразу для всех типов доставки.
+
+    Товары без цены (или с нулевой ценой) пропускаются.
+
+    Возвращает словарь вида:
+    {mp_product_id: {delivery_type: (profit, profitability)}}
+    """
+    result = {}
+    for row in rows:
+        price = _row_price(row, ozon_prices)
+        if not price or price <= 0:
+            continue
+        cost_price = _row_cost_price(row, costprice_flag)
+        product_overheads = overheads.get(row['account_id'], DEFAULT_OVERHEADS)
+        logistic_costs = _row_logistic_costs(row)
+        product_result = {}
+        for delivery_type in DELIVERY_TYPES:
+            comission = row[f'marketproduct_comission__{delivery_type}_commission'] or 0
+            profit = round((price - cost_price - logistic_costs[delivery_type] -
+                            (comission * price / 100) - (product_overheads * price)), 2)
+            profitability = round(((profit / price) * 100), 2)
+            product_result[delivery_type] = (profit, profitability)
+        result[row['id']] = product_result
+    return result
+
+
+def save_profitability(profitability_data, order_delivery_type='fbo'):
+    """
+    Записывает прибыль и рентабельность выбранного типа доставки
+    в ProfitabilityMarketplaceProduct одним bulk upsert
+    """
+    objects = [
+        ProfitabilityMarketplaceProduct(
+            mp_product_id=mp_product_id,
+            profit=delivery_data[order_delivery_type][0],
+            profitability=delivery_data[order_delivery_type][1])
+        for mp_product_id, delivery_data in profitability_data.items()
+    ]
+    if objects:
+        ProfitabilityMarketplaceProduct.objects.bulk_create(
+            objects,
+            batch_size=PROFITABILITY_UPSERT_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['mp_product'],
+            update_fields=['profit', 'profitability'])
+
+
+def profitability_bulk_calculate(mp_products=None, costprice_flag='table', order_delivery_type='fbo', user_id=None):
+    """
+    Пакетный пересчет рентабельности товаров.
+
+    Входящие данные:
+        mp_products - queryset модели MarketplaceProduct
+        user_id - если mp_products не передан, считаются все товары пользователя
+        costprice_flag - 'table' (обычная с/с) или 'enter' (с/с по оприходованию)
+        order_delivery_type - тип доставки, рентабельность которого сохраняется в БД
+
+    Возвращает словарь {mp_product_id: {delivery_type: (profit, profitability)}}
+    """
+    if order_delivery_type is None:
+        order_delivery_type = 'fbo'
+    if mp_products is None:
+        mp_products = MarketplaceProduct.objects.filter(account__user_id=user_id)
+    profitability_data = compute_profitability(
+        *load_profitability_inputs(mp_products), costprice_flag=costprice_flag)
+    save_profitability(profitability_data, order_delivery_type)
+    return profitability_data
+
+
+def refresh_profitability_snapshot(mp_products=None, user_id=None):
+    """
+    Инкрементально обновляет ProfitabilitySnapshot.
+
+    Рентабельность пересчитывается для всех сочетаний типа себестоимости
+    и типа доставки, а в БД записываются только строки, значения которых
+    отличаются от сохраненных. Товары без цены получают снимок с пустыми
+    прибылью и рентабельностью, чтобы таблица не пересчитывала их при каждом запросе.
+
+    Входящие данные:
+        mp_products - queryset модели MarketplaceProduct
+        user_id - если mp_products не передан, обновляются все товары пользователя
+
+    Возвращает количество записанных строк
+    """
+    if mp_products is None:
+        mp_products = MarketplaceProduct.objects.filter(account__user_id=user_id)
+    rows, ozon_prices, overheads = load_profitability_inputs(mp_products)
+
+    fresh_data = {}
+    for costprice_flag in COSTPRICE_FLAGS:
+        profitability_data = compute_profitability(rows, ozon_prices, overheads, costprice_flag)
+        for row in rows:
+            delivery_data = profitability_data.get(row['id'], {})
+            for delivery_type in DELIVERY_TYPES:
+                fresh_data[(row['id'], costprice_flag, delivery_type)] = delivery_data.get(
+                    delivery_type, (None, None))
+
+    saved_data = {
+        (mp_product_id, costprice_flag, delivery_type): (profit, profitability)
+        for mp_product_id, costprice_flag, delivery_type, profit, profitability
+        in ProfitabilitySnapshot.objects.filter(
+            mp_product_id__in=[row['id'] for row in rows]).values_list(
+            'mp_product_id', 'costprice_flag', 'order_delivery_type', 'profit', 'profitability')
+    }
+
+    changed_objects = [
+        ProfitabilitySnapshot(
+            mp_product_id=mp_product_id, costprice_flag=costprice_flag,
+            order_delivery_type=delivery_type, profit=profit, profitability=profitability)
+        for (mp_product_id, costprice_flag, delivery_type), (profit, profitability) in fresh_data.items()
+        if saved_data.get((mp_product_id, costprice_flag, delivery_type)) != (profit, profitability)
+    ]
+    if changed_objects:
+        ProfitabilitySnapshot.objects.bulk_create(
+            changed_objects,
+            batch_size=PROFITABILITY_UPSERT_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['mp_product', 'costprice_flag', 'order_delivery_type'],
+            update_fields=['profit', 'profitability', 'updated_at'])
+    return len(changed_objects)
@@ -59,10 +59,8 @@ class MarketplaceProductSerializer(serializers.ModelSerializer):
     logistic_cost = serializers.SerializerMethodField()
     overheads = serializers.FloatField(
         source='mp_profitability.overheads', read_only=True)
-    profit = serializers.FloatField(
-        source='mp_profitability.profit', read_only=True)
-    profitability = serializers.FloatField(
-        source='mp_profitability.profitability', read_only=True)
+    profit = serializers.SerializerMethodField()
+    profitability = serializers.SerializerMethodField()
     image = serializers.SerializerMethodField()
     profit_price = serializers.FloatField(
         source='mp_product_profit_price.profit_price', read_only=True)
@@ -87,11 +85,30 @@ class MarketplaceProductSerializer(serializers.ModelSerializer):
         elif platform_name == 'yandex market':
             return obj.product.price_product.yandex_price
         elif platform_name == 'ozon':
+            # Цены Озон могут быть загружены заранее (Prefetch с to_attr='ozon_prices')
+            if hasattr(obj.product, 'ozon_prices'):
+                return next((ozon_price.ozon_price for ozon_price in obj.product.ozon_prices
+                             if ozon_price.account_id == obj.account_id), None)
             ozon_price = obj.product.ozon_price_product.filter(
                 account=obj.account).first()
             return ozon_price.ozon_price if ozon_price else None
         return None
 
+    def get_profit(self, obj):
+        return self._profitability_value(obj, 'profit')
+
+    def get_profitability(self, obj):
+        return self._profitability_value(obj, 'profitability')
+
+    def _profitability_value(self, obj, field_name):
+        # Если к queryset подключен снимок рентабельности, значение берется из него
+        if hasattr(obj, f'snapshot_{field_name}'):
+            return getattr(obj, f'snapshot_{field_name}')
+        try:
+            return getattr(obj.mp_profitability, field_name)
+        except ProfitabilityMarketplaceProduct.DoesNotExist:
+            return None
+
     def get_commission(self, obj):
         try:
             commission = obj.marketproduct_comission
@@ -125,8 +142,11 @@ class MarketplaceProductSerializer(serializers.ModelSerializer):
         return None
 
     def get_actions(self, obj):
-        # Получаем только активные акции
-        product_in_actions = obj.product_in_action.filter(action__date_finish__gte=timezone.now().date())
+        # Получаем только активные акции, если они не загружены заранее (Prefetch с to_attr='active_actions')
+        if hasattr(obj, 'active_actions'):
+            product_in_actions = obj.active_actions
+        else:
+            product_in_actions = obj.product_in_action.filter(action__date_finish__gte=timezone.now().date())
         return MarketplaceProductInActionSerializer(product_in_actions, many=True).data
 
 
@@ -1,98 +1,86 @@
-from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_migrate, post_save
 from django.dispatch import receiver
 
-from unit_economics.integrations import (changer_price_with_profitability,
-                                         changer_profitability_calculate)
+from unit_economics.barcodes import (fill_empty_barcode_tables,
+                                     sync_marketplace_product_barcodes,
+                                     sync_product_barcodes)
+from unit_economics.invalidation import mark_profitability_changed
 from unit_economics.models import (MarketplaceCommission, MarketplaceLogistic,
-                                   MarketplaceProduct,
-                                   MarketplaceProductPriceWithProfitability,
-                                   ProductCostPrice,
+                                   MarketplaceProduct, ProductCostPrice,
                                    ProductForMarketplacePrice,
-                                   ProductOzonPrice,
-                                   ProfitabilityMarketplaceProduct)
-
-
-# @receiver(post_save, sender=MarketplaceLogistic)
-# def profitability_logistic_update(sender, instance, created, **kwargs):
-#     """
-#     Пересчет рентабельности при изменении стоимости логистики
-#     """
-#     product = instance.marketplace_product
-#     try:
-#         changer_profitability_calculate(product)
-#     except Exception as e:
-#         message = f'Не удалось обновить рентабельность для продукта при обновлении логистики: {product}. Ошибка: {e}'
-#         print(message)
-
-
-# @receiver(post_save, sender=MarketplaceCommission)
-# def profitability_comission_update(sender, instance, created, **kwargs):
-#     """
-#     Пересчет рентабельности при изменении стоимости комиссии
-#     """
-#     product = instance.marketplace_product
-#     try:
-#         changer_profitability_calculate(product)
-#     except Exception as e:
-#         message = f'Не удалось обновить рентабельность для продукта при обновлении комиссии: {product}. Ошибка: {e}'
-#         print(message)
-
-
-# @receiver(post_save, sender=ProductForMarketplacePrice)
-# def profitability_price_wb_ya_update(sender, instance, created, **kwargs):
-#     """
-#     Пересчет рентабельности при изменении цены на Яндексе и Вб
-#     """
-#     main_product = instance.product
-#     products_list = MarketplaceProduct.objects.filter(product=main_product)
-#     for product in products_list:
-#         try:
-#             changer_profitability_calculate(product)
-#         except Exception as e:
-#             message = f'Не удалось обновить рентабельность для продукта при обновлении цены: {product}. Ошибка: {e}'
-#             print(message)
-
-
-# @receiver(post_save, sender=ProductOzonPrice)
-# def profitability_price_oz_update(sender, instance, created, **kwargs):
-#     """
-#     Пересчет рентабельности при изменении цены на Озоне
-#     """
-#     main_product = instance.product
-#     products_list = MarketplaceProduct.objects.filter(product=main_product)
-#     for product in products_list:
-#         try:
-#             changer_profitability_calculate(product)
-#         except Exception as e:
-#             message = f'Не удалось обновить рентабельность для продукта: {product}. Ошибка: {e}'
-#             print(message)
-
-
-# @receiver(post_save, sender=ProfitabilityMarketplaceProduct)
-# def price_profitability_price_oz_update(sender, instance, created, **kwargs):
-#     """
-#     Пересчет цены на основе рентабельности при изменении Накладных расходов
-#     """
-#     product = instance.mp_product
-#     try:
-#         changer_price_with_profitability(product)
-#     except Exception as e:
-#         message = f'Не удалось обновить цену на основе рентабельности для продукта: {product}. Ошибка: {e}'
-#         print(message)
-
-
-# @receiver(post_save, sender=ProductCostPrice)
-# def profitability_price_oz_update(sender, instance, created, **kwargs):
-#     """
-#     Пересчет цены на основе рентабельности при изменении
-#     себестоимости Продукта по методу оприходования по FIFO
-#     """
-#     main_product = instance.product
-#     products_list = MarketplaceProduct.objects.filter(product=main_product)
-#     for product in products_list:
-#         try:
-#             changer_price_with_profitability(product)
-#         except Exception as e:
-#             message = f'Не удалось обновить цену на основе рентабельности для продукта: {product}. Ошибка: {e}'
-#             print(message)
+                                   ProductOzonPrice, ProductPrice,
+                                   StoreOverhead)
+
+
+@receiver(post_save, sender=MarketplaceProduct)
+def profitability_marketplace_product_update(sender, instance, **kwargs):
+    """
+    Пересчет рентабельности при добавлении или изменении товара маркетплейса
+    """
+    mark_profitability_changed(mp_product_ids=[instance.id])
+
+
+@receiver(post_save, sender=MarketplaceLogistic)
+@receiver(post_delete, sender=MarketplaceLogistic)
+@receiver(post_save, sender=MarketplaceCommission)
+@receiver(post_delete, sender=MarketplaceCommission)
+def profitability_comission_logistic_update(sender, instance, **kwargs):
+    """
+    Пересчет рентабельности при изменении стоимости комиссии или логистики
+    """
+    mark_profitability_changed(mp_product_ids=[instance.marketplace_product_id])
+
+
+@receiver(post_save, sender=ProductPrice)
+def profitability_costprice_table_update(sender, instance, **kwargs):
+    """
+    Пересчет рентабельности при изменении товара Мой Склад (себестоимость из таблицы)
+    """
+    mark_profitability_changed(product_ids=[instance.id])
+
+
+@receiver(post_save, sender=ProductForMarketplacePrice)
+@receiver(post_delete, sender=ProductForMarketplacePrice)
+@receiver(post_save, sender=ProductOzonPrice)
+@receiver(post_delete, sender=ProductOzonPrice)
+@receiver(post_save, sender=ProductCostPrice)
+@receiver(post_delete, sender=ProductCostPrice)
+def profitability_price_costprice_update(sender, instance, **kwargs):
+    """
+    Пересчет рентабельности при изменении цены или себестоимости (по оприходованию)
+    """
+    mark_profitability_changed(product_ids=[instance.product_id])
+
+
+@receiver(post_save, sender=StoreOverhead)
+@receiver(post_delete, sender=StoreOverhead)
+def profitability_overhead_update(sender, instance, **kwargs):
+    """
+    Пересчет рентабельности всех товаров магазина при изменении накладных расходов
+    """
+    mark_profitability_changed(account_ids=[instance.account_id])
+
+
+@receiver(post_save, sender=ProductPrice)
+def product_barcodes_update(sender, instance, created, **kwargs):
+    """
+    Синхронизация таблицы баркодов при сохранении продукта Мой Склад
+    """
+    sync_product_barcodes({instance.id: instance.barcode}, created)
+
+
+@receiver(post_save, sender=MarketplaceProduct)
+def marketplace_product_barcodes_update(sender, instance, created, **kwargs):
+    """
+    Синхронизация таблицы баркодов при сохранении продукта маркетплейса
+    """
+    sync_marketplace_product_barcodes({instance.id: instance.barcode}, created)
+
+
+@receiver(post_migrate)
+def barcode_tables_fill(sender, **kwargs):
+    """
+    Первичное заполнение таблиц баркодов при выкатке (после migrate)
+    """
+    if sender.label == 'unit_economics':
+        fill_empty_barcode_tables()
@@ -0,0 +1,34 @@
+from django.db.models import Q
+
+from analyticalplatform.celery import app
+from unit_economics.barcodes import rebuild_barcode_tables
+from unit_economics.models import MarketplaceProduct
+from unit_economics.profitability import refresh_profitability_snapshot
+
+
+def changed_marketplace_products(mp_product_ids=(), product_ids=(), account_ids=()):
+    """Товары маркетплейса, затронутые изменениями входных данных рентабельности"""
+    condition = Q(pk__in=[])
+    if mp_product_ids:
+        condition |= Q(id__in=mp_product_ids)
+    if product_ids:
+        condition |= Q(product_id__in=product_ids)
+    if account_ids:
+        condition |= Q(account_id__in=account_ids)
+    return MarketplaceProduct.objects.filter(condition)
+
+
+@app.task()
+def recalculate_changed_profitability(mp_product_ids=(), product_ids=(), account_ids=()):
+    """
+    Пересчитывает снимки рентабельности только для измененных товаров.
+    Задачу ставит unit_economics.invalidation после коммита транзакции
+    """
+    return refresh_profitability_snapshot(
+        changed_marketplace_products(mp_product_ids, product_ids, account_ids))
+
+
+@app.task()
+def rebuild_barcodes():
+    """Перестраивает таблицы баркодов по JSON полям товаров (первичное заполнение - после migrate)"""
+    return rebuild_barcode_tables()
@@ -1,23 +1,41 @@
 import logging
-import time
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
 
-import requests
 from django.db import transaction
-
-from api_requests.moy_sklad import (get_assortiment_info,
-                                    get_picture_from_moy_sklad, get_stock_info,
-                                    moy_sklad_assortment, moy_sklad_bundle_components, moy_sklad_enter,
-                                    moy_sklad_positions_enter, moy_sklad_product_info,
+from django.utils import timezone
+
+from analyticalplatform.integrations import bulk_create_objects, bulk_upsert
+from analyticalplatform.settings import IMPORT_CHUNK_SIZE
+from api_requests import client, fetch
+from api_requests.moy_sklad import (get_picture_from_moy_sklad, get_stock_info,
+                                    moy_sklad_assortment_all_pages,
+                                    moy_sklad_assortment_pages,
+                                    moy_sklad_enter_pages, moy_sklad_positions_enter,
                                     picture_href_request)
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform
 # from unit_economics.integrations import sender_error_to_tg
-from unit_economics.models import (PostingGoods, ProductCostPrice,
+from unit_economics.barcodes import sync_product_barcodes
+from unit_economics.bundles import BundleCostResolver, moy_sklad_id_from_href
+from unit_economics.invalidation import mark_profitability_changed
+from unit_economics.models import (ImportWatermark, PostingGoods, ProductCostPrice,
                                    ProductForMarketplacePrice,
                                    ProductOzonPrice, ProductPrice)
 
 logger = logging.getLogger(__name__)
 
+MOY_SKLAD_ASSORTMENT_SOURCE = 'moy_sklad_assortment'
+# Как часто инкрементальная загрузка сверяет полный список товаров
+MOY_SKLAD_RECONCILE_INTERVAL = timedelta(days=7)
+MOY_SKLAD_ENTERS_SOURCE = 'moy_sklad_enters'
+# Сколько оприходований одновременно запрашивают позиции: больше, чем пропускает
+# ограничение одновременных запросов токена в api_requests.client, смысла нет
+ENTER_POSITIONS_CONCURRENCY = client.CONCURRENCY_LIMITS[client.MOY_SKLAD]
+# Сколько строк оприходований читается из базы за раз при расчете себестоимости
+COST_PRICE_STREAM_CHUNK_SIZE = 10000
+
 OZON_ACCOUNT_NAME = {
     'ОЗОН Evium': 'Ozon Envium',
     'ОЗОН Combo': 'Озон Комбо',
@@ -26,164 +44,225 @@ OZON_ACCOUNT_NAME = {
 
 
 # @sender_error_to_tg
-def moy_sklad_add_data_to_db():
+def moy_sklad_add_data_to_db(full=False):
     """
     Записывает данные Мой Склад в базу данных
 
+    Загружаются только товары, измененные с прошлой загрузки
+    (фильтр updated>= по отметке ImportWatermark). Без отметки или с full=True
+    загружается весь ассортимент. Раз в MOY_SKLAD_RECONCILE_INTERVAL
+    сверяется полный список id, чтобы найти удаленные товары.
+
     Входящие переменные:
-        TOKEN_MY_SKLAD - токен учетной записи
-        account - объект модели Account
+        full - загрузить весь ассортимент, а не только изменения
     """
     accounts_ms = Account.objects.filter(
         platform=Platform.objects.get(
             platform_type=MarketplaceChoices.MOY_SKLAD)
     )
-    account_names = []
-    accounts = Account.objects.all().values('name')
-    for acc_obj in accounts:
-        account_names.append(acc_obj['name'])
+    # Аккаунты Озон для цен ищутся по названию
+    account_names = dict(Account.objects.values_list('name', 'id'))
 
     for account in accounts_ms:
         token_ms = account.authorization_fields['token']
-        products_data_list = moy_sklad_assortment(token_ms)
-        product_data = []
-        x = len(products_data_list)
-        print(x)
-        if products_data_list:
-            for item in products_data_list:
-                # Добавляем продукты и информацию о них в список
-                attributes_list = item['attributes']
-                brand = ''
-                code = item.get('code', '')
-                try:
-                    for attribute in attributes_list:
-                        if attribute['name'] == 'Бренд':
-                            brand = attribute['value']
-                    # Извлечение цен
-                    sale_prices_list = item.get('salePrices', [])
-                    wb_price_after_discount = ''
-                    for price in sale_prices_list:
-                        if price['priceType']['name'] == 'Цена РРЦ МС':
-                            wb_price_after_discount = price['value']
-                    # Добавление фотографии
-                    photo_link = picture_href_request(
-                        token_ms, item['images']['meta']['href'])
-                    image_filename = ''
-                    image_content = ''
-                    if photo_link:
-                        image_filename, image_content = get_picture_from_moy_sklad(
-                            token_ms, photo_link)
-
-                    # Извлечение себестоимости
-                    if item['meta']['type'] == 'product':
-                        cost_price = item.get('buyPrice', {}).get(
-                            'value', 0)  # Используем 0 как дефолтное значение
-
-                    elif item['meta']['type'] == 'bundle':
-                        components_url = item['components']['meta']['href']
-                        headers = {
-                            'Authorization': f'Bearer {token_ms}',
-                            'Accept-Encoding': 'gzip',
-                            'Content-Type': 'application/json'
-                        }
-                        try:
-                            response = requests.get(
-                                components_url, headers=headers, timeout=200)
-                        except:
-                            time.sleep(10)
-                            response = requests.get(
-                                components_url, headers=headers, timeout=500)
-
-                        if response.status_code == 200:
-                            components_data = response.json()
-                            total_cost_price = 0
-                            list_url_products = []
-                            for component in components_data.get('rows', []):
-                                product_url = component['assortment']['meta']['href']
-                                quantity = component.get('quantity')
-                                list_url_products.append((product_url, quantity))
-
-                            for product_url, quantity in list_url_products:
-                                time.sleep(1)
-                                try:
-                                    response_url = requests.get(
-                                    product_url, headers=headers, timeout=200)
-                                except:
-                                    time.sleep(10)
-                                    response_url = requests.get(
-                                        product_url, headers=headers, timeout=500)
-                                if response_url.status_code == 200:
-                                    cost_price_data = response_url.json()
-                                    total_cost_price += cost_price_data.get(
-                                        'buyPrice', {}).get('value', 0) * quantity
-                                else:
-                                    message = f'Ошибка при вызове метода (продукт): {response_url.status_code}. {response_url.text}'
-                                    print(message)
-                                    total_cost_price = None
-                                    break  # Прекращаем суммирование, если есть ошибка
-
-                            cost_price = total_cost_price
-
-                        else:
-                            message = f'Ошибка при вызове метода (компоненты): {response.status_code}. {response.text}'
-                            print(message)
-                            cost_price = None
-                    else:
-                        cost_price = None
-                    common_cost_price = cost_price/100
-                    if cost_price:
-                        common_cost_price = cost_price/100
-                    else:
-                        common_cost_price = 0
-
-                    if ProductPrice.objects.filter(
-                            account=account,
-                            moy_sklad_product_number=item.get('id', '')).exists():
-                        ProductPrice.objects.filter(
-                            account=account,
-                            moy_sklad_product_number=item.get('id', '')).update(
-                            name=item.get('name', ''),
-                            code=code,
-                            barcode=[list(barcode.values())[0]
-                                     for barcode in item.get('barcodes', [])],
-
-                            cost_price=common_cost_price,
-                            brand=brand,
-                            vendor=item.get('article', '')
-                        )
-                    else:
-                        ProductPrice(
-                            account=account,
-                            moy_sklad_product_number=item.get('id', ''),
-                            code=code,
-                            name=item.get('name', ''),
-                            brand=brand,
-                            vendor=item.get('article', ''),
-                            barcode=[list(barcode.values())[0]
-                                     for barcode in item.get('barcodes', [])],
-                            product_type=item['meta'].get('type'),
-                            cost_price=common_cost_price
-                        ).save()
-
-                    product_obj = ProductPrice.objects.get(
-                        account=account,
-                        barcode=[list(barcode.values())[0]
-                                 for barcode in item.get('barcodes', [])],
-                        moy_sklad_product_number=item.get('id', ''))
-                    price_for_marketplace_from_moysklad(
-                        product_obj, item['salePrices'], account_names)
-                    if image_filename:
-                        product_obj.image.save(
-                            image_filename, image_content)
-                    x -= 1
-                    print(x)
-                except Exception as e:
-                    print(f'Ошибка на артикуле {code}: {e}')
+        watermark, _ = ImportWatermark.objects.get_or_create(
+            account=account, source=MOY_SKLAD_ASSORTMENT_SOURCE)
+        updated_from = None if full else watermark.value
+        try:
+            watermark.value = moy_sklad_import_assortment(
+                account, token_ms, account_names, updated_from)
+            if not updated_from or watermark.full_sync_due(MOY_SKLAD_RECONCILE_INTERVAL):
+                # После полной загрузки комплекты уже пересчитаны
+                moy_sklad_reconcile_assortment(account, token_ms, refresh_bundles=bool(updated_from))
+                watermark.last_full_sync = timezone.now()
+        except fetch.FetchError as e:
+            logger.warning(f'Не удалось загрузить ассортимент Мой Склад аккаунта {account}: {e}')
+            continue
+        watermark.save()
+
+
+def moy_sklad_import_assortment(account, token_ms, account_names, updated_from=None):
+    """
+    Загружает товары и комплекты Мой Склад, измененные начиная с updated_from
+    (все, если не задано), и записывает их в базу данных.
+
+    Возвращает отметку для следующей загрузки: наибольшее поле updated
+    среди товаров, а если часть товаров записать не удалось - наименьшее
+    updated среди них, чтобы в следующий раз они загрузились снова
+    """
+    resolver = BundleCostResolver(token_ms)
+    bundles = []
+    newest = updated_from
+    oldest_failed = None
+
+    def write(item, cost_price):
+        nonlocal newest, oldest_failed
+        updated = item.get('updated')
+        if not moy_sklad_product_to_db(account, token_ms, item, cost_price, account_names):
+            if updated and (oldest_failed is None or updated < oldest_failed):
+                oldest_failed = updated
+        if updated and (newest is None or updated > newest):
+            newest = updated
+
+    pages = fetch.iterate(moy_sklad_assortment_pages(token_ms, updated_from=updated_from))
+    for chunk in fetch.chunks(pages, IMPORT_CHUNK_SIZE):
+        for item in chunk:
+            resolver.add_assortment_item(item)
+            if item['meta']['type'] == 'bundle':
+                # Комплекты считаем после товаров: их компоненты обычно уже скачаны
+                bundles.append(item)
+                continue
+            if item['meta']['type'] == 'product':
+                cost_price = item.get('buyPrice', {}).get('value', 0)
+            else:
+                cost_price = None
+            write(item, cost_price)
+
+    bundle_costs = resolver.resolve([item['id'] for item in bundles])
+    for item in bundles:
+        write(item, bundle_costs[item['id']])
+    return oldest_failed or newest
+
+
+def moy_sklad_reconcile_assortment(account, token_ms, refresh_bundles=True):
+    """
+    Сверяет полный список товаров Мой Склад (включая архивные) с базой данных:
+    удаляет продукты, которых больше нет в Моем Складе, и при refresh_bundles
+    пересчитывает закупочную стоимость комплектов - их updated не меняется,
+    когда меняются цены компонентов
+    """
+    resolver = BundleCostResolver(token_ms)
+    moy_sklad_ids = set()
+    bundle_ids = []
+    for page in fetch.iterate(moy_sklad_assortment_all_pages(token_ms)):
+        for item in page:
+            moy_sklad_ids.add(item['id'])
+            resolver.add_assortment_item(item)
+            if item['meta']['type'] == 'bundle':
+                bundle_ids.append(item['id'])
+
+    # Пустой ассортимент скорее ошибка API или прав токена, чем удаление всех товаров:
+    # каскадом удалились бы товары маркетплейсов, цены и оприходования аккаунта
+    if not moy_sklad_ids:
+        logger.warning(f'Ассортимент Мой Склад аккаунта {account} пуст, удаление продуктов пропущено')
+    else:
+        deleted, _ = ProductPrice.objects.filter(
+            account=account, moy_sklad_product_number__isnull=False
+        ).exclude(moy_sklad_product_number__in=moy_sklad_ids).delete()
+        if deleted:
+            logger.info(f'Удалено продуктов Мой Склад аккаунта {account}: {deleted}')
+
+    if not refresh_bundles:
+        return
+    bundle_pks = dict(ProductPrice.objects.filter(
+        account=account, moy_sklad_product_number__in=bundle_ids
+    ).values_list('moy_sklad_product_number', 'id'))
+    bundle_costs = resolver.resolve(list(bundle_pks))
+    changed_ids = []
+    for bundle in ProductPrice.objects.filter(id__in=bundle_pks.values()):
+        cost = bundle_costs[bundle.moy_sklad_product_number]
+        if cost is None:
+            continue
+        cost_price = cost/100 if cost else 0
+        if bundle.cost_price != cost_price:
+            ProductPrice.objects.filter(id=bundle.id).update(cost_price=cost_price)
+            changed_ids.append(bundle.id)
+    if changed_ids:
+        mark_profitability_changed(product_ids=changed_ids)
+
+
+def moy_sklad_product_to_db(account, token_ms, item, cost_price, account_names):
+    """
+    Записывает товар или комплект Мой Склад в базу данных
+
+    Входящие переменные:
+        account - аккаунт Мой Склад
+        token_ms - токен учетной записи
+        item - товар из ответа ассортимента
+        cost_price - закупочная цена в копейках или None
+        account_names - словарь {название аккаунта: id аккаунта}
+
+    Возвращает False, если товар записать не удалось
+    """
+    attributes_list = item['attributes']
+    brand = ''
+    code = item.get('code', '')
+    try:
+        for attribute in attributes_list:
+            if attribute['name'] == 'Бренд':
+                brand = attribute['value']
+        # Добавление фотографии
+        photo_link = picture_href_request(
+            token_ms, item['images']['meta']['href'])
+        image_filename = ''
+        image_content = ''
+        if photo_link:
+            image_filename, image_content = get_picture_from_moy_sklad(
+                token_ms, photo_link)
+
+        if cost_price:
+            common_cost_price = cost_price/100
+        else:
+            common_cost_price = 0
+
+        if ProductPrice.objects.filter(
+                account=account,
+                moy_sklad_product_number=item.get('id', '')).exists():
+            ProductPrice.objects.filter(
+                account=account,
+                moy_sklad_product_number=item.get('id', '')).update(
+                name=item.get('name', ''),
+                code=code,
+                barcode=[list(barcode.values())[0]
+                         for barcode in item.get('barcodes', [])],
+
+                cost_price=common_cost_price,
+                brand=brand,
+                vendor=item.get('article', '')
+            )
+        else:
+            ProductPrice(
+                account=account,
+                moy_sklad_product_number=item.get('id', ''),
+                code=code,
+                name=item.get('name', ''),
+                brand=brand,
+                vendor=item.get('article', ''),
+                barcode=[list(barcode.values())[0]
+                         for barcode in item.get('barcodes', [])],
+                product_type=item['meta'].get('type'),
+                cost_price=common_cost_price
+            ).save()
+
+        product_obj = ProductPrice.objects.get(
+            account=account,
+            barcode=[list(barcode.values())[0]
+                     for barcode in item.get('barcodes', [])],
+            moy_sklad_product_number=item.get('id', ''))
+        # update() не отправляет post_save, баркоды и себестоимость обновляем явно
+        sync_product_barcodes({product_obj.id: product_obj.barcode})
+        mark_profitability_changed(product_ids=[product_obj.id])
+        price_for_marketplace_from_moysklad(
+            product_obj, item['salePrices'], account_names)
+        if image_filename:
+            product_obj.image.save(
+                image_filename, image_content)
+    except Exception as e:
+        print(f'Ошибка на артикуле {code}: {e}')
+        return False
+    return True
 
 
 # @sender_error_to_tg
 def price_for_marketplace_from_moysklad(product_obj, price_info, accounts_names):
-    """"Записывает цены для маркетплейсов с Мой Склад"""
+    """
+    Записывает цены для маркетплейсов с Мой Склад
+
+    Входящие переменные:
+        product_obj - продукт ProductPrice
+        price_info - цены продажи товара из ответа ассортимента
+        accounts_names - словарь {название аккаунта: id аккаунта}
+    """
     rrc = 0
     wb_price = 0
     yandex_price = 0
@@ -204,34 +283,33 @@ def price_for_marketplace_from_moysklad(product_obj, price_info, accounts_names)
                 if OZON_ACCOUNT_NAME[price_account] in accounts_names:
                     difficult_price_data[OZON_ACCOUNT_NAME[price_account]
                                          ] = data['value']/100
-    print(product_obj, yandex_price)
-    search_params = {'product': product_obj}
-    values_for_update = {
-        "wb_price": wb_price,
-        "yandex_price": yandex_price,
-        "rrc": rrc
-    }
-    ProductForMarketplacePrice.objects.update_or_create(
-        defaults=values_for_update, **search_params
-    )
-    for account_name, price in difficult_price_data.items():
-        search_params = {'product': product_obj,
-                         'account': Account.objects.get(name=account_name)}
-        values_for_update = {
-            "ozon_price": price
-        }
-        ProductOzonPrice.objects.update_or_create(
-            defaults=values_for_update, **search_params
-        )
+    # Профиль рентабельности помечает вызывающий код (moy_sklad_product_to_db)
+    bulk_upsert(ProductForMarketplacePrice, [{
+        'product_id': product_obj.id,
+        'wb_price': wb_price,
+        'yandex_price': yandex_price,
+        'rrc': rrc,
+    }], unique_fields=['product_id'])
+    bulk_upsert(ProductOzonPrice, [
+        {'product_id': product_obj.id, 'account_id': accounts_names[account_name], 'ozon_price': price}
+        for account_name, price in difficult_price_data.items()
+    ], unique_fields=['product_id', 'account_id'])
 
 
 # @sender_error_to_tg
-def moy_sklad_enters_calculate():
+def moy_sklad_enters_calculate(full=False):
     """
     Записывает поставки товаров Их Моего Склада в базу данных
     Считает поставки товара на Мой Склад.
 
-    Возвращает словарь вида:
+    Загружаются только оприходования, измененные с прошлой загрузки
+    (фильтр updated>= по отметке ImportWatermark), без отметки или
+    с full=True - все (moy_sklad_import_enters).
+
+    Входящие переменные:
+        full - загрузить все оприходования, а не только изменения
+
+    Возвращает словарь новых поставок вида:
     {account:
         {code:
             {
@@ -254,7 +332,6 @@ def moy_sklad_enters_calculate():
         account - текущий аккаунт на Мой Склад
         code - обозначение артикула в Мой Склад
         moy_sklad_id - id товара в Мой Склад
-        brand - бренд артикула
         enter_date - дата поставки
         price - стоимость поставки
         quantity - количество артикула в текущей поставке
@@ -267,81 +344,105 @@ def moy_sklad_enters_calculate():
     main_retuned_dict = {}
     for account in accounts_ms:
         token_ms = account.authorization_fields['token']
-        enters_list_raw = moy_sklad_enter(token_ms)
-        enters_list = sorted(
-            enters_list_raw, key=lambda x: x['moment'], reverse=True)
-        enter_main_data = {}
-        # print(len(enters_list))
-
-        x = len(enters_list)
-        print(len(enters_list))
-        for enter in enters_list:
-            enter_id = enter['id']
-            x -= 1
-            print(x)
-            if PostingGoods.objects.filter(enter_number=enter_id).exists():
-                print('Должен пропустить')
-                continue
-            else:
-                if 'moment' in enter:
-                    enter_date = enter['moment']
-                    positions = moy_sklad_positions_enter(token_ms, enter_id)
-                    for position in positions:
-                        position_id = position['id']
-                        if PostingGoods.objects.filter(position_number=position_id).exists():
-                            continue
-                        else:
-                            api_url = position['assortment']['meta']['href']
-                            assortiment_data = get_assortiment_info(
-                                token_ms, api_url)
-                            if assortiment_data:
-                                if assortiment_data['archived'] == False:
-                                    moy_sklad_id = assortiment_data['id']
-                                    quantity = position.get('quantity', 0)
-                                    price = position.get('price', 0)
-                                    overhead = position.get('overhead', 0)
-
-                                    if 'code' in assortiment_data and quantity != 0 and price != 0:
-                                        article = assortiment_data['code']
-                                        if ProductPrice.objects.filter(moy_sklad_product_number=moy_sklad_id).exists():
-                                            product_obj = ProductPrice.objects.get(
-                                                moy_sklad_product_number=moy_sklad_id)
-
-                                            PostingGoods(
-                                                account=account,
-                                                enter_number=enter_id,
-                                                position_number=position_id,
-                                                product=product_obj,
-                                                code=article,
-                                                receipt_date=enter_date,
-                                                amount=quantity,
-                                                price=price,
-                                                costs=overhead
-                                            ).save()
-                                            if article not in enter_main_data:
-                                                enter_main_data[article] = {
-                                                    'article_data':
-                                                        {
-                                                            'moy_sklad_id': moy_sklad_id
-                                                        },
-                                                    'enter_data': [
-                                                        {
-                                                            'date': enter_date,
-                                                            'price': price,
-                                                            'quantity': quantity,
-                                                            'overhead': overhead
-                                                        }]}
-                                            else:
-                                                enter_main_data[article]['enter_data'].append({
-                                                    'date': enter_date,
-                                                    'price': price,
-                                                    'quantity': quantity,
-                                                    'overhead': overhead
-                                                })
+        watermark, _ = ImportWatermark.objects.get_or_create(
+            account=account, source=MOY_SKLAD_ENTERS_SOURCE)
+        updated_from = None if full else watermark.value
+        try:
+            enter_main_data, watermark.value = moy_sklad_import_enters(account, token_ms, updated_from)
+        except fetch.FetchError as e:
+            logger.warning(f'Не удалось загрузить оприходования Мой Склад аккаунта {account}: {e}')
+            continue
+        watermark.save()
         main_retuned_dict[account] = enter_main_data
     return main_retuned_dict
 
 
+def moy_sklad_import_enters(account, token_ms, updated_from=None):
+    """
+    Записывает новые позиции оприходований Мой Склад, измененных начиная
+    с updated_from (всех, если не задано), в базу данных.
+
+    Продукты аккаунта и уже записанные позиции загружаются заранее,
+    позиции оприходований пачки запрашиваются параллельно, новые
+    записываются одной пачкой. При полной загрузке оприходования, которые
+    уже есть в базе, не перечитываются.
+
+    Возвращает (новые поставки по артикулам, отметку для следующей загрузки).
+    Отметка - наибольшее updated среди оприходований, а если позиции части
+    оприходований получить не удалось - наименьшее updated среди них
+    """
+    products = {
+        moy_sklad_id: (product_id, code)
+        for moy_sklad_id, product_id, code in ProductPrice.objects.filter(
+            account=account, moy_sklad_product_number__isnull=False
+        ).values_list('moy_sklad_product_number', 'id', 'code')
+    }
+    enter_main_data = {}
+    newest = updated_from
+    oldest_failed = None
+
+    # Оприходования приходят от новых к старым пачками по IMPORT_CHUNK_SIZE
+    pages = fetch.iterate(moy_sklad_enter_pages(token_ms, updated_from=updated_from))
+    for chunk in fetch.chunks(pages, IMPORT_CHUNK_SIZE):
+        existing_enters = set()
+        existing_positions = set()
+        for enter_number, position_number in PostingGoods.objects.filter(
+                account=account, enter_number__in=[enter['id'] for enter in chunk]
+        ).values_list('enter_number', 'position_number'):
+            existing_enters.add(enter_number)
+            existing_positions.add(position_number)
+        enters = [enter for enter in chunk
+                  if 'moment' in enter and (updated_from or enter['id'] not in existing_enters)]
+        enters_positions = fetch.run_parallel(
+            moy_sklad_positions_enter, [(token_ms, enter['id']) for enter in enters],
+            ENTER_POSITIONS_CONCURRENCY)
+
+        new_postings = []
+        for enter, positions in zip(enters, enters_positions):
+            if positions is None:
+                updated = enter.get('updated')
+                if updated and (oldest_failed is None or updated < oldest_failed):
+                    oldest_failed = updated
+                continue
+            for position in positions:
+                if position['id'] in existing_positions:
+                    continue
+                moy_sklad_id = moy_sklad_id_from_href(position['assortment']['meta']['href'])
+                product_id, article = products.get(moy_sklad_id, (None, None))
+                quantity = position.get('quantity', 0)
+                price = position.get('price', 0)
+                overhead = position.get('overhead', 0)
+                if not product_id or not article or quantity == 0 or price == 0:
+                    continue
+                new_postings.append(PostingGoods(
+                    account=account,
+                    enter_number=enter['id'],
+                    position_number=position['id'],
+                    product_id=product_id,
+                    code=article,
+                    receipt_date=enter['moment'],
+                    amount=quantity,
+                    price=price,
+                    costs=overhead
+                ))
+                enter_main_data.setdefault(article, {
+                    'article_data': {'moy_sklad_id': moy_sklad_id},
+                    'enter_data': [],
+                })['enter_data'].append({
+                    'date': enter['moment'],
+                    'price': price,
+                    'quantity': quantity,
+                    'overhead': overhead
+                })
+        bulk_create_objects(PostingGoods, new_postings, ignore_conflicts=True)
+
+        for enter in chunk:
+            updated = enter.get('updated')
+            if updated and (newest is None or updated > newest):
+                newest = updated
+    return enter_main_data, oldest_failed or newest
+
+
 # @sender_error_to_tg
 def moy_sklad_stock_data():
     """
@@ -376,143 +477,118 @@ def moy_sklad_stock_data():
     return main_retuned_dict
 
 
+def fifo_cost_prices(postings, stocks):
+    """
+    Считает себестоимость товаров методом оприходования за один проход.
+
+    Поставки артикула перебираются от новых к старым, пока их количество
+    не покроет текущий остаток: себестоимость берется по этой поставке
+    (самой старой из лежащих на складе). Если остатка нет в Моем Складе -
+    по последней поставке, если поставок меньше остатка - по самой старой.
+    Одинаковые поставки (дата, цена, количество, расходы) считаются один раз.
+
+    Входящие переменные:
+        postings - итерируемое кортежей (account_id, code, product_id,
+            receipt_date, price, amount, costs), упорядоченное по account_id,
+            code и receipt_date по убыванию
+        stocks - словарь {account_id: {code: остаток}}
+
+    Возвращает генератор словарей {'product_id': id продукта, 'cost_price': себестоимость}
+    """
+    for (account_id, code), lots in groupby(postings, key=itemgetter(0, 1)):
+        stock = stocks.get(account_id, {}).get(code)
+        product_id = None
+        lot = None
+        covered = 0
+        seen = set()
+        for _, _, lot_product_id, receipt_date, price, amount, costs in lots:
+            if (receipt_date, price, amount, costs) in seen:
+                continue
+            seen.add((receipt_date, price, amount, costs))
+            if product_id is None:
+                product_id = lot_product_id
+            lot = (price, amount, costs)
+            covered += amount
+            if stock is None or covered >= stock:
+                # Остальные поставки артикула groupby пропустит сам
+                break
+        price, amount, costs = lot
+        if amount > 0:
+            yield {'product_id': product_id, 'cost_price': (price + costs/amount) / 100}
+
+
+def cost_price_postings(queryset):
+    """
+    Возвращает оприходования queryset кортежами для fifo_cost_prices
+    в нужном порядке. Строки читаются серверным курсором пачками
+    по COST_PRICE_STREAM_CHUNK_SIZE без создания объектов моделей
+    """
+    return queryset.order_by(
+        'account_id', 'code', '-receipt_date', 'id'
+    ).values_list(
+        'account_id', 'code', 'product_id', 'receipt_date', 'price', 'amount', 'costs'
+    ).iterator(chunk_size=COST_PRICE_STREAM_CHUNK_SIZE)
+
+
 # @sender_error_to_tg
 def moy_sklad_costprice_calculate():
     """
-    Считает себестоимость товаров методом оприходования
+    Считает себестоимость товаров методом оприходования (fifo_cost_prices).
+
+    Оприходования читаются из базы данных потоком (cost_price_postings).
+    Возвращает генератор словарей {'product_id': id продукта, 'cost_price': себестоимость}
     """
-    # enters_data = moy_sklad_enters_calculate()
-    stock_data = moy_sklad_stock_data()
-    enters_data = {}
-    account_cost_price_data = {}
-    # Достает все записи из таблицы оприходования
-    main_data = PostingGoods.objects.all()
-    for data in main_data:
-        # Создаем внутренний словарь вида {'date': дата_поставки, 'price': Цена_при_поставке,
-        # 'quantity': количество_при_поставке, 'overhead': накладные_расходы}
-        inner_dict = {
-            'date': data.receipt_date,
-            'price': data.price,
-            'quantity': data.amount,
-            'overhead': data.costs
-        }
-        if data.account not in enters_data:
-            # Для каждого артикула (code) создаем словарь вида:
-            # {'article_data': {'product': product_obj (таблицы ProductPrice)},
-            #  'enter_data': [список из данных о каждой поставке артикула из inner_dict]}
-            enters_data[data.account] = {
-                data.code: {
-                    'article_data': {
-                        'product': data.product
-                    },
-                    'enter_data': [inner_dict]
-                }
-            }
-        else:
-            if data.code not in enters_data[data.account]:
-                enters_data[data.account][data.code] = {
-                    'article_data': {
-                        'product': data.product
-                    },
-                    'enter_data': [inner_dict]
-                }
+    stocks = {account.id: account_stocks for account, account_stocks in moy_sklad_stock_data().items()}
+    return fifo_cost_prices(cost_price_postings(PostingGoods.objects.all()), stocks)
 
-            else:
-                if inner_dict not in enters_data[data.account][data.code]['enter_data']:
-                    enters_data[data.account][data.code]['enter_data'].append(
-                        inner_dict)
-   
-    for account, code_data in enters_data.items():
-        code_list = []
-        for code, article_info in code_data.items():
-            enters_data_list = article_info['enter_data']
-            sorted_enters_data_list = sorted(
-                enters_data_list, key=lambda x: x['date'], reverse=True)
-            summ = 0
-            amount = 0
-            overhead = 0
-            price = 0
-            if code in stock_data[account]:
-                
-                # Считаем данные по мотоду оприходования
-                for index, enter_data in enumerate(sorted_enters_data_list):
-                    summ += enter_data['quantity']
-                    if summ >= stock_data[account][code]:
-                        overhead = enter_data['overhead']
-                        amount = enter_data['quantity']
-                        price = enter_data['price']
-                        continue
-                    elif summ < stock_data[account][code] and index == len(sorted_enters_data_list) - 1:
-                        overhead = enter_data['overhead']
-                        amount = enter_data['quantity']
-                        price = enter_data['price']
-            else:
-                if len(sorted_enters_data_list) > 0:
-                    overhead = sorted_enters_data_list[0]['overhead']
-                    amount = sorted_enters_data_list[0]['quantity']
-                    price = sorted_enters_data_list[0]['price']
-
-            if amount > 0:
-                cost_price = (price + overhead/amount) / 100
-                inner_dict = {
-                    'product': article_info['article_data']['product'], 'cost_price': cost_price}
-                code_list.append(inner_dict)
-        account_cost_price_data[account] = code_list
-    return account_cost_price_data
 
 def moy_sklad_costprice_calculate_for_bundle():
     """
-    Считает себестоимость товаров методом оприходования для комплектов
+    Считает себестоимость комплектов методом оприходования и записывает в базу данных
+
+    Составы комплектов аккаунта запрашиваются параллельно (BundleCostResolver),
+    себестоимость компонентов считается fifo_cost_prices по оприходованиям
+    всех компонентов одним запросом, комплекты записываются одной пачкой.
+    Комплекты, состав которых не получен, не пересчитываются
     """
     accounts_ms = Account.objects.filter(
         platform=Platform.objects.get(
             platform_type=MarketplaceChoices.MOY_SKLAD)
     )
-    stock_data = moy_sklad_stock_data()
+    stocks = {account.id: account_stocks for account, account_stocks in moy_sklad_stock_data().items()}
     for account in accounts_ms:
         token_ms = account.authorization_fields['token']
-        
+        bundles = dict(ProductPrice.objects.filter(
+            account=account, product_type='bundle'
+        ).values_list('moy_sklad_product_number', 'id'))
+        bundles_components = BundleCostResolver(token_ms).components(list(bundles))
+
+        component_numbers = {
+            moy_sklad_id_from_href(component['assortment']['meta']['href'])
+            for components in bundles_components.values() if components
+            for component in components
+        }
+        component_products = dict(ProductPrice.objects.filter(
+            account=account, moy_sklad_product_number__in=component_numbers
+        ).values_list('moy_sklad_product_number', 'id'))
+        component_costs = {
+            row['product_id']: row['cost_price'] for row in fifo_cost_prices(
+                cost_price_postings(PostingGoods.objects.filter(
+                    product_id__in=component_products.values())), stocks)
+        }
 
-        products_list = ProductPrice.objects.filter(product_type='bundle')
-        stock_account = stock_data[account]
-        ids_code_bundle_list = {}
-        for data in products_list:
-            components = moy_sklad_bundle_components(token_ms, data.moy_sklad_product_number)
-            data_costprice = 0
+        rows = []
+        for moy_sklad_id, bundle_id in bundles.items():
+            components = bundles_components[moy_sklad_id]
+            if components is None:
+                continue
+            cost_price = 0
             for component in components:
-                product_link  =component['assortment']['meta']['href']
-                component_data = moy_sklad_product_info(token_ms, product_link)
-                component_moy_sklad_product_number = component_data['id']
-                component_code = component_data['code']
-                component_amount = component['quantity']
-                component_costprice = 0
-                component_enter_data = PostingGoods.objects.filter(product__moy_sklad_product_number=component_moy_sklad_product_number).order_by('-receipt_date')
-                # print('component_code', component_code)
-                # print('component_enter_data', component_enter_data)
-                for index, component_enter in enumerate(component_enter_data):    
-                    if component_code in stock_account:
-                        code_stock = stock_account[component_code]
-                        common_amount = 0
-
-                        # for component_enter in component_enter_data:
-                        common_amount += component_enter.amount
-                        if common_amount > code_stock:
-                            component_costprice = component_enter.price + component_enter.costs/component_enter.amount
-                        elif common_amount < code_stock and index == len(component_enter_data) - 1:
-                            component_costprice = component_enter.price + component_enter.costs/component_enter.amount
-                        
-                    else:
-                        component_costprice = component_enter.price + component_enter.costs/component_enter.amount
-                
-                # print(component_code, component_costprice/100)
-                data_costprice += component_costprice/100 * component_amount
-            if ProductCostPrice.objects.filter(product=data).exists():
-                print('существует', data)
-                cp_obj = ProductCostPrice.objects.get(product=data)
-                cp_obj.cost_price = round(data_costprice, 2)
-                cp_obj.save()
-            else:
-                print('Сохранил заново', data)
-                ProductCostPrice(product=data,
-                cost_price=round(data_costprice, 2)
-                ).save()
+                product_id = component_products.get(
+                    moy_sklad_id_from_href(component['assortment']['meta']['href']))
+                # Без оприходований компонент в себестоимость не входит
+                cost_price += component_costs.get(product_id, 0) * component.get('quantity', 0)
+            rows.append({'product_id': bundle_id, 'cost_price': round(cost_price, 2)})
+        bulk_upsert(ProductCostPrice, rows, unique_fields=['product_id'])
+        # bulk_upsert не отправляет post_save
+        mark_profitability_changed(product_ids=[row['product_id'] for row in rows])
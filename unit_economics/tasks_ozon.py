@@ -2,16 +2,20 @@ import logging
 from datetime import datetime
 import math
 
+from analyticalplatform.integrations import bulk_upsert
+from analyticalplatform.settings import IMPORT_CHUNK_SIZE
+from api_requests import fetch
 from api_requests.ozon_requests import (ozon_actions_list,
-                                        ozon_actions_product_price_info,
+                                        ozon_actions_product_price_pages,
                                         ozon_product_info_with_sku_data,
-                                        ozon_products_comission_info_from_api,
-                                        ozon_products_info_from_api)
+                                        ozon_products_comission_info_pages,
+                                        ozon_products_info_pages)
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform, User
-from unit_economics.integrations import (add_marketplace_comission_to_db,
-                                         add_marketplace_logistic_to_db,
-                                         add_marketplace_product_to_db, sender_error_to_tg)
+from unit_economics.integrations import (add_marketplace_comissions_to_db,
+                                         add_marketplace_logistics_to_db,
+                                         add_marketplace_products_to_db, sender_error_to_tg,
+                                         update_marketplace_products_activity)
 from unit_economics.models import (MarketplaceAction, MarketplaceCommission, MarketplaceLogistic, MarketplaceProduct,
                                    MarketplaceProductInAction,
                                    ProductOzonPrice, ProductPrice)
@@ -25,10 +29,9 @@ def ozon_price_articles(TOKEN_OZON, OZON_ID):
     """
     Возвращает словарь типа {product_id: price_after_discount}
     """
-    data_list = ozon_products_comission_info_from_api(TOKEN_OZON, OZON_ID)
     price_dict = {}
-    if data_list:
-        for data in data_list:
+    for page in fetch.iterate(ozon_products_comission_info_pages(TOKEN_OZON, OZON_ID)):
+        for data in page:
             price_dict[data['product_id']] = data['price']['price']
     return price_dict
 
@@ -38,65 +41,69 @@ def ozon_comission_logistic_add_data_to_db():
     """
     Записывает комиссии и затрат на логистику OZON в базу данных
     """
-
+    platform = Platform.objects.get(
+        platform_type=MarketplaceChoices.OZON)
     users = User.objects.all()
     for user in users:
         accounts_oz = Account.objects.filter(
             user=user,
-            platform=Platform.objects.get(
-                platform_type=MarketplaceChoices.OZON)
+            platform=platform
         )
         for account in accounts_oz:
             ozon_token = account.authorization_fields['token']
             ozon_client_id = account.authorization_fields['client_id']
-            data_list = ozon_products_comission_info_from_api(
-                ozon_token, ozon_client_id)
-
-            for data in data_list:
-                try:
-                    if MarketplaceProduct.objects.filter(
-                            account=account,
-                            platform=Platform.objects.get(
-                                platform_type=MarketplaceChoices.OZON),
-                            sku=data['product_id']).exists():
-                        product_obj = MarketplaceProduct.objects.filter(
-                            account=account,
-                            platform=Platform.objects.get(
-                                platform_type=MarketplaceChoices.OZON),
-                            sku=data['product_id'])[0]
-
-                        comissions_data = data['commissions']
-                        fbs_commission = comissions_data['sales_percent_fbs']
-                        fbo_commission = comissions_data['sales_percent_fbo']
-                        add_marketplace_comission_to_db(product_obj, fbs_commission,
-                                                        fbo_commission)
-                        width = product_obj.width
-                        height = product_obj.height
-                        lenght = product_obj.length
-                        volume_cost_fbo = 0
-                        volume_cost_fbs = 0
-                        volume = (width * height * lenght) / 1000
-                        if volume < 1:
-                            volume_cost_fbs = 76
-                            volume_cost_fbo = 63
-                        elif volume > 190:
-                            volume_cost_fbs = 2344
-                            volume_cost_fbo = 1953
-                        else:
-                            volume_cost_fbs = 76 + 12 * math.ceil(volume - 1)
-                            volume_cost_fbo = 63 + 10 * math.ceil(volume - 1)
-                        cost_logistic_fbo = comissions_data['fbo_deliv_to_customer_amount'] + \
-                            comissions_data['fbo_fulfillment_amount'] + \
-                            volume_cost_fbo
-                        cost_logistic_fbs = comissions_data['fbs_deliv_to_customer_amount'] + \
-                            comissions_data['fbs_first_mile_max_amount'] + volume_cost_fbs
-                        add_marketplace_logistic_to_db(
-                            product_obj, cost_logistic_fbo=cost_logistic_fbo, cost_logistic_fbs=cost_logistic_fbs)
-                        # print(f'Сохранил комиссию для {product_obj}')
-                except MarketplaceProduct.DoesNotExist:
-                    print(f'В модели MarketplaceProduct (ОЗОН) нет sku {data["product_id"]}')
-                    logger.info(
-                        f'В модели MarketplaceProduct (ОЗОН) нет sku {data["product_id"]}')
+            pages = fetch.iterate(ozon_products_comission_info_pages(
+                ozon_token, ozon_client_id))
+            for chunk in fetch.chunks(pages, IMPORT_CHUNK_SIZE):
+                # Товары пачки одним запросом, при дублях sku берем первый
+                products = {}
+                for product_obj in MarketplaceProduct.objects.filter(
+                        account=account,
+                        platform=platform,
+                        sku__in=[str(data['product_id']) for data in chunk]).order_by('id').only(
+                            'id', 'sku', 'width', 'height', 'length'):
+                    products.setdefault(product_obj.sku, product_obj)
+
+                comissions = []
+                logistics = []
+
+                for data in chunk:
+                    product_obj = products.get(str(data['product_id']))
+                    if product_obj is None:
+                        logger.info(
+                            f'В модели MarketplaceProduct (ОЗОН) нет sku {data["product_id"]}')
+                        continue
+                    comissions_data = data['commissions']
+                    fbs_commission = comissions_data['sales_percent_fbs']
+                    fbo_commission = comissions_data['sales_percent_fbo']
+                    comissions.append({'marketplace_product_id': product_obj.id,
+                                       'fbs_commission': fbs_commission,
+                                       'fbo_commission': fbo_commission})
+                    width = product_obj.width
+                    height = product_obj.height
+                    lenght = product_obj.length
+                    volume_cost_fbo = 0
+                    volume_cost_fbs = 0
+                    volume = (width * height * lenght) / 1000
+                    if volume < 1:
+                        volume_cost_fbs = 76
+                        volume_cost_fbo = 63
+                    elif volume > 190:
+                        volume_cost_fbs = 2344
+                        volume_cost_fbo = 1953
+                    else:
+                        volume_cost_fbs = 76 + 12 * math.ceil(volume - 1)
+                        volume_cost_fbo = 63 + 10 * math.ceil(volume - 1)
+                    cost_logistic_fbo = comissions_data['fbo_deliv_to_customer_amount'] + \
+                        comissions_data['fbo_fulfillment_amount'] + \
+                        volume_cost_fbo
+                    cost_logistic_fbs = comissions_data['fbs_deliv_to_customer_amount'] + \
+                        comissions_data['fbs_first_mile_max_amount'] + volume_cost_fbs
+                    logistics.append({'marketplace_product_id': product_obj.id,
+                                      'cost_logistic_fbo': cost_logistic_fbo,
+                                      'cost_logistic_fbs': cost_logistic_fbs})
+                add_marketplace_comissions_to_db(comissions)
+                add_marketplace_logistics_to_db(logistics)
 
 
 @sender_error_to_tg
@@ -125,50 +132,38 @@ def ozon_products_data_to_db():
                 ozon_client_id = ''
                 ozon_token = account.authorization_fields['token']
                 ozon_client_id = account.authorization_fields['client_id']
-                main_data = ozon_products_info_from_api(
-                    ozon_token, ozon_client_id)
-                print('len(main_data) ozon_products_data_to_db', len(main_data))
-                # Получаем все товары для данного аккаунта
-                existing_products = MarketplaceProduct.objects.filter(account=account)
-                # Создаем множество SKU из API
-                api_skus = {data['id'] for data in main_data}
+                # Множество SKU из API
+                api_skus = set()
+                pages = fetch.iterate(ozon_products_info_pages(ozon_token, ozon_client_id))
+                for chunk in fetch.chunks(pages, IMPORT_CHUNK_SIZE):
+                    cards = []
+                    for data in chunk:
+                        api_skus.add(data['id'])
+                        ozonsku = ''
+                        article_info = ozon_product_info_with_sku_data(
+                            ozon_token, ozon_client_id, data['id'])
+                        if article_info:
+                            ozonsku = article_info.get('sku', '')
+                            if not ozonsku:
+                                ozonsku = article_info.get('fbo_sku', '')
+                            if not ozonsku:
+                                ozonsku = article_info.get('fbs_sku', '')
+                        cards.append({
+                            'name': data['name'],
+                            'sku': data['id'],
+                            'seller_article': data['offer_id'],
+                            'barcode': data['barcode'],
+                            'category_number': data['description_category_id'],
+                            'category_name': '',
+                            'width': data['width']/10,
+                            'height': data['height']/10,
+                            'length': data['depth']/10,
+                            'weight': data['weight']/1000,
+                            'ozon_sku': ozonsku,
+                        })
+                    add_marketplace_products_to_db(account_sklad, account, platform, cards)
                 # Обновляем флаг is_active для существующих товаров
-                for product in existing_products:
-                    if int(product.sku) in api_skus:
-                        product.is_active = True
-                        api_skus.remove(int(product.sku))
-                    else:
-                        product.is_active = False
-                    product.save()
-                for data in main_data:
-                    ozonsku = ''
-                    sku = ''
-                    barcode = ''
-                    article_info = ozon_product_info_with_sku_data(
-                        ozon_token, ozon_client_id, data['id'])
-                    if article_info:
-                        ozonsku = article_info.get('sku', '')
-                        if not ozonsku:
-                            ozonsku = article_info.get('fbo_sku', '')
-                        if not ozonsku:
-                            ozonsku = article_info.get('fbs_sku', '')
-
-                    name = data['name']
-                    sku = data['id']
-                    seller_article = data['offer_id']
-                    barcode = data['barcode']
-                    category_number = data['description_category_id']
-                    category_name = ''
-                    width = data['width']/10
-                    height = data['height']/10
-                    length = data['depth']/10
-                    weight = data['weight']/1000
-                    add_marketplace_product_to_db(
-                        account_sklad, barcode,
-                        account, platform, name,
-                        sku, seller_article, category_number,
-                        category_name, width,
-                        height, length, weight, ozonsku)
+                update_marketplace_products_activity(account, api_skus)
 
 
 @sender_error_to_tg
@@ -184,24 +179,20 @@ def ozon_action_data_to_db():
         oz_token = account.authorization_fields['token']
         ozon_client_id = account.authorization_fields['client_id']
         actions_data = ozon_actions_list(oz_token, ozon_client_id)
+        actions = []
         for action in actions_data:
-            platform = account.platform
-            action_number = action['id']
-            action_name = action['title']
-            date_start = datetime.strptime(
-                action['date_start'], "%Y-%m-%dT%H:%M:%SZ")
-            date_finish = datetime.strptime(
-                action['date_end'], "%Y-%m-%dT%H:%M:%SZ")
-
-            search_params = {'platform': platform,
-                             'account': account, 'action_number': action_number}
-            values_for_update = {
-                "action_name": action_name,
-                "date_start": date_start,
-                "date_finish": date_finish
-            }
-            MarketplaceAction.objects.update_or_create(
-                defaults=values_for_update, **search_params)
+            actions.append({
+                'platform_id': account.platform_id,
+                'account_id': account.id,
+                'action_number': action['id'],
+                'action_name': action['title'],
+                'date_start': datetime.strptime(
+                    action['date_start'], "%Y-%m-%dT%H:%M:%SZ"),
+                'date_finish': datetime.strptime(
+                    action['date_end'], "%Y-%m-%dT%H:%M:%SZ"),
+            })
+        bulk_upsert(MarketplaceAction, actions,
+                    unique_fields=['platform_id', 'account_id', 'action_number'])
 
 
 @sender_error_to_tg
@@ -210,29 +201,27 @@ def ozon_action_article_price_to_db(account, actions_data, platform):
     Записывает возможные цены артикулов OZON из акции
     """
 
-    for data in actions_data:
-        oz_token = account.authorization_fields['token']
-        ozon_client_id = account.authorization_fields['client_id']
-        action_data = ozon_actions_product_price_info(
-            oz_token, ozon_client_id, data.action_number)
+    oz_token = account.authorization_fields['token']
+    ozon_client_id = account.authorization_fields['client_id']
+    # Страницы всех акций запрашиваются одновременно
+    actions_products = fetch.collect_many({
+        data: ozon_actions_product_price_pages(oz_token, ozon_client_id, data.action_number)
+        for data in actions_data
+    })
+    # При дублях sku берется товар с меньшим id
+    products = dict(MarketplaceProduct.objects.filter(
+        account=account).order_by('-id').values_list('sku', 'id'))
+    for data, action_data in actions_products.items():
         if action_data:
+            products_in_action = []
             for action_oz in action_data:
-                nom_id = action_oz['id']
-                if MarketplaceProduct.objects.filter(
-                        account=account, sku=nom_id).exists():
-                    marketplace_product = MarketplaceProduct.objects.filter(
-                        account=account, sku=nom_id)[0]
-                    action = data
-                    product_price = action_oz['max_action_price']
-                    if action_oz['action_price'] != 0:
-                        status = True
-                    else:
-                        status = False
-                    search_params = {'action': action,
-                                     'marketplace_product': marketplace_product}
-                    values_for_update = {
-                        "product_price": product_price,
-                        "status": status
-                    }
-                    MarketplaceProductInAction.objects.update_or_create(
-                        defaults=values_for_update, **search_params)
+                marketplace_product_id = products.get(str(action_oz['id']))
+                if marketplace_product_id:
+                    products_in_action.append({
+                        'action_id': data.id,
+                        'marketplace_product_id': marketplace_product_id,
+                        'product_price': action_oz['max_action_price'],
+                        'status': action_oz['action_price'] != 0,
+                    })
+            bulk_upsert(MarketplaceProductInAction, products_in_action,
+                        unique_fields=['action_id', 'marketplace_product_id'])
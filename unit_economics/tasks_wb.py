@@ -1,16 +1,22 @@
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from django.utils import timezone
+
+from analyticalplatform.integrations import bulk_upsert
+from analyticalplatform.settings import IMPORT_CHUNK_SIZE
+from api_requests import fetch
 from api_requests.wb_requests import (wb_actions_list,
                                       wb_actions_product_price_info,
-                                      wb_article_data_from_api, wb_comissions,
-                                      wb_logistic, wb_price_data_from_api)
+                                      wb_article_data_pages, wb_comissions,
+                                      wb_logistic, wb_price_data_pages)
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform, User
-from unit_economics.integrations import (add_marketplace_comission_to_db,
-                                         add_marketplace_logistic_to_db,
-                                         add_marketplace_product_to_db, sender_error_to_tg)
-from unit_economics.models import (MarketplaceAction, MarketplaceCommission,
+from unit_economics.integrations import (add_marketplace_comissions_to_db,
+                                         add_marketplace_logistics_to_db,
+                                         add_marketplace_products_to_db, sender_error_to_tg,
+                                         update_marketplace_products_activity)
+from unit_economics.models import (ImportWatermark, MarketplaceAction, MarketplaceCommission,
                                    MarketplaceProduct,
                                    MarketplaceProductInAction,
                                    ProductForMarketplacePrice, ProductPrice)
@@ -18,15 +24,19 @@ from unit_economics.models import (MarketplaceAction, MarketplaceCommission,
 
 logger = logging.getLogger(__name__)
 
+WB_CARDS_SOURCE = 'wb_cards'
+# Как часто загружаются все карточки, чтобы найти удаленные
+WB_FULL_RESYNC_INTERVAL = timedelta(days=7)
+
 
 @sender_error_to_tg
 def wb_categories_list(TOKEN_WB):
     """Возвращает список категорий товаров текущего пользователя"""
-    main_data = wb_article_data_from_api(TOKEN_WB)
     categories_dict = {}
-    for data in main_data:
-        if data['subjectID'] not in categories_dict:
-            categories_dict[data['subjectID']] = data['subjectName']
+    for page in fetch.iterate(wb_article_data_pages(TOKEN_WB)):
+        for data in page:
+            if data['subjectID'] not in categories_dict:
+                categories_dict[data['subjectID']] = data['subjectName']
     return categories_dict
 
 
@@ -58,28 +68,16 @@ def wb_comission_add_to_db():
                     'fbs_express_commission': data['kgvpSupplierExpress']
                 }
             goods_list = MarketplaceProduct.objects.filter(
-                account=account, platform=Platform.objects.get(platform_type=MarketplaceChoices.WILDBERRIES))
-
-            for good_data in goods_list:
+                account=account, platform=Platform.objects.get(platform_type=MarketplaceChoices.WILDBERRIES)
+            ).values_list('id', 'category__category_number')
 
-                fbs_commission = wb_comission_dict[good_data.category.category_number]['fbs_commission']
-                fbo_commission = wb_comission_dict[good_data.category.category_number]['fbo_commission']
-                dbs_commission = wb_comission_dict[good_data.category.category_number]['dbs_commission']
-
-                if good_data.id == 14410:
-                    print('good_data.category.category_number', good_data.category.category_number)
-                    print('fbs_commission', fbs_commission)
-                    print('fbo_commission', fbo_commission)
-                    print('dbs_commission', dbs_commission)
-                fbs_express_commission = wb_comission_dict[
-                    good_data.category.category_number]['fbs_express_commission']
-                add_marketplace_comission_to_db(
-                    good_data,
-                    fbs_commission,
-                    fbo_commission,
-                    dbs_commission,
-                    fbs_express_commission
-                )
+            comissions = []
+            for good_id, category_number in goods_list:
+                if category_number not in wb_comission_dict:
+                    logger.info(f'Нет комиссии ВБ для категории {category_number}')
+                    continue
+                comissions.append({'marketplace_product_id': good_id, **wb_comission_dict[category_number]})
+            add_marketplace_comissions_to_db(comissions)
 
 
 @sender_error_to_tg
@@ -107,24 +105,23 @@ def wb_logistic_add_to_db():
                     box_delivery_liter = data['boxDeliveryLiter']
                     break
         goods_data = MarketplaceProduct.objects.filter(
-            account=account, platform=Platform.objects.get(platform_type=MarketplaceChoices.WILDBERRIES))
-        for good in goods_data:
-            height = good.height
-            width = good.width
-            length = good.length
+            account=account, platform=Platform.objects.get(platform_type=MarketplaceChoices.WILDBERRIES)
+        ).values_list('id', 'height', 'width', 'length')
+        box_delivery_base = float(
+            str(box_delivery_base).replace(',', '.'))
+        box_delivery_liter = float(
+            str(box_delivery_liter).replace(',', '.'))
+        logistics = []
+        for good_id, height, width, length in goods_data:
             value = height * width * length / 1000
-            box_delivery_base = float(
-                str(box_delivery_base).replace(',', '.'))
-            box_delivery_liter = float(
-                str(box_delivery_liter).replace(',', '.'))
             if value <= 1:
                 comission = box_delivery_base
             else:
                 comission = box_delivery_base + \
                     box_delivery_liter * (value - 1)
             comission = round(comission, 2)
-            add_marketplace_logistic_to_db(
-                good, comission)
+            logistics.append({'marketplace_product_id': good_id, 'cost_logistic': comission})
+        add_marketplace_logistics_to_db(logistics)
 
 
 @sender_error_to_tg
@@ -132,20 +129,26 @@ def wb_article_price_info(TOKEN_WB):
     """
     Возвращает словарь типа {nm_id: price_with_discount}
     """
-    main_data = wb_price_data_from_api(TOKEN_WB)
-
     article_price_info = {}
-    if main_data:
-        for data in main_data:
-
+    for page in fetch.iterate(wb_price_data_pages(TOKEN_WB)):
+        for data in page:
             discounted_price = data['sizes'][0]['discountedPrice']
             article_price_info[data['nmID']] = discounted_price
-        return article_price_info
+    return article_price_info
 
 
 @sender_error_to_tg
-def wb_products_data_to_db():
-    """Записывает данные о продуктах ВБ в базу данных"""
+def wb_products_data_to_db(full=False):
+    """
+    Записывает данные о продуктах ВБ в базу данных
+
+    Загружаются только карточки, измененные после курсора прошлой загрузки
+    (отметка ImportWatermark). Без отметки, с full=True или раз в
+    WB_FULL_RESYNC_INTERVAL загружаются все карточки, и товары,
+    которых нет в ВБ, становятся неактивными.
+    """
+    platform = Platform.objects.get(
+        platform_type=MarketplaceChoices.WILDBERRIES)
     users = User.objects.all()
     for user in users:
         if Account.objects.filter(
@@ -160,45 +163,49 @@ def wb_products_data_to_db():
             )
             accounts_wb = Account.objects.filter(
                 user=user,
-                platform=Platform.objects.get(
-                    platform_type=MarketplaceChoices.WILDBERRIES)
+                platform=platform
             )
 
             for account in accounts_wb:
                 token_wb = account.authorization_fields['token']
-                main_data = wb_article_data_from_api(token_wb)
-                # Получаем все товары для данного аккаунта
-                existing_products = MarketplaceProduct.objects.filter(account=account)
-                # Создаем множество SKU из API
-                api_skus = {data['nmID'] for data in main_data}
-                
-                # Обновляем флаг is_active для существующих товаров
-                for product in existing_products:
-                    if int(product.sku) in api_skus:
-                        product.is_active = True
-                        api_skus.remove(int(product.sku))
-                    else:
-                        product.is_active = False
-                    product.save()
-                for data in main_data:
-                    platform = Platform.objects.get(
-                        platform_type=MarketplaceChoices.WILDBERRIES)
-                    name = data['title']
-                    sku = data['nmID']
-                    seller_article = data['vendorCode']
-                    barcode = data['sizes'][0]['skus'][0]
-                    category_number = data['subjectID']
-                    category_name = data['subjectName']
-                    width = data['dimensions']['width']
-                    height = data['dimensions']['height']
-                    length = data['dimensions']['length']
-                    weight = 0
-                    add_marketplace_product_to_db(
-                        account_sklad, barcode,
-                        account, platform, name,
-                        sku, seller_article, category_number,
-                        category_name, width,
-                        height, length, weight)
+                watermark, _ = ImportWatermark.objects.get_or_create(
+                    account=account, source=WB_CARDS_SOURCE)
+                full_resync = full or not watermark.value or watermark.full_sync_due(WB_FULL_RESYNC_INTERVAL)
+                cursor = None if full_resync else watermark.value
+                # Множество SKU из API
+                api_skus = set()
+                last_card = None
+                try:
+                    pages = fetch.iterate(wb_article_data_pages(token_wb, cursor))
+                    for chunk in fetch.chunks(pages, IMPORT_CHUNK_SIZE):
+                        cards = []
+                        for data in chunk:
+                            api_skus.add(data['nmID'])
+                            cards.append({
+                                'name': data['title'],
+                                'sku': data['nmID'],
+                                'seller_article': data['vendorCode'],
+                                'barcode': data['sizes'][0]['skus'][0],
+                                'category_number': data['subjectID'],
+                                'category_name': data['subjectName'],
+                                'width': data['dimensions']['width'],
+                                'height': data['dimensions']['height'],
+                                'length': data['dimensions']['length'],
+                                'weight': 0,
+                            })
+                        add_marketplace_products_to_db(account_sklad, account, platform, cards)
+                        last_card = chunk[-1]
+                except fetch.FetchError as e:
+                    logger.warning(f'Не удалось загрузить карточки ВБ аккаунта {account}: {e}')
+                    continue
+                # Измененные карточки есть в ВБ, удаленные видны только при полной загрузке
+                update_marketplace_products_activity(
+                    account, api_skus, deactivate_missing=full_resync)
+                if last_card:
+                    watermark.value = {'updatedAt': last_card['updatedAt'], 'nmID': last_card['nmID']}
+                if full_resync:
+                    watermark.last_full_sync = timezone.now()
+                watermark.save()
 
 
 @sender_error_to_tg
@@ -214,23 +221,20 @@ def wb_action_data_to_db():
         wb_token = account.authorization_fields['token']
         actions_data = wb_actions_list(wb_token)
         if actions_data:
+            actions = []
             for action in actions_data:
-                platform = account.platform
-                action_number = action['id']
-                action_name = action['name']
-                date_finish = datetime.strptime(
-                    action['endDateTime'], "%Y-%m-%dT%H:%M:%SZ")
-                date_start = datetime.strptime(
-                    action['startDateTime'], "%Y-%m-%dT%H:%M:%SZ")
-                search_params = {'platform': platform,
-                             'account': account, 'action_number': action_number}
-                values_for_update = {
-                    "action_name": action_name,
-                    "date_start": date_start,
-                    "date_finish": date_finish
-                }
-                MarketplaceAction.objects.update_or_create(
-                    defaults=values_for_update, **search_params)
+                actions.append({
+                    'platform_id': account.platform_id,
+                    'account_id': account.id,
+                    'action_number': action['id'],
+                    'action_name': action['name'],
+                    'date_start': datetime.strptime(
+                        action['startDateTime'], "%Y-%m-%dT%H:%M:%SZ"),
+                    'date_finish': datetime.strptime(
+                        action['endDateTime'], "%Y-%m-%dT%H:%M:%SZ"),
+                })
+            bulk_upsert(MarketplaceAction, actions,
+                        unique_fields=['platform_id', 'account_id', 'action_number'])
 
 
 @sender_error_to_tg
@@ -238,25 +242,22 @@ def wb_action_article_price_to_db(account, actions_data, platform, wb_token):
     """
     Записывает возможные цены артикулов wb из акции
     """
+    # При дублях sku берется товар с меньшим id
+    products = dict(MarketplaceProduct.objects.filter(
+        account=account, platform=platform).order_by('-id').values_list('sku', 'id'))
     for data in actions_data:
         action_data = wb_actions_product_price_info(
             wb_token, data.action_number)
         if action_data:
+            products_in_action = []
             for action in action_data:
-                nom_id = action['id']
-                marketplace_product = MarketplaceProduct.objects.filter(
-                    account=account, platform=platform, sku=nom_id).first()
-                if marketplace_product:
-                    if 'price' in action:
-                        product_price = action['price']
-                        status = action['inAction']
-                        search_params = {'action': data,
-                                         'marketplace_product': marketplace_product}
-                        values_for_update = {
-                            "product_price": product_price,
-                            "status": status
-                        }
-                        MarketplaceProductInAction.objects.update_or_create(
-                            defaults=values_for_update, **search_params)
-                else:
-                    print(nom_id)
+                marketplace_product_id = products.get(str(action['id']))
+                if marketplace_product_id and 'price' in action:
+                    products_in_action.append({
+                        'action_id': data.id,
+                        'marketplace_product_id': marketplace_product_id,
+                        'product_price': action['price'],
+                        'status': action['inAction'],
+                    })
+            bulk_upsert(MarketplaceProductInAction, products_in_action,
+                        unique_fields=['action_id', 'marketplace_product_id'])
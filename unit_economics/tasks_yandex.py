@@ -1,24 +1,32 @@
 import logging
-import math
 from datetime import datetime
 
+from analyticalplatform.integrations import bulk_upsert
+from analyticalplatform.settings import IMPORT_CHUNK_SIZE
+from api_requests import fetch
 from api_requests.yandex_requests import (yandex_actions_list,
                                           yandex_actions_product_price_info,
                                           yandex_campaigns_data,
-                                          yandex_campaigns_from_business,
-                                          yandex_comission_calculate)
+                                          yandex_comission_calculate,
+                                          yandex_offer_mappings_pages)
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform, User
-from unit_economics.integrations import (add_marketplace_comission_to_db,
-                                         add_marketplace_logistic_to_db,
-                                         add_marketplace_product_to_db, sender_error_to_tg)
+from unit_economics.integrations import (add_marketplace_comissions_to_db,
+                                         add_marketplace_logistics_to_db,
+                                         add_marketplace_products_to_db, sender_error_to_tg,
+                                         update_marketplace_products_activity)
 from unit_economics.models import (MarketplaceAction, MarketplaceProduct,
-                                   MarketplaceProductInAction,
-                                   ProductForMarketplacePrice)
+                                   MarketplaceProductInAction)
 
 
 logger = logging.getLogger(__name__)
 
+YANDEX_SELLING_PROGRAMS = ('EXPRESS', 'FBS', 'FBY')
+# Сколько предложений помещается в один запрос калькулятора тарифов
+YANDEX_TARIFFS_CHUNK_SIZE = 150
+# Сколько запросов калькулятора выполняется одновременно
+YANDEX_TARIFFS_CONCURRENCY = 4
+
 
 @sender_error_to_tg
 def yandex_business_list(TOKEN_YM):
@@ -33,6 +41,37 @@ def yandex_business_list(TOKEN_YM):
     return business_list
 
 
+def yandex_product_card(data):
+    """
+    Карточка товара для add_marketplace_products_to_db из ответа offer-mappings.
+    Товары без штрихкода пропускаются (None)
+    """
+    market_data = data.get('mapping', {})
+    product_data = data.get('offer', {})
+    barcode = product_data.get('barcodes', 0)
+    if not barcode:
+        return None
+    # Нулевые и отсутствующие габариты считаем 20 см
+    width = height = length = 20
+    weight = 0
+    if 'weightDimensions' in product_data:
+        dimensions = product_data['weightDimensions']
+        width = dimensions['width'] or 20
+        height = dimensions['height'] or 20
+        length = dimensions['length'] or 20
+        weight = dimensions.get('weight', 0)
+    return {
+        'barcode': barcode[0],
+        'name': market_data.get('marketSkuName', ''),
+        'sku': market_data.get('marketSku', 0),
+        'seller_article': product_data.get('offerId', ''),
+        'category_number': market_data.get('marketCategoryId', 0),
+        'category_name': market_data.get('marketCategoryName', ''),
+        'width': width, 'height': height,
+        'length': length, 'weight': weight,
+    }
+
+
 @sender_error_to_tg
 def yandex_add_products_data_to_db():
     """Записывает данные артикулов в базу данных
@@ -61,155 +100,141 @@ def yandex_add_products_data_to_db():
                 token_ya = account.authorization_fields['token']
                 business_list = yandex_business_list(token_ya)
                 if business_list:
-                    main_data = []
+                    platform = Platform.objects.get(
+                        platform_type=MarketplaceChoices.YANDEX_MARKET)
+                    # Множество SKU из API
+                    api_skus = set()
                     for business_id in business_list:
-                        articles_data = yandex_campaigns_from_business(
-                            token_ya, business_id)
-                        for data in articles_data:
-                            main_data.append(data)
-                    existing_products = MarketplaceProduct.objects.filter(account=account)
-                    api_skus = {data['mapping']['marketSku'] for data in main_data if
-                                    'marketSku' in data['mapping']}
-                    for product in existing_products:
-                        if int(product.sku) in api_skus:
-                            product.is_active = True
-                            api_skus.remove(int(product.sku))
-                        else:
-                            product.is_active = False
-                        product.save()
+                        pages = fetch.iterate(yandex_offer_mappings_pages(token_ya, business_id))
+                        for chunk in fetch.chunks(pages, IMPORT_CHUNK_SIZE):
+                            cards = []
+                            for data in chunk:
+                                if 'marketSku' in data['mapping']:
+                                    api_skus.add(data['mapping']['marketSku'])
+                                    card = yandex_product_card(data)
+                                    if card:
+                                        cards.append(card)
+                            add_marketplace_products_to_db(
+                                account_sklad, account, platform, cards)
+                    # Обновляем флаг is_active для существующих товаров
+                    update_marketplace_products_activity(account, api_skus)
+
+
+def yandex_tariff_offers(account):
+    """
+    Собирает товары аккаунта для калькулятора тарифов Маркета.
+
+    Тариф зависит только от категории, цены и габаритов, поэтому товары
+    с одинаковыми параметрами объединяются в одно предложение.
+    Цены и категории берутся одним запросом.
+
+    Возвращает словарь {(categoryId, price, length, width, height, weight): [id товаров]}
+    """
+    offers = {}
+    for product_id, *key in MarketplaceProduct.objects.filter(
+            account=account, platform=account.platform).values_list(
+            'id', 'category__category_number', 'product__price_product__yandex_price',
+            'length', 'width', 'height', 'weight'):
+        price, weight = key[1], key[5]
+        # Без веса калькулятор не считает, без цены не посчитать процент комиссии
+        if not weight or not price:
+            continue
+        offers.setdefault(tuple(key), []).append(product_id)
+    return offers
 
-                    for data in main_data:
-                        if 'marketSku' in data['mapping']:
-                            platform = Platform.objects.get(
-                                platform_type=MarketplaceChoices.YANDEX_MARKET)
-                            market_data = data.get('mapping', '')
-                            product_data = data.get('offer', '')
-                            barcode = product_data.get('barcodes', 0)                                
-                            if barcode:
-                                barcode = barcode[0]
-                                name = market_data.get('marketSkuName', '')
-                                sku = market_data.get('marketSku', 0)
-                                seller_article = product_data.get(
-                                    'offerId', '')
-                                category_number = market_data.get(
-                                    'marketCategoryId', 0)
-                                category_name = market_data.get(
-                                    'marketCategoryName', '')
-                                if 'weightDimensions' in product_data:
-                                    width = product_data['weightDimensions']['width']
-                                    height = product_data['weightDimensions']['height']
-                                    length = product_data['weightDimensions']['length']
-                                    if width == 0:
-                                        width = 20
-                                    if height == 0:
-                                        height = 20
-                                    if length == 0:
-                                        length = 20
-                                    if 'weight' in product_data['weightDimensions']:
-                                        weight = product_data['weightDimensions']['weight']
-                                add_marketplace_product_to_db(
-                                    account_sklad, barcode,
-                                    account, platform, name,
-                                    sku, seller_article, category_number,
-                                    category_name, width,
-                                    height, length, weight
-                                )
+
+def yandex_tariffs_to_costs(tariffs, price):
+    """
+    Возвращает (комиссия в процентах от цены, затраты на логистику)
+    по тарифам одного предложения из ответа калькулятора
+    """
+    product_comission = 0
+    delivery_to_customer = 0
+    middle_mile = 0
+    sorting = 0
+    for amount in tariffs:
+        if amount['type'] == 'FEE':
+            product_comission = amount['amount'] / price * 100
+        elif amount['type'] == 'DELIVERY_TO_CUSTOMER':
+            delivery_to_customer = amount['amount']
+        elif amount['type'] == 'MIDDLE_MILE':
+            middle_mile = amount['amount']
+        elif amount['type'] == 'SORTING':
+            sorting += amount['amount']
+    return product_comission, delivery_to_customer + middle_mile + sorting
 
 
 @sender_error_to_tg
 def yandex_comission_logistic_add_data_to_db():
     """
     Записывает комиссии и затраты на логистику YANDEX MARKET в базу данных
-    """
-    selling_program_list = ['EXPRESS', 'FBS', 'FBY']
-    users = User.objects.all()
-    for user in users:
-        accounts_ya = Account.objects.filter(
-            user=user,
-            platform=Platform.objects.get(
-                platform_type=MarketplaceChoices.YANDEX_MARKET)
-        )
-        for account in accounts_ya:
-            token_ya = account.authorization_fields['token']
-            data_list = MarketplaceProduct.objects.filter(
-                account=account,
-                platform=Platform.objects.get(
-                    platform_type=MarketplaceChoices.YANDEX_MARKET)
-            )
-            article_comission = {}
-            amount_articles = math.ceil(len(data_list)/150)
-            for i in range(amount_articles):
-                start_point = i*150
-                finish_point = (i+1)*150
-                request_article_list = data_list[
-                    start_point:finish_point]
-
-                for logistic_type in selling_program_list:
-                    request_data = []
 
-                    for data in request_article_list:
-                        product_obj = data.product
-                        price = ProductForMarketplacePrice.objects.get(
-                            product=product_obj).yandex_price
-                        if data.weight:
-                            inner_request_dict = {
-                                "categoryId": data.category.category_number,
-                                # float(data.product.ya_price),
-                                "price": price,
-                                "length": data.length,
-                                "width": data.width,
-                                "height": data.height,
-                                "weight": data.weight,
-                                "quantity": 1
-                            }
-                            request_data.append(inner_request_dict)
-                    comission_data = yandex_comission_calculate(
-                        token_ya, logistic_type, request_data)
-                    for comission in comission_data:
-                        article_data = comission['offer']
-                        product_objects = MarketplaceProduct.objects.filter(
-                            account=account,
-                            platform=Platform.objects.get(
-                                platform_type=MarketplaceChoices.YANDEX_MARKET),
-                            category__category_number=article_data['categoryId'],
-                            # price=article_data['price'],
-                            length=article_data['length'],
-                            width=article_data['width'],
-                            height=article_data['height'],
-                            weight=article_data['weight']
-                        )
-                        for prod_obj in product_objects:
-                            price = prod_obj.product.price_product.yandex_price
-                            product_comission = 0
-                            delivery_to_customer = 0
-                            middle_mile = 0
-                            sorting = 0
+    Одинаковые предложения всех аккаунтов собираются заранее, запросы
+    калькулятора (пачка x модель работы) выполняются параллельно,
+    лимит частоты на токен соблюдается в api_requests.client.
+    Ответ сопоставляется с товарами по порядку предложений в запросе.
+    """
+    accounts_ya = Account.objects.filter(
+        platform=Platform.objects.get(
+            platform_type=MarketplaceChoices.YANDEX_MARKET)
+    )
+    requests_keys = []
+    requests_args = []
+    accounts_offers = {}
+    for account in accounts_ya:
+        token_ya = account.authorization_fields['token']
+        offers = yandex_tariff_offers(account)
+        accounts_offers[account] = offers
+        keys = list(offers)
+        for start in range(0, len(keys), YANDEX_TARIFFS_CHUNK_SIZE):
+            chunk = keys[start:start + YANDEX_TARIFFS_CHUNK_SIZE]
+            request_data = [{
+                "categoryId": category_number,
+                "price": price,
+                "length": length,
+                "width": width,
+                "height": height,
+                "weight": weight,
+                "quantity": 1
+            } for category_number, price, length, width, height, weight in chunk]
+            for logistic_type in YANDEX_SELLING_PROGRAMS:
+                requests_keys.append((account, logistic_type, chunk))
+                requests_args.append((token_ya, logistic_type, request_data))
 
-                            for amount in comission['tariffs']:
-                                if amount['type'] == 'FEE':
-                                    product_comission = amount['amount'] / price * 100
-                                elif amount['type'] == 'DELIVERY_TO_CUSTOMER':
-                                    delivery_to_customer = amount['amount']
-                                elif amount['type'] == 'MIDDLE_MILE':
-                                    middle_mile = amount['amount']
-                                elif amount['type'] == 'SORTING':
-                                    sorting += amount['amount']
-                            logistic_cost = (delivery_to_customer + \
-                                middle_mile + sorting )
-                            # print('logistic_cost', logistic_cost, 'logistic_type', logistic_type, prod_obj)
-                            # print('**********************')
-                            add_marketplace_logistic_to_db(
-                                prod_obj, cost_logistic=logistic_cost, cost_logistic_fbo=None, cost_logistic_fbs=None)
+    responses = fetch.run_parallel(
+        yandex_comission_calculate, requests_args, YANDEX_TARIFFS_CONCURRENCY)
 
-                            if prod_obj not in article_comission:
-                                article_comission[prod_obj] = {
-                                    logistic_type: product_comission}
-                            else:
-                                article_comission[prod_obj][logistic_type] = product_comission
+    # {account: {ключ предложения: {модель работы: (комиссия, логистика)}}}
+    accounts_costs = {account: {} for account in accounts_offers}
+    for (account, logistic_type, chunk), comission_data in zip(requests_keys, responses):
+        if comission_data is None:
+            logger.warning(f'Тарифы Маркета {logistic_type} аккаунта {account} не получены')
+            continue
+        for key, comission in zip(chunk, comission_data):
+            accounts_costs[account].setdefault(key, {})[logistic_type] = yandex_tariffs_to_costs(
+                comission['tariffs'], key[1])
 
-            for prod_obj, value in article_comission.items():
-                add_marketplace_comission_to_db(
-                    prod_obj, fbs_commission=value['FBS'], fbo_commission=value['FBY'], dbs_commission=0, fbs_express_commission=value['EXPRESS'])
+    for account, offers_costs in accounts_costs.items():
+        comissions = []
+        logistics = []
+        for key, costs in offers_costs.items():
+            for product_id in accounts_offers[account][key]:
+                # Логистика - по последней рассчитанной модели работы
+                logistics.append({
+                    'marketplace_product_id': product_id,
+                    'cost_logistic': costs[list(costs)[-1]][1],
+                })
+                # Комиссия записывается, только если рассчитаны все модели работы
+                if len(costs) == len(YANDEX_SELLING_PROGRAMS):
+                    comissions.append({
+                        'marketplace_product_id': product_id,
+                        'fbs_commission': costs['FBS'][0],
+                        'fbo_commission': costs['FBY'][0],
+                        'dbs_commission': 0,
+                        'fbs_express_commission': costs['EXPRESS'][0],
+                    })
+        add_marketplace_logistics_to_db(logistics)
+        add_marketplace_comissions_to_db(comissions)
 
 
 @sender_error_to_tg
@@ -225,33 +250,35 @@ def yandex_action_data_to_db():
         ya_token = account.authorization_fields['token']
         business_list = yandex_business_list(ya_token)
         if business_list:
+            actions = []
             for business_id in business_list:
                 actions_data = yandex_actions_list(ya_token, business_id)
                 for action in actions_data:
-                    platform = account.platform
-                    action_number = f"{action['id']} {business_id}"
-                    action_name = action['name']
-                    date_start = datetime.fromisoformat(
-                        action['period']['dateTimeFrom'])
-                    date_finish = datetime.fromisoformat(
-                        action['period']['dateTimeTo'])
-                    search_params = {'platform': platform,
-                                     'account': account, 'action_number': action_number}
-                    values_for_update = {
-                        "action_name": action_name,
-                        "date_start": date_start,
-                        "date_finish": date_finish
-                    }
-                    MarketplaceAction.objects.update_or_create(
-                        defaults=values_for_update, **search_params)
+                    actions.append({
+                        'platform_id': account.platform_id,
+                        'account_id': account.id,
+                        'action_number': f"{action['id']} {business_id}",
+                        'action_name': action['name'],
+                        'date_start': datetime.fromisoformat(
+                            action['period']['dateTimeFrom']),
+                        'date_finish': datetime.fromisoformat(
+                            action['period']['dateTimeTo']),
+                    })
+            bulk_upsert(MarketplaceAction, actions,
+                        unique_fields=['platform_id', 'account_id', 'action_number'])
 
 
 def yandex_action_article_price_to_db(account, actions_data, platform):
     """
     Записывает возможные цены артикулов YANDEX из акции
     """
+    ya_token = account.authorization_fields['token']
+    # Один артикул продавца может быть у нескольких товаров
+    products = {}
+    for product_id, seller_article in MarketplaceProduct.objects.filter(
+            account=account).values_list('id', 'seller_article'):
+        products.setdefault(seller_article, []).append(product_id)
     for data in actions_data:
-        ya_token = account.authorization_fields['token']
         common_data = data.action_number
         parts = common_data.split()
         action_id = parts[0]
@@ -259,26 +286,19 @@ def yandex_action_article_price_to_db(account, actions_data, platform):
         action_data = yandex_actions_product_price_info(
             ya_token, business_id, action_id)
         if action_data:
+            products_in_action = []
             for action_ya in action_data:
-                nom_id = action_ya['offerId']
-                if MarketplaceProduct.objects.filter(
-                        account=account, seller_article=nom_id).exists():
-                        for marketplace_product in MarketplaceProduct.objects.filter(
-                            account=account, seller_article=nom_id):
-                            action = data
-                            if 'discountParams' in action_ya['params']:
-                                product_price = action_ya['params']['discountParams']['maxPromoPrice']
-                            else:
-                                product_price = action_ya['params']['promocodeParams']['maxPrice']
-                            if action_ya['status'] == 'NOT_PARTICIPATING':
-                                status = False
-                            else:
-                                status = True
-                            search_params = {'action': action,
-                                             'marketplace_product': marketplace_product}
-                            values_for_update = {
-                                "product_price": product_price,
-                                "status": status
-                            }
-                            MarketplaceProductInAction.objects.update_or_create(
-                                defaults=values_for_update, **search_params)
+                if 'discountParams' in action_ya['params']:
+                    product_price = action_ya['params']['discountParams']['maxPromoPrice']
+                else:
+                    product_price = action_ya['params']['promocodeParams']['maxPrice']
+                status = action_ya['status'] != 'NOT_PARTICIPATING'
+                for marketplace_product_id in products.get(action_ya['offerId'], []):
+                    products_in_action.append({
+                        'action_id': data.id,
+                        'marketplace_product_id': marketplace_product_id,
+                        'product_price': product_price,
+                        'status': status,
+                    })
+            bulk_upsert(MarketplaceProductInAction, products_in_action,
+                        unique_fields=['action_id', 'marketplace_product_id'])
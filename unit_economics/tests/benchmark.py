@@ -0,0 +1,201 @@
+"""
+Генератор данных и замеры для набора бенчмарков (тесты с меткой benchmark).
+
+Замер - число запросов к базе, время выполнения и пик памяти Python (tracemalloc).
+Результаты сравниваются с базовыми значениями из benchmark_baselines.json:
+запросов не должно стать больше, время и память не должны превысить
+базовые значения больше чем в BENCHMARK_TOLERANCE раз (отклонения меньше
+MIN_REGRESSION не учитываются).
+Время и память сравниваются, только если размер данных совпадает с размером,
+на котором сняты базовые значения. Число запросов при другом размере сравнивается
+только для замеров, где оно не зависит от количества данных (fixed_queries).
+"""
+import gc
+import json
+import os
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from analyticalplatform.integrations import bulk_create_objects
+from core.enums import MarketplaceChoices
+from unit_economics.barcodes import rebuild_barcode_tables
+from unit_economics.models import (MarketplaceAction, MarketplaceCommission,
+                                   MarketplaceLogistic, MarketplaceProduct,
+                                   MarketplaceProductInAction,
+                                   MarketplaceProductPriceWithProfitability, PostingGoods,
+                                   ProductCostPrice, ProductForMarketplacePrice,
+                                   ProductOzonPrice, ProductPrice, StoreOverhead)
+from unit_economics.tests.helpers import create_account
+
+BASELINES_PATH = Path(__file__).with_name('benchmark_baselines.json')
+BENCHMARK_TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 1.5))
+# Отклонения меньше этих значений считаются шумом
+MIN_REGRESSION = {'seconds': 0.1, 'peak_mb': 1}
+# Аккаунты маркетплейсов пользователя создаются по кругу
+MARKETPLACES = (MarketplaceChoices.WILDBERRIES, MarketplaceChoices.OZON, MarketplaceChoices.YANDEX_MARKET)
+
+
+def benchmark_size():
+    """
+    Размер данных из BENCHMARK_SIZE: 'пользователи,аккаунты,товары,оприходования,акции'.
+    Аккаунты - маркетплейсов на пользователя, товары - на пользователя,
+    оприходования - на товар, акции - на аккаунт маркетплейса
+    """
+    users, accounts, products, postings, actions = (
+        int(value) for value in os.environ.get('BENCHMARK_SIZE', '2,3,500,5,3').split(','))
+    return {'users': users, 'accounts': accounts, 'products': products,
+            'postings': postings, 'actions': actions}
+
+
+def marketplace_sku(account, number):
+    """SKU товара на маркетплейсе: числовой и уникальный между аккаунтами"""
+    return str(account.id * 10 ** 7 + number)
+
+
+def generate_catalogue(django_user_model, users=1, accounts=3, products=100, postings=0, actions=0):
+    """
+    Создает пользователей с аккаунтом Мой Склад, аккаунтами маркетплейсов,
+    товарами, ценами, себестоимостью, комиссиями, логистикой, ценами по рентабельности,
+    оприходованиями и акциями. Возвращает список пользователей
+
+    Входящие переменные:
+        django_user_model - модель пользователя
+        users - количество пользователей
+        accounts - количество аккаунтов маркетплейсов у пользователя
+        products - количество товаров Мой Склад у пользователя (на каждом аккаунте маркетплейса столько же)
+        postings - количество оприходований на товар
+        actions - количество акций на аккаунт маркетплейса, в каждой все товары аккаунта
+    """
+    today = timezone.now().date()
+    created_users = []
+    for user_number in range(users):
+        user = django_user_model.objects.create_user(
+            email=f'benchmark{user_number}@test.test', password='benchmark')
+        created_users.append(user)
+        moy_sklad_account = create_account(user, MarketplaceChoices.MOY_SKLAD, name=f'Мой Склад {user_number}')
+        moy_sklad_account.authorization_fields = {'token': 'token'}
+        moy_sklad_account.save()
+        product_objects = bulk_create_objects(ProductPrice, [
+            ProductPrice(account=moy_sklad_account, moy_sklad_product_number=f'{user_number}-{i}',
+                         name=f'Товар {i}', brand=f'Бренд {i % 10}', vendor=f'V{i}', code=f'{user_number}-{i}',
+                         barcode=[f'{user_number}{i:07d}'], product_type='product', cost_price=300)
+            for i in range(products)])
+        bulk_create_objects(ProductForMarketplacePrice, [
+            ProductForMarketplacePrice(product=product, wb_price=1000, yandex_price=950, rrc=1000 + i % 200)
+            for i, product in enumerate(product_objects)])
+        bulk_create_objects(ProductCostPrice, [
+            ProductCostPrice(product=product, cost_price=200) for product in product_objects])
+        start_date = datetime(2024, 1, 1)
+        bulk_create_objects(PostingGoods, [
+            PostingGoods(account=moy_sklad_account, product=product, code=product.code,
+                         enter_number=f'enter-{day}', position_number=f'{product.code}-{day}',
+                         receipt_date=start_date + timedelta(days=day), amount=2, price=150 + day)
+            for product in product_objects for day in range(postings)])
+
+        for account_number in range(accounts):
+            platform_type = MARKETPLACES[account_number % len(MARKETPLACES)]
+            account = create_account(user, platform_type, name=f'Магазин {user_number}-{account_number}')
+            account.authorization_fields = {'token': 'token', 'client_id': 'client_id'}
+            account.save()
+            StoreOverhead.objects.create(account=account, name='Аренда', overhead=5)
+            if platform_type == MarketplaceChoices.OZON:
+                bulk_create_objects(ProductOzonPrice, [
+                    ProductOzonPrice(product=product, account=account, ozon_price=1100)
+                    for product in product_objects])
+            mp_products = bulk_create_objects(MarketplaceProduct, [
+                MarketplaceProduct(account=account, platform=account.platform, product=product,
+                                   name=product.name, sku=marketplace_sku(account, i),
+                                   seller_article=product.vendor, barcode=product.barcode[0],
+                                   width=10, height=10, length=10 + i % 20, weight=1)
+                for i, product in enumerate(product_objects)])
+            bulk_create_objects(MarketplaceCommission, [
+                MarketplaceCommission(marketplace_product=mp_product, fbs_commission=15, fbo_commission=12,
+                                      dbs_commission=10, fbs_express_commission=8)
+                for mp_product in mp_products])
+            bulk_create_objects(MarketplaceLogistic, [
+                MarketplaceLogistic(marketplace_product=mp_product, cost_logistic=60,
+                                    cost_logistic_fbo=70, cost_logistic_fbs=80)
+                for mp_product in mp_products])
+            bulk_create_objects(MarketplaceProductPriceWithProfitability, [
+                MarketplaceProductPriceWithProfitability(mp_product=mp_product, profit_price=1200, usual_price=1000)
+                for mp_product in mp_products])
+            action_objects = bulk_create_objects(MarketplaceAction, [
+                MarketplaceAction(platform=account.platform, account=account, action_number=str(number),
+                                  action_name=f'Акция {number}', date_start=today - timedelta(days=1),
+                                  date_finish=today + timedelta(days=number))
+                for number in range(actions)])
+            bulk_create_objects(MarketplaceProductInAction, [
+                MarketplaceProductInAction(action=action, marketplace_product=mp_product,
+                                           product_price=900, status=i % 2 == 0)
+                for action in action_objects for i, mp_product in enumerate(mp_products)])
+    # bulk_create не отправляет post_save, таблицы баркодов заполняются отдельно
+    rebuild_barcode_tables()
+    return created_users
+
+
+def measure(function):
+    """
+    Выполняет function и возвращает (замер, результат function).
+    Замер - словарь {'queries': число запросов, 'seconds': время, 'peak_mb': пик памяти}.
+    Время меряется вместе с tracemalloc, поэтому сравнимо только с такими же замерами
+    """
+    gc.collect()
+    tracemalloc.start()
+    started = time.monotonic()
+    with CaptureQueriesContext(connection) as queries:
+        result = function()
+    seconds = time.monotonic() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'queries': len(queries.captured_queries), 'seconds': round(seconds, 3),
+            'peak_mb': round(peak / 2 ** 20, 2)}, result
+
+
+def load_baselines():
+    if not BASELINES_PATH.exists():
+        return {'size': None, 'results': {}}
+    return json.loads(BASELINES_PATH.read_text())
+
+
+def save_baseline(name, size, result):
+    """Записывает замер в benchmark_baselines.json как новое базовое значение"""
+    baselines = load_baselines()
+    if baselines['size'] != size:
+        baselines = {'size': size, 'results': {}}
+    baselines['results'][name] = result
+    BASELINES_PATH.write_text(json.dumps(baselines, ensure_ascii=False, indent=2, sort_keys=True) + '\n')
+
+
+def baseline_regressions(name, size, result, fixed_queries=False):
+    """
+    Возвращает список отклонений замера от базового значения.
+    Замер без базового значения регрессией не считается
+
+    Входящие переменные:
+        name - название замера
+        size - размер данных (benchmark_size)
+        result - замер из measure
+        fixed_queries - число запросов не зависит от размера данных
+            и сравнивается, даже если размер отличается от базового
+    """
+    baselines = load_baselines()
+    baseline = baselines['results'].get(name)
+    if baseline is None:
+        return []
+    same_size = baselines['size'] == size
+    regressions = []
+    if (same_size or fixed_queries) and result['queries'] > baseline['queries']:
+        regressions.append(f"{name}: запросов {result['queries']}, было {baseline['queries']}")
+    if not same_size:
+        return regressions
+    for metric in ('seconds', 'peak_mb'):
+        if (result[metric] > baseline[metric] * BENCHMARK_TOLERANCE
+                and result[metric] - baseline[metric] > MIN_REGRESSION[metric]):
+            regressions.append(f'{name}: {metric} {result[metric]}, было {baseline[metric]}')
+    return regressions
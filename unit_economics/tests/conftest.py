@@ -0,0 +1,38 @@
+import pytest
+
+from core.enums import MarketplaceChoices
+from unit_economics.models import (MarketplaceCommission, MarketplaceLogistic,
+                                   ProductCostPrice, ProductForMarketplacePrice,
+                                   ProductOzonPrice, ProductPrice, StoreOverhead)
+from unit_economics.tests.helpers import create_account, create_mp_product
+
+
+@pytest.fixture()
+def catalogue(django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    moy_sklad_account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    wb_account = create_account(user, MarketplaceChoices.WILDBERRIES)
+    ozon_account = create_account(user, MarketplaceChoices.OZON)
+
+    product = ProductPrice.objects.create(
+        account=moy_sklad_account, name="Test Product", vendor="Vendor", barcode=["1"],
+        product_type="product", cost_price=300,
+    )
+    ProductCostPrice.objects.create(product=product, cost_price=200)
+    ProductForMarketplacePrice.objects.create(product=product, wb_price=1000, yandex_price=900, rrc=1000)
+    ProductOzonPrice.objects.create(product=product, account=ozon_account, ozon_price=2000)
+    StoreOverhead.objects.create(account=ozon_account, name="Аренда", overhead=5)
+    StoreOverhead.objects.create(account=ozon_account, name="Зарплата", overhead=5)
+
+    wb_product = create_mp_product(wb_account, product, "1")
+    MarketplaceCommission.objects.create(
+        marketplace_product=wb_product, fbs_commission=10, fbo_commission=20)
+    MarketplaceLogistic.objects.create(marketplace_product=wb_product, cost_logistic=50)
+
+    ozon_product = create_mp_product(ozon_account, product, "2")
+    MarketplaceCommission.objects.create(
+        marketplace_product=ozon_product, fbs_commission=15, fbo_commission=10)
+    MarketplaceLogistic.objects.create(
+        marketplace_product=ozon_product, cost_logistic_fbo=100, cost_logistic_fbs=150)
+
+    return user, wb_product, ozon_product
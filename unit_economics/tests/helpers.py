@@ -0,0 +1,37 @@
+from core.enums import MarketplaceChoices
+from core.models import Account, Platform
+from unit_economics.models import MarketplaceProduct
+
+PLATFORM_NAMES = {
+    MarketplaceChoices.WILDBERRIES: "Wildberries",
+    MarketplaceChoices.OZON: "OZON",
+    MarketplaceChoices.YANDEX_MARKET: "Yandex Market",
+    MarketplaceChoices.MOY_SKLAD: "Мой склад",
+}
+
+
+def get_or_create_platform(platform_type):
+    platform, _ = Platform.objects.get_or_create(
+        platform_type=platform_type, defaults={"name": PLATFORM_NAMES[platform_type]}
+    )
+    return platform
+
+
+def create_account(user, platform_type, name=None):
+    return Account.objects.create(
+        user=user,
+        platform=get_or_create_platform(platform_type),
+        name=name or f"Test Account {platform_type}",
+    )
+
+
+def create_mp_product(account, product, sku):
+    return MarketplaceProduct.objects.create(
+        account=account,
+        platform=account.platform,
+        product=product,
+        name=f"Test MP Product {sku}",
+        sku=sku,
+        seller_article=f"Article {sku}",
+        barcode=[sku],
+    )
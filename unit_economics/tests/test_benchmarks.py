@@ -0,0 +1,260 @@
+"""
+Бенчмарки API юнит-экономики и ночных задач: число запросов, время и пик памяти.
+
+По умолчанию пропускаются. Запуск:
+    python -m pytest --benchmark -m benchmark -s
+Рост числа запросов или выход времени и памяти за BENCHMARK_TOLERANCE
+от базовых значений (benchmark_baselines.json) роняет тест.
+Новые базовые значения записываются с --benchmark-save.
+Размер данных задается через BENCHMARK_SIZE (см. benchmark.benchmark_size).
+В CI (задача Benchmark) размер маленький, поэтому там проверяются только
+число запросов сценариев с fixed_queries и ассерты самих тестов
+"""
+from itertools import product as combinations
+from urllib.parse import urlencode
+
+import pytest
+from rest_framework.test import APIClient
+
+from core.enums import MarketplaceChoices
+from core.models import Account
+from unit_economics import integrations, periodic_tasks, tasks_moy_sklad, tasks_ozon, tasks_wb, tasks_yandex
+from unit_economics.models import (MarketplaceAction, MarketplaceProduct,
+                                   MarketplaceProductInAction, ProductCostPrice,
+                                   ProductPrice, ProfitabilitySnapshot)
+from unit_economics.profitability import profitability_bulk_calculate
+from unit_economics.tests.benchmark import (baseline_regressions, benchmark_size,
+                                            generate_catalogue, measure, save_baseline)
+from unit_economics.tests.test_moy_sklad_sync import pages_of
+
+pytestmark = [pytest.mark.benchmark, pytest.mark.django_db]
+
+MARKETPLACE_PRODUCTS_URL = '/api/unit_economics/marketplace-products/'
+
+# Переключатели таблицы товаров: цена (price_toggle), себестоимость и тип доставки
+TOGGLE_SCENARIOS = {
+    f'price_toggle={price_toggle},costprice_flag={costprice_flag},order_delivery_type={delivery}': {
+        'price_toggle': price_toggle, 'costprice_flag': costprice_flag, 'order_delivery_type': delivery}
+    for price_toggle, costprice_flag, delivery in combinations(('', 'true'), ('table', 'enter'), ('fbs', 'fbo'))
+}
+LIST_SCENARIOS = {
+    **TOGGLE_SCENARIOS,
+    'ordering': {'price_toggle': 'true', 'ordering': '-mp_profitability__profitability'},
+    'profitability_group': {'price_toggle': 'true', 'profitability_group': 'count_above_20'},
+    'calculate_product_price': {'calculate_product_price': '20', 'costprice_flag': 'table',
+                                'order_delivery_type': 'fbs'},
+    'action_id': {'action_id': None, 'costprice_flag': 'table', 'order_delivery_type': 'fbs'},
+    'quarantine': {'quarantine': 'true', 'top_selection_platform_id': None},
+}
+# Сценарии, где число запросов не зависит от количества товаров. С price_toggle
+# первый запрос строит снимок рентабельности пачками, calculate_product_price
+# и action_id пока делают запросы на каждый товар
+FIXED_QUERY_SCENARIOS = {
+    scenario for scenario, params in LIST_SCENARIOS.items()
+    if not params.get('price_toggle') and 'calculate_product_price' not in params and 'action_id' not in params
+}
+
+
+@pytest.fixture()
+def size():
+    return benchmark_size()
+
+
+@pytest.fixture()
+def users(django_user_model, size):
+    return generate_catalogue(django_user_model, **size)
+
+
+@pytest.fixture()
+def client(users):
+    client = APIClient()
+    client.force_authenticate(users[0])
+    # Первый запрос загружает модули и маршруты, в замер это не должно попадать
+    client.get('/api/unit_economics/topselectors/', {'user_id': users[0].id})
+    return client
+
+
+@pytest.fixture(autouse=True)
+def raise_task_errors(monkeypatch):
+    """Ошибки задач (sender_error_to_tg) роняют бенчмарк вместо отправки в телеграм"""
+    async def send_message(chat_id, message):
+        raise AssertionError(message)
+    monkeypatch.setattr(integrations, 'ADMINS_CHATID_LIST', [0])
+    monkeypatch.setattr(integrations, 'send_message_async', send_message)
+
+
+@pytest.fixture()
+def check_baseline(request, size):
+    """
+    Сравнивает замер с базовым значением или, с --benchmark-save, записывает его.
+    fixed_queries=True - число запросов сравнивается при любом BENCHMARK_SIZE
+    """
+    def check(name, result, fixed_queries=False):
+        print(f'\n{name}: {result}')
+        if request.config.getoption('--benchmark-save'):
+            save_baseline(name, size, result)
+            return
+        regressions = baseline_regressions(name, size, result, fixed_queries)
+        assert not regressions, '\n'.join(regressions)
+    return check
+
+
+def wb_account(user):
+    return Account.objects.filter(user=user, platform__platform_type=MarketplaceChoices.WILDBERRIES).first()
+
+
+@pytest.mark.parametrize('scenario', LIST_SCENARIOS)
+def test_marketplace_products_list(scenario, users, client, check_baseline):
+    params = dict(LIST_SCENARIOS[scenario])
+    account = wb_account(users[0])
+    if 'action_id' in params:
+        params['action_id'] = MarketplaceAction.objects.filter(account=account).first().id
+    if 'top_selection_platform_id' in params:
+        params['top_selection_platform_id'] = account.platform_id
+
+    result, response = measure(lambda: client.get(MARKETPLACE_PRODUCTS_URL, params))
+
+    assert response.status_code == 200
+    check_baseline(f'marketplace_products_list[{scenario}]', result,
+                   fixed_queries=scenario in FIXED_QUERY_SCENARIOS)
+
+
+@pytest.mark.parametrize('scenario', TOGGLE_SCENARIOS)
+def test_marketplace_products_excel_export(scenario, users, client, check_baseline):
+    def export():
+        response = client.post(f'{MARKETPLACE_PRODUCTS_URL}?{urlencode(TOGGLE_SCENARIOS[scenario])}')
+        content = b''.join(response.streaming_content)
+        response.close()
+        return response, content
+
+    result, (response, content) = measure(export)
+
+    assert response.status_code == 200
+    assert content
+    # Выгрузка читает товары блоками EXPORT_CHUNK_SIZE, на меньших данных запросов не больше
+    check_baseline(f'marketplace_products_excel_export[{scenario}]', result,
+                   fixed_queries=not TOGGLE_SCENARIOS[scenario]['price_toggle'])
+
+
+def test_profitability_api(users, client, check_baseline):
+    user = users[0]
+    profitability_bulk_calculate(user_id=user.id)
+
+    result, response = measure(lambda: client.get(f'/api/unit_economics/profitabilitys/{user.id}/'))
+
+    assert response.status_code == 200
+    assert response.data['all_situations'] == MarketplaceProduct.objects.filter(account__user=user).count()
+    check_baseline('profitability_api', result, fixed_queries=True)
+
+
+def test_top_selectors(users, client, check_baseline):
+    result, response = measure(lambda: client.get('/api/unit_economics/topselectors/', {'user_id': users[0].id}))
+
+    assert response.status_code == 200
+    check_baseline('top_selectors', result, fixed_queries=True)
+
+
+def test_update_wildberries_product_list(monkeypatch, users, check_baseline):
+    accounts = Account.objects.filter(platform__platform_type=MarketplaceChoices.WILDBERRIES)
+    cards = {}
+    for account in accounts:
+        account.authorization_fields = {'token': f'wb-{account.id}'}
+        account.save()
+        cards[account.authorization_fields['token']] = [{
+            'nmID': int(sku), 'updatedAt': '2024-05-01T10:00:00Z', 'title': name, 'vendorCode': seller_article,
+            'sizes': [{'skus': [barcode]}], 'subjectID': 10, 'subjectName': 'Категория',
+            'dimensions': {'width': 10, 'height': 10, 'length': 20},
+        } for sku, name, seller_article, barcode in MarketplaceProduct.objects.filter(account=account).values_list(
+            'sku', 'name', 'seller_article', 'barcode')]
+    monkeypatch.setattr(tasks_wb, 'wb_article_data_pages', lambda token, cursor=None: pages_of(cards[token]))
+    monkeypatch.setattr(tasks_wb, 'wb_comissions', lambda token: [{
+        'subjectID': 10, 'kgvpMarketplace': 15, 'paidStorageKgvp': 12,
+        'kgvpSupplier': 10, 'kgvpSupplierExpress': 8}])
+    monkeypatch.setattr(tasks_wb, 'wb_logistic', lambda token: [{
+        'warehouseName': 'Коледино', 'boxDeliveryBase': '50', 'boxDeliveryLiter': '10,5'}])
+
+    result, _ = measure(periodic_tasks.update_wildberries_product_list)
+
+    assert not MarketplaceProduct.objects.filter(account__in=accounts, category__isnull=True).exists()
+    check_baseline('update_wildberries_product_list', result)
+
+
+def test_update_ozon_product_list(monkeypatch, users, check_baseline):
+    products = {}
+    for account in Account.objects.filter(platform__platform_type=MarketplaceChoices.OZON):
+        account.authorization_fields = {'token': f'ozon-{account.id}', 'client_id': 'client_id'}
+        account.save()
+        products[account.authorization_fields['token']] = list(
+            MarketplaceProduct.objects.filter(account=account).values_list(
+                'sku', 'name', 'seller_article', 'barcode'))
+    commissions = {
+        'sales_percent_fbs': 15, 'sales_percent_fbo': 12, 'fbo_deliv_to_customer_amount': 20,
+        'fbo_fulfillment_amount': 30, 'fbs_deliv_to_customer_amount': 25, 'fbs_first_mile_max_amount': 15,
+    }
+    monkeypatch.setattr(tasks_ozon, 'ozon_products_info_pages', lambda token, client_id: pages_of([{
+        'id': int(sku), 'name': name, 'offer_id': seller_article, 'barcode': barcode,
+        'description_category_id': 20, 'width': 100, 'height': 100, 'depth': 200, 'weight': 1000,
+    } for sku, name, seller_article, barcode in products[token]]))
+    monkeypatch.setattr(tasks_ozon, 'ozon_product_info_with_sku_data',
+                        lambda token, client_id, product_id: {'sku': product_id + 1})
+    monkeypatch.setattr(tasks_ozon, 'ozon_products_comission_info_pages', lambda token, client_id: pages_of([
+        {'product_id': int(sku), 'commissions': commissions} for sku, *_ in products[token]]))
+
+    result, _ = measure(periodic_tasks.update_ozon_product_list)
+
+    assert not MarketplaceProduct.objects.filter(
+        platform__platform_type=MarketplaceChoices.OZON).exclude(ozonsku__gt='').exists()
+    check_baseline('update_ozon_product_list', result)
+
+
+def test_moy_sklad_costprice_add_to_db(monkeypatch, users, check_baseline):
+    stocks = [{'code': code, 'stock': 3} for code in ProductPrice.objects.values_list('code', flat=True)]
+    monkeypatch.setattr(tasks_moy_sklad, 'get_stock_info', lambda token: stocks)
+    ProductCostPrice.objects.all().delete()
+
+    result, _ = measure(periodic_tasks.moy_sklad_costprice_add_to_db)
+
+    assert ProductCostPrice.objects.count() == ProductPrice.objects.count()
+    check_baseline('moy_sklad_costprice_add_to_db', result)
+
+
+def test_action_article_price_to_db(monkeypatch, users, check_baseline):
+    skus = {account.id: list(MarketplaceProduct.objects.filter(account=account).values_list('sku', flat=True))
+            for account in Account.objects.all()}
+    articles = {account.id: list(MarketplaceProduct.objects.filter(account=account).values_list(
+        'seller_article', flat=True)) for account in Account.objects.all()}
+    for account in Account.objects.all():
+        account.authorization_fields = {'token': str(account.id), 'client_id': 'client_id'}
+        account.save()
+    MarketplaceProductInAction.objects.all().delete()
+    MarketplaceAction.objects.all().delete()
+    monkeypatch.setattr(tasks_wb, 'wb_actions_list', lambda token: [
+        {'id': number, 'name': f'Акция {number}', 'startDateTime': '2024-05-01T00:00:00Z',
+         'endDateTime': '2030-05-01T00:00:00Z'} for number in range(3)])
+    monkeypatch.setattr(tasks_wb, 'wb_actions_product_price_info', lambda token, number: [
+        {'id': int(sku), 'price': 900, 'inAction': True} for sku in skus[int(token)]])
+    monkeypatch.setattr(tasks_ozon, 'ozon_actions_list', lambda token, client_id: [
+        {'id': number, 'title': f'Акция {number}', 'date_start': '2024-05-01T00:00:00Z',
+         'date_end': '2030-05-01T00:00:00Z'} for number in range(3)])
+    monkeypatch.setattr(tasks_ozon, 'ozon_actions_product_price_pages', lambda token, client_id, number: pages_of([
+        {'id': int(sku), 'max_action_price': 900, 'action_price': 0} for sku in skus[int(token)]]))
+    monkeypatch.setattr(tasks_yandex, 'yandex_business_list', lambda token: [1])
+    monkeypatch.setattr(tasks_yandex, 'yandex_actions_list', lambda token, business_id: [
+        {'id': number, 'name': f'Акция {number}', 'period': {
+            'dateTimeFrom': '2024-05-01T00:00:00+03:00', 'dateTimeTo': '2030-05-01T00:00:00+03:00'}}
+        for number in range(3)])
+    monkeypatch.setattr(tasks_yandex, 'yandex_actions_product_price_info', lambda token, business_id, action_id: [
+        {'offerId': article, 'params': {'discountParams': {'maxPromoPrice': 900}}, 'status': 'PARTICIPATING'}
+        for article in articles[int(token)]])
+
+    result, _ = measure(periodic_tasks.action_article_price_to_db)
+
+    assert MarketplaceProductInAction.objects.count() == 3 * MarketplaceProduct.objects.count()
+    check_baseline('action_article_price_to_db', result)
+
+
+def test_refresh_profitability_snapshots(users, check_baseline):
+    result, _ = measure(periodic_tasks.refresh_profitability_snapshots)
+
+    assert ProfitabilitySnapshot.objects.exists()
+    check_baseline('refresh_profitability_snapshots', result)
@@ -0,0 +1,43 @@
+from unit_economics import bundles
+
+HREF = 'https://api.moysklad.ru/api/remap/1.2/entity/product/{}'
+
+
+def component(product_id, quantity):
+    return {'assortment': {'meta': {'href': HREF.format(product_id)}}, 'quantity': quantity}
+
+
+def test_resolver_uses_assortment_and_fetches_only_misses(monkeypatch):
+    components = {
+        'bundle-1': [component('p1', 2), component('p2', 1)],
+        'bundle-2': [component('p1', 1), component('p3', 3)],
+        'bundle-3': None,
+    }
+    fetched = []
+
+    def product_info(token, href):
+        fetched.append(href)
+        return {'buyPrice': {'value': 500}}
+
+    monkeypatch.setattr(bundles, 'moy_sklad_bundle_components',
+                        lambda token, bundle_id: components[bundle_id])
+    monkeypatch.setattr(bundles, 'moy_sklad_product_info', product_info)
+
+    resolver = bundles.BundleCostResolver('token')
+    resolver.add_assortment_item({'id': 'p1', 'meta': {'type': 'product'}, 'buyPrice': {'value': 100}})
+    resolver.add_assortment_item({'id': 'p2', 'meta': {'type': 'product'}, 'buyPrice': {'value': 300}})
+
+    costs = resolver.resolve(['bundle-1', 'bundle-2', 'bundle-3'])
+
+    assert costs == {'bundle-1': 500, 'bundle-2': 1600, 'bundle-3': None}
+    assert fetched == [HREF.format('p3')]
+
+
+def test_resolver_marks_bundle_failed_when_component_missing(monkeypatch):
+    monkeypatch.setattr(bundles, 'moy_sklad_bundle_components',
+                        lambda token, bundle_id: [component('p9', 1)])
+    monkeypatch.setattr(bundles, 'moy_sklad_product_info', lambda token, href: None)
+
+    costs = bundles.BundleCostResolver('token').resolve(['bundle-1'])
+
+    assert costs == {'bundle-1': None}
@@ -0,0 +1,95 @@
+from datetime import datetime
+
+import pytest
+
+from core.enums import MarketplaceChoices
+from unit_economics import bundles, periodic_tasks, tasks_moy_sklad
+from unit_economics.models import PostingGoods, ProductCostPrice, ProductPrice
+from unit_economics.tasks_moy_sklad import fifo_cost_prices
+from unit_economics.tests.test_bundles import component
+from unit_economics.tests.helpers import create_account
+
+
+def posting(code, day, price, amount, costs=0, account_id=1, product_id=None):
+    return (account_id, code, product_id or code, datetime(2024, 1, day), price, amount, costs)
+
+
+def test_fifo_cost_prices_takes_lot_covering_stock():
+    postings = [
+        posting('a', 5, 300, 10), posting('a', 5, 300, 10), posting('a', 3, 200, 10, costs=500),
+        posting('a', 1, 100, 10),
+        posting('b', 4, 400, 5), posting('b', 2, 350, 5),
+        posting('c', 6, 600, 2, costs=100), posting('c', 1, 500, 2),
+    ]
+    stocks = {1: {'a': 15, 'b': 100}}
+
+    cost_prices = {row['product_id']: row['cost_price'] for row in fifo_cost_prices(postings, stocks)}
+
+    # Дубль поставки 'a' от 5 числа не считается, остаток 15 покрывает поставка от 3 числа
+    assert cost_prices['a'] == pytest.approx(2.5)
+    # Поставок меньше остатка - самая старая
+    assert cost_prices['b'] == pytest.approx(3.5)
+    # Остатка нет в Моем Складе - последняя поставка
+    assert cost_prices['c'] == pytest.approx(6.5)
+
+
+@pytest.mark.django_db
+def test_moy_sklad_costprice_add_to_db_streams_postings(
+        monkeypatch, django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    product = ProductPrice.objects.create(
+        account=account, name='a', vendor='a', barcode=['1'], product_type='product')
+    ProductCostPrice.objects.create(product=product, cost_price=1)
+    for day, price in ((1, 100), (2, 200), (3, 300)):
+        PostingGoods.objects.create(account=account, product=product, code='a',
+                                    receipt_date=datetime(2024, 1, day), amount=10, price=price)
+    monkeypatch.setattr('unit_economics.tasks_moy_sklad.moy_sklad_stock_data', lambda: {account: {'a': 20}})
+    monkeypatch.setattr(periodic_tasks, 'moy_sklad_costprice_calculate_for_bundle', lambda: None)
+
+    periodic_tasks.moy_sklad_costprice_add_to_db()
+
+    assert ProductCostPrice.objects.get(product=product).cost_price == pytest.approx(2)
+
+
+@pytest.mark.django_db
+def test_bundle_cost_prices_from_component_postings(
+        monkeypatch, django_user_model, test_user_name, test_user_password, django_assert_max_num_queries):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    account.authorization_fields = {'token': 'token'}
+    account.save()
+    other_account = create_account(user, MarketplaceChoices.MOY_SKLAD, name='Другой склад')
+    other_account.authorization_fields = {'token': 'other'}
+    other_account.save()
+
+    def product(moy_sklad_id, product_type='product', owner=account):
+        return ProductPrice.objects.create(
+            account=owner, name=moy_sklad_id, vendor=moy_sklad_id, code=moy_sklad_id,
+            moy_sklad_product_number=moy_sklad_id, product_type=product_type)
+
+    for moy_sklad_id, price in (('p1', 100), ('p2', 300)):
+        PostingGoods.objects.create(account=account, product=product(moy_sklad_id), code=moy_sklad_id,
+                                    receipt_date=datetime(2024, 1, 1), amount=10, price=price)
+    bundle = product('b1', 'bundle')
+    ProductCostPrice.objects.create(product=bundle, cost_price=1)
+    unavailable_bundle = product('b2', 'bundle')
+    product('b3', 'bundle', owner=other_account)
+    requested = []
+
+    def bundle_components(token, bundle_id):
+        requested.append((token, bundle_id))
+        if bundle_id == 'b2':
+            return None
+        return [component('p1', 2), component('p2', 1), component('p9', 5)]
+
+    monkeypatch.setattr(bundles, 'moy_sklad_bundle_components', bundle_components)
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_stock_data', lambda: {account: {}, other_account: {}})
+
+    with django_assert_max_num_queries(20):
+        tasks_moy_sklad.moy_sklad_costprice_calculate_for_bundle()
+
+    # Компонента p9 нет в базе, состав b2 не получен
+    assert ProductCostPrice.objects.get(product=bundle).cost_price == 5
+    assert not ProductCostPrice.objects.filter(product=unavailable_bundle).exists()
+    assert sorted(requested) == [('other', 'b3'), ('token', 'b1'), ('token', 'b2')]
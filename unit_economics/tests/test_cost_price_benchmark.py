@@ -0,0 +1,56 @@
+"""
+Замер расчета себестоимости методом оприходования на 1 млн оприходований.
+
+Долгий тест с меткой benchmark, по умолчанию пропускается. Запуск:
+    python -m pytest --benchmark unit_economics/tests/test_cost_price_benchmark.py -s
+Количество можно задать через COST_PRICE_BENCHMARK_POSTINGS=100000
+"""
+import os
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pytest
+
+from analyticalplatform.integrations import bulk_create_objects
+from core.enums import MarketplaceChoices
+from unit_economics import tasks_moy_sklad
+from unit_economics.models import PostingGoods, ProductPrice
+from unit_economics.tests.helpers import create_account
+
+BENCHMARK_POSTINGS = int(os.environ.get("COST_PRICE_BENCHMARK_POSTINGS", 1000000))
+POSTINGS_PER_PRODUCT = 100
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.mark.django_db
+def test_cost_price_engine(monkeypatch, django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    products = bulk_create_objects(ProductPrice, [
+        ProductPrice(account=account, name=str(i), vendor=str(i), code=str(i), product_type="product")
+        for i in range(BENCHMARK_POSTINGS // POSTINGS_PER_PRODUCT)
+    ])
+    start_date = datetime(2024, 1, 1)
+    for product in products:
+        bulk_create_objects(PostingGoods, [
+            PostingGoods(account=account, product=product, code=product.code,
+                         receipt_date=start_date + timedelta(days=day), amount=10, price=100 + day)
+            for day in range(POSTINGS_PER_PRODUCT)
+        ])
+    stocks = {account: {product.code: 250 for product in products}}
+    monkeypatch.setattr(tasks_moy_sklad, "moy_sklad_stock_data", lambda: stocks)
+
+    tracemalloc.start()
+    started = time.monotonic()
+    rows = list(tasks_moy_sklad.moy_sklad_costprice_calculate())
+    seconds = time.monotonic() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(rows) == len(products)
+    # Остаток 250 покрывают 25 последних поставок
+    assert rows[0]["cost_price"] == pytest.approx((100 + POSTINGS_PER_PRODUCT - 25) / 100)
+    print(f"\n{BENCHMARK_POSTINGS} оприходований: {seconds:.2f} с, "
+          f"{BENCHMARK_POSTINGS / seconds:.0f} строк/с, пик памяти {peak / 2 ** 20:.1f} МБ")
@@ -0,0 +1,55 @@
+import pytest
+
+from unit_economics import tasks
+from unit_economics.invalidation import (pending_changes,
+                                         profitability_changes_batch)
+from unit_economics.models import (MarketplaceCommission, ProductOzonPrice,
+                                   ProfitabilitySnapshot, StoreOverhead)
+
+
+@pytest.fixture()
+def recalculations(monkeypatch):
+    """Запускает задачи пересчета синхронно и запоминает их аргументы"""
+    calls = []
+
+    def delay(**kwargs):
+        calls.append(kwargs)
+        return tasks.recalculate_changed_profitability(**kwargs)
+
+    monkeypatch.setattr(tasks.recalculate_changed_profitability, "delay", delay)
+    pending_changes.pop()
+    yield calls
+    pending_changes.pop()
+
+
+@pytest.mark.django_db
+def test_changes_in_transaction_flush_single_recalculation(
+        catalogue, recalculations, django_capture_on_commit_callbacks):  # noqa: F811
+    user, wb_product, ozon_product = catalogue
+
+    with django_capture_on_commit_callbacks(execute=True):
+        MarketplaceCommission.objects.filter(marketplace_product=wb_product).get().save()
+        ProductOzonPrice.objects.update_or_create(
+            product=ozon_product.product, account=ozon_product.account, defaults={"ozon_price": 4000})
+
+    assert recalculations == [{
+        "mp_product_ids": [wb_product.id], "product_ids": [ozon_product.product_id], "account_ids": []}]
+    snapshot = ProfitabilitySnapshot.objects.get(
+        mp_product=ozon_product, costprice_flag="enter", order_delivery_type="fbs")
+    assert snapshot.profitability == 66.25
+
+
+@pytest.mark.django_db
+def test_changes_batch_defers_recalculation(
+        catalogue, recalculations, django_capture_on_commit_callbacks):  # noqa: F811
+    user, wb_product, ozon_product = catalogue
+
+    with django_capture_on_commit_callbacks(execute=True):
+        with profitability_changes_batch():
+            StoreOverhead.objects.create(account=ozon_product.account, name="Склад", overhead=10)
+            StoreOverhead.objects.create(account=wb_product.account, name="Склад", overhead=10)
+            assert recalculations == []
+
+    assert len(recalculations) == 1
+    assert recalculations[0]["account_ids"] == sorted([wb_product.account_id, ozon_product.account_id])
+    assert ProfitabilitySnapshot.objects.filter(mp_product=wb_product).count() == 8
@@ -0,0 +1,254 @@
+from datetime import timedelta
+from io import BytesIO
+
+import pytest
+from openpyxl import load_workbook
+from django.apps import apps
+from django.db.models.signals import post_migrate
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from analyticalplatform.integrations import bulk_upsert
+from core.enums import MarketplaceChoices
+from unit_economics.barcodes import (fill_empty_barcode_tables,
+                                     marketplace_products_with_barcode,
+                                     product_ids_by_barcode,
+                                     products_with_barcode,
+                                     rebuild_barcode_tables)
+from unit_economics.integrations import (add_marketplace_comissions_to_db,
+                                         add_marketplace_products_to_db)
+from unit_economics.models import (MarketplaceAction, MarketplaceCommission,
+                                   MarketplaceLogistic, MarketplaceProduct,
+                                   MarketplaceProductInAction, ProductBarcode,
+                                   ProductForMarketplacePrice, ProductOzonPrice,
+                                   ProductPrice, ProfitabilityMarketplaceProduct)
+from unit_economics.tests.helpers import create_account, create_mp_product
+
+
+def make_card(sku, barcode, name="Товар"):
+    return {
+        "barcode": barcode, "name": name, "sku": sku, "seller_article": f"Article {sku}",
+        "category_number": 10, "category_name": "Категория",
+        "width": 10.5, "height": 20, "length": 30, "weight": 0.5,
+    }
+
+
+@pytest.mark.django_db
+def test_add_marketplace_products_to_db_matches_by_barcode(
+        django_user_model, test_user_name, test_user_password, django_assert_max_num_queries):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    moy_sklad_account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    wb_account = create_account(user, MarketplaceChoices.WILDBERRIES)
+    first_product = ProductPrice.objects.create(
+        account=moy_sklad_account, name="Первый", vendor="1", barcode=["111", "112"], product_type="product")
+    second_product = ProductPrice.objects.create(
+        account=moy_sklad_account, name="Второй", vendor="2", barcode=["222"], product_type="product")
+    cards = [make_card(1, "112"), make_card(2, "222"), make_card(3, "999")]
+
+    with django_assert_max_num_queries(6):
+        assert add_marketplace_products_to_db(moy_sklad_account, wb_account, wb_account.platform, cards) == (2, 0)
+
+    products = MarketplaceProduct.objects.filter(account=wb_account).order_by("sku")
+    assert [(product.product_id, product.sku, product.barcode) for product in products] == [
+        (first_product.id, "1", "112"), (second_product.id, "2", "222")]
+    assert products[0].width == 10
+    assert products[0].category.category_name == "Категория"
+
+    # Повторная загрузка без изменений ничего не пишет
+    assert add_marketplace_products_to_db(moy_sklad_account, wb_account, wb_account.platform, cards) == (0, 0)
+
+    cards[1]["name"] = "Новое название"
+    assert add_marketplace_products_to_db(moy_sklad_account, wb_account, wb_account.platform, cards) == (0, 1)
+    assert MarketplaceProduct.objects.get(account=wb_account, sku="2").name == "Новое название"
+    assert MarketplaceProduct.objects.filter(account=wb_account).count() == 2
+
+
+@pytest.mark.django_db
+def test_barcode_tables_follow_json_fields(django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    moy_sklad_account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    wb_account = create_account(user, MarketplaceChoices.WILDBERRIES)
+    product = ProductPrice.objects.create(
+        account=moy_sklad_account, name="Первый", vendor="1", barcode=["111", "112"], product_type="product")
+    add_marketplace_products_to_db(moy_sklad_account, wb_account, wb_account.platform, [make_card(1, "112")])
+    mp_product = MarketplaceProduct.objects.get(account=wb_account)
+
+    assert product_ids_by_barcode(["112", "999"], moy_sklad_account) == {"112": [product.id]}
+    assert list(marketplace_products_with_barcode("112")) == [mp_product]
+
+    product.barcode = ["113"]
+    product.save()
+    assert list(products_with_barcode("113")) == [product]
+    assert not products_with_barcode("112").exists()
+
+    ProductBarcode.objects.all().delete()
+    assert rebuild_barcode_tables() == 1
+    assert sorted(ProductBarcode.objects.values_list("barcode", flat=True)) == ["113"]
+
+
+@pytest.mark.django_db
+def test_barcode_tables_are_filled_after_migrate(django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    moy_sklad_account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    wb_account = create_account(user, MarketplaceChoices.WILDBERRIES)
+    # Продукты, загруженные до появления таблиц баркодов: bulk_create без сигналов
+    product = ProductPrice.objects.bulk_create([ProductPrice(
+        account=moy_sklad_account, name="Первый", vendor="1", barcode=["111"], product_type="product")])[0]
+    assert not ProductBarcode.objects.exists()
+
+    app_config = apps.get_app_config("unit_economics")
+    post_migrate.send(sender=app_config, app_config=app_config, verbosity=0, interactive=False,
+                      using="default", apps=apps, plan=[])
+
+    assert product_ids_by_barcode(["111"], moy_sklad_account) == {"111": [product.id]}
+    assert add_marketplace_products_to_db(
+        moy_sklad_account, wb_account, wb_account.platform, [make_card(1, "111")]) == (1, 0)
+    # Заполненные таблицы повторно не перестраиваются
+    assert fill_empty_barcode_tables() == 0
+
+
+@pytest.mark.django_db
+def test_add_marketplace_comissions_to_db_upserts_in_one_query(
+        catalogue, django_assert_num_queries):  # noqa: F811
+    _, wb_product, ozon_product = catalogue
+    new_product = create_mp_product(wb_product.account, wb_product.product, "3")
+    comissions = [
+        {'marketplace_product_id': wb_product.id, 'fbs_commission': 11},
+        {'marketplace_product_id': new_product.id, 'fbs_commission': 12, 'fbo_commission': 13},
+        # Дубль по ключу: записывается последняя строка
+        {'marketplace_product_id': wb_product.id, 'fbs_commission': 14},
+    ]
+
+    with django_assert_num_queries(1):
+        bulk_upsert(MarketplaceCommission, comissions, unique_fields=['marketplace_product_id'])
+
+    assert MarketplaceCommission.objects.get(marketplace_product=wb_product).fbs_commission == 14
+    assert MarketplaceCommission.objects.get(marketplace_product=new_product).fbo_commission == 13
+    assert MarketplaceCommission.objects.get(marketplace_product=ozon_product).fbs_commission == 15
+
+    add_marketplace_comissions_to_db([{'marketplace_product_id': new_product.id, 'fbs_commission': 20}])
+    comission = MarketplaceCommission.objects.get(marketplace_product=new_product)
+    assert (comission.fbs_commission, comission.fbo_commission) == (20, 0)
+
+
+
+def create_ozon_catalogue(user, count):
+    """Товары Озон с ценами, комиссиями, логистикой, активной и прошедшей акцией"""
+    moy_sklad_account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    ozon_account = create_account(user, MarketplaceChoices.OZON)
+    products = ProductPrice.objects.bulk_create([
+        ProductPrice(account=moy_sklad_account, name=f"Товар {i}", vendor=str(i), barcode=[str(i)],
+                     product_type="product")
+        for i in range(count)])
+    ProductForMarketplacePrice.objects.bulk_create([
+        ProductForMarketplacePrice(product=product, rrc=1000) for product in products])
+    ProductOzonPrice.objects.bulk_create([
+        ProductOzonPrice(product=product, account=ozon_account, ozon_price=900) for product in products])
+    mp_products = MarketplaceProduct.objects.bulk_create([
+        MarketplaceProduct(account=ozon_account, platform=ozon_account.platform, product=product,
+                           name=product.name, sku=str(i), seller_article=str(i), barcode=[str(i)])
+        for i, product in enumerate(products)])
+    MarketplaceCommission.objects.bulk_create([
+        MarketplaceCommission(marketplace_product=mp_product, fbs_commission=10) for mp_product in mp_products])
+    MarketplaceLogistic.objects.bulk_create([
+        MarketplaceLogistic(marketplace_product=mp_product, cost_logistic_fbs=50) for mp_product in mp_products])
+    today = timezone.now().date()
+    active_action = MarketplaceAction.objects.create(
+        platform=ozon_account.platform, account=ozon_account, action_number="1", action_name="Акция",
+        date_start=today, date_finish=today + timedelta(days=7))
+    finished_action = MarketplaceAction.objects.create(
+        platform=ozon_account.platform, account=ozon_account, action_number="2", action_name="Прошла",
+        date_start=today - timedelta(days=7), date_finish=today - timedelta(days=1))
+    MarketplaceProductInAction.objects.bulk_create([
+        MarketplaceProductInAction(action=action, marketplace_product=mp_product, product_price=800)
+        for mp_product in mp_products for action in (active_action, finished_action)])
+    return ozon_account, mp_products, active_action
+
+
+@pytest.mark.django_db
+def test_marketplace_products_page_has_fixed_query_count(
+        django_user_model, test_user_name, test_user_password, django_assert_max_num_queries):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    ozon_account, mp_products, active_action = create_ozon_catalogue(user, 150)
+    client = APIClient()
+    client.force_authenticate(user)
+
+    with django_assert_max_num_queries(8):
+        response = client.get("/api/unit_economics/marketplace-products/", {"limit": 100})
+
+    assert response.status_code == 200
+    assert response.data["all_products_count"] == 150
+    assert response.data["data_count"] == 100
+    first_item = response.data["data"][0]
+    assert first_item["id"] == mp_products[0].id
+    assert first_item["price"] == 900
+    assert [action["action"]["id"] for action in first_item["actions"]] == [active_action.id]
+
+    response = client.get(
+        "/api/unit_economics/marketplace-products/", {"limit": 100, "cursor": response.data["next_cursor"]})
+    assert [item["id"] for item in response.data["data"]] == [mp_product.id for mp_product in mp_products[100:]]
+    assert response.data["next_cursor"] is None
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("ordering, limit", [("-mp_profitability__profit", 4), ("mp_profitability__profit", 3)])
+def test_marketplace_products_keyset_pages_by_nullable_field(
+        django_user_model, test_user_name, test_user_password, ordering, limit):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    _, mp_products, _ = create_ozon_catalogue(user, 10)
+    # Повторяющиеся значения и четыре товара без рентабельности
+    profits = [50, 100, 10, 50, 20, 10]
+    ProfitabilityMarketplaceProduct.objects.bulk_create([
+        ProfitabilityMarketplaceProduct(mp_product=mp_product, profit=profit, profitability=profit / 10)
+        for mp_product, profit in zip(mp_products, profits)])
+    descending = ordering.startswith("-")
+    with_profit = sorted(zip(profits, [mp_product.id for mp_product in mp_products]),
+                         key=lambda pair: (-pair[0] if descending else pair[0], pair[1]))
+    expected = [mp_product_id for _, mp_product_id in with_profit] + [
+        mp_product.id for mp_product in mp_products[len(profits):]]
+    client = APIClient()
+    client.force_authenticate(user)
+
+    pages = []
+    cursor = None
+    while True:
+        params = {"ordering": ordering, "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/api/unit_economics/marketplace-products/", params)
+        assert response.status_code == 200
+        pages.append([item["id"] for item in response.data["data"]])
+        cursor = response.data["next_cursor"]
+        if cursor is None:
+            break
+
+    # Страницы не пересекаются и не пропускают строк, пустые значения в конце
+    assert sum(pages, []) == expected
+    assert all(len(page) == limit for page in pages[:-1])
+
+
+@pytest.mark.django_db
+def test_marketplace_products_excel_export_is_streamed(
+        django_user_model, test_user_name, test_user_password, django_assert_max_num_queries):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    ozon_account, mp_products, _ = create_ozon_catalogue(user, 150)
+    client = APIClient()
+    client.force_authenticate(user)
+
+    # Число запросов не зависит от количества товаров (вместе с расчетом снимков рентабельности)
+    with django_assert_max_num_queries(14):
+        response = client.post(
+            f"/api/unit_economics/marketplace-products/?price_toggle=true&order_delivery_type=fbs"
+            f"&top_selection_platform_id={ozon_account.platform_id}&top_selection_account_id={ozon_account.id}")
+        content = b"".join(response.streaming_content)
+
+    assert response.status_code == 200
+    assert response["Content-Disposition"].startswith("attachment")
+    rows = list(load_workbook(BytesIO(content)).active.values)
+    assert rows[0][0] == "Marketpalce: OZON "
+    assert rows[1][0] == f"Магазин: {ozon_account.name}"
+    assert rows[4][:2] == ("Название на маркетплейсе", "Название на 'Мой склад'")
+    assert len(rows) == 5 + len(mp_products)
+    # Цена Озон 900, комиссия FBS 10%
+    assert rows[5][:7] == (mp_products[0].name, mp_products[0].product.name, "0", "0", "0", None, "0")
+    assert rows[5][9:12] == (900, None, 90)
@@ -0,0 +1,133 @@
+import pytest
+
+from core.enums import MarketplaceChoices
+from unit_economics import tasks_moy_sklad
+from unit_economics.models import ImportWatermark, PostingGoods, ProductPrice
+from unit_economics.tests.helpers import create_account
+
+
+def pages_of(*pages):
+    async def iterator():
+        for page in pages:
+            yield page
+    return iterator()
+
+
+def assortment_item(moy_sklad_id, updated):
+    return {'id': moy_sklad_id, 'updated': updated, 'meta': {'type': 'product'}, 'buyPrice': {'value': 100}}
+
+
+@pytest.fixture()
+def moy_sklad_account(django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    account.authorization_fields = {'token': 'token'}
+    account.save()
+    for moy_sklad_id in ('a', 'b'):
+        ProductPrice.objects.create(account=account, moy_sklad_product_number=moy_sklad_id,
+                                    name=moy_sklad_id, vendor=moy_sklad_id, product_type='product')
+    return account
+
+
+@pytest.mark.django_db
+def test_moy_sklad_sync_is_incremental_and_reconciles_deletions(monkeypatch, moy_sklad_account):
+    requested_from = []
+    written = []
+    changed = [[assortment_item('a', '2024-05-01 10:00:00.000')],
+               [assortment_item('c', '2024-05-02 09:00:00.000')]]
+
+    def assortment_pages(token, updated_from=None):
+        requested_from.append(updated_from)
+        return pages_of(changed.pop(0))
+
+    def product_to_db(account, token, item, cost_price, account_names):
+        written.append(item['id'])
+        return True
+
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_assortment_pages', assortment_pages)
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_product_to_db', product_to_db)
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_assortment_all_pages',
+                        lambda token: pages_of([assortment_item('a', '2024-05-01 10:00:00.000')]))
+
+    tasks_moy_sklad.moy_sklad_add_data_to_db()
+
+    watermark = ImportWatermark.objects.get(account=moy_sklad_account)
+    assert watermark.value == '2024-05-01 10:00:00.000'
+    assert watermark.last_full_sync is not None
+    assert list(ProductPrice.objects.values_list('moy_sklad_product_number', flat=True)) == ['a']
+
+    def fail_reconcile(token):
+        raise AssertionError('Сверка не должна запускаться')
+
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_assortment_all_pages', fail_reconcile)
+    tasks_moy_sklad.moy_sklad_add_data_to_db()
+
+    watermark.refresh_from_db()
+    assert requested_from == [None, '2024-05-01 10:00:00.000']
+    assert written == ['a', 'c']
+    assert watermark.value == '2024-05-02 09:00:00.000'
+
+
+@pytest.mark.django_db
+def test_moy_sklad_reconcile_keeps_products_when_assortment_is_empty(monkeypatch, moy_sklad_account):
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_assortment_all_pages', lambda token: pages_of([]))
+
+    tasks_moy_sklad.moy_sklad_reconcile_assortment(moy_sklad_account, 'token')
+
+    assert sorted(ProductPrice.objects.values_list('moy_sklad_product_number', flat=True)) == ['a', 'b']
+
+
+@pytest.mark.django_db
+def test_moy_sklad_sync_keeps_failed_items_for_next_run(monkeypatch, moy_sklad_account):
+    items = [assortment_item('a', '2024-05-01 10:00:00.000'), assortment_item('b', '2024-05-03 10:00:00.000')]
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_assortment_pages',
+                        lambda token, updated_from=None: pages_of(items))
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_product_to_db',
+                        lambda account, token, item, cost_price, account_names: item['id'] != 'a')
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_assortment_all_pages', lambda token: pages_of(items))
+
+    tasks_moy_sklad.moy_sklad_add_data_to_db()
+
+    assert ImportWatermark.objects.get(account=moy_sklad_account).value == '2024-05-01 10:00:00.000'
+
+
+def enter_position(position_id, moy_sklad_id, quantity=10, price=500):
+    href = f'https://api.moysklad.ru/api/remap/1.2/entity/product/{moy_sklad_id}'
+    return {'id': position_id, 'assortment': {'meta': {'href': href}}, 'quantity': quantity, 'price': price}
+
+
+@pytest.mark.django_db
+def test_moy_sklad_enters_are_ingested_incrementally(monkeypatch, moy_sklad_account):
+    ProductPrice.objects.filter(moy_sklad_product_number='a').update(code='A')
+    enters = [{'id': 'e1', 'moment': '2024-05-01 10:00:00.000', 'updated': '2024-05-01 10:00:00.000'}]
+    positions = {'e1': [enter_position('p1', 'a'), enter_position('p2', 'unknown')]}
+    requested_from = []
+    requested_positions = []
+
+    def enter_pages(token, updated_from=None):
+        requested_from.append(updated_from)
+        return pages_of(enters)
+
+    def positions_enter(token, enter_id):
+        requested_positions.append(enter_id)
+        return positions[enter_id]
+
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_enter_pages', enter_pages)
+    monkeypatch.setattr(tasks_moy_sklad, 'moy_sklad_positions_enter', positions_enter)
+
+    new_postings = tasks_moy_sklad.moy_sklad_enters_calculate()
+
+    assert list(new_postings[moy_sklad_account]) == ['A']
+    assert list(PostingGoods.objects.values_list('position_number', flat=True)) == ['p1']
+
+    # Оприходование изменено: добавлена позиция
+    enters[0]['updated'] = '2024-05-02 10:00:00.000'
+    positions['e1'].append(enter_position('p3', 'a', quantity=5))
+    tasks_moy_sklad.moy_sklad_enters_calculate()
+
+    assert requested_from == [None, '2024-05-01 10:00:00.000']
+    assert requested_positions == ['e1', 'e1']
+    assert sorted(PostingGoods.objects.values_list('position_number', flat=True)) == ['p1', 'p3']
+    assert ImportWatermark.objects.get(
+        account=moy_sklad_account, source=tasks_moy_sklad.MOY_SKLAD_ENTERS_SOURCE
+    ).value == '2024-05-02 10:00:00.000'
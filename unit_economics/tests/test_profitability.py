@@ -0,0 +1,132 @@
+import pytest
+from rest_framework.test import APIClient
+
+from core.enums import MarketplaceChoices
+from unit_economics import views
+from unit_economics.integrations import profitability_calculate
+from unit_economics.models import (MarketplaceProduct, ProductOzonPrice,
+                                   ProfitabilityMarketplaceProduct,
+                                   ProfitabilitySnapshot)
+from unit_economics.profitability import (profitability_bulk_calculate,
+                                          refresh_profitability_snapshot)
+from unit_economics.tests.helpers import create_account, create_mp_product
+
+
+@pytest.mark.django_db
+def test_profitability_bulk_calculate_all_delivery_types(catalogue):
+    user, wb_product, ozon_product = catalogue
+
+    result = profitability_bulk_calculate(user_id=user.id, costprice_flag="table")
+
+    # 1000 - 300 - 50 - 20% комиссии - 20% накладных по умолчанию
+    assert result[wb_product.id]["fbo"] == (250.0, 25.0)
+    assert result[wb_product.id]["fbs"] == (350.0, 35.0)
+    # 2000 - 300 - 100 - 10% комиссии - 10% накладных магазина
+    assert result[ozon_product.id]["fbo"] == (1200.0, 60.0)
+    # У ОЗОН нет логистики для dbs
+    assert result[ozon_product.id]["dbs"] == (1500.0, 75.0)
+
+
+@pytest.mark.django_db
+def test_profitability_bulk_calculate_upserts(catalogue, django_assert_max_num_queries):
+    user, wb_product, ozon_product = catalogue
+    ProfitabilityMarketplaceProduct.objects.create(mp_product=wb_product, profit=0, profitability=0, overheads=0.3)
+
+    with django_assert_max_num_queries(4):
+        profitability_bulk_calculate(user_id=user.id, costprice_flag="enter", order_delivery_type="fbs")
+
+    wb_profitability = ProfitabilityMarketplaceProduct.objects.get(mp_product=wb_product)
+    assert (wb_profitability.profit, wb_profitability.profitability) == (450.0, 45.0)
+    assert wb_profitability.overheads == 0.3
+    assert ProfitabilityMarketplaceProduct.objects.get(mp_product=ozon_product).profitability == 57.5
+
+
+@pytest.mark.django_db
+def test_profitability_calculate_skips_products_without_price(catalogue):
+    user, wb_product, ozon_product = catalogue
+    ProductOzonPrice.objects.all().delete()
+
+    profitability_calculate(user.id)
+
+    assert ProfitabilityMarketplaceProduct.objects.filter(mp_product=wb_product).exists()
+    assert not ProfitabilityMarketplaceProduct.objects.filter(mp_product=ozon_product).exists()
+
+
+@pytest.mark.django_db
+def test_profitability_calculate_groups_scoped_to_user(catalogue, django_user_model):
+    user, wb_product, ozon_product = catalogue
+    other_user = django_user_model.objects.create_user(email="other@test.test", password="testtest")
+    other_account = create_account(other_user, MarketplaceChoices.WILDBERRIES)
+    other_product = create_mp_product(other_account, wb_product.product, "3")
+    ProfitabilityMarketplaceProduct.objects.create(mp_product=other_product, profit=-500, profitability=-50)
+
+    result = profitability_calculate(user.id, profitability_group="count_above_20")
+
+    assert result["count_above_20"] == 2
+    assert result["count_below_minus_20"] == 0
+    assert set(result["filtered_products"]) == {wb_product, ozon_product}
+    assert list(MarketplaceProduct.objects.profitability_group("count_below_minus_20")) == [other_product]
+    assert not MarketplaceProduct.objects.profitability_group("unknown").exists()
+
+
+@pytest.mark.django_db
+def test_refresh_profitability_snapshot_is_incremental(catalogue):
+    user, wb_product, ozon_product = catalogue
+
+    # 2 товара x 2 типа себестоимости x 4 типа доставки
+    assert refresh_profitability_snapshot(user_id=user.id) == 16
+    assert refresh_profitability_snapshot(user_id=user.id) == 0
+
+    ProductOzonPrice.objects.update(ozon_price=4000)
+    assert refresh_profitability_snapshot(user_id=user.id) == 8
+    snapshot = ProfitabilitySnapshot.objects.get(
+        mp_product=ozon_product, costprice_flag="enter", order_delivery_type="fbs")
+    assert snapshot.profitability == 66.25
+
+    ProductOzonPrice.objects.all().delete()
+    assert refresh_profitability_snapshot(user_id=user.id) == 8
+    assert set(ProfitabilitySnapshot.objects.filter(mp_product=ozon_product).values_list(
+        "profit", "profitability")) == {(None, None)}
+    assert refresh_profitability_snapshot(user_id=user.id) == 0
+
+
+@pytest.mark.django_db
+def test_marketplace_products_read_profitability_from_snapshot(catalogue):
+    user, wb_product, ozon_product = catalogue
+    client = APIClient()
+    client.force_authenticate(user)
+
+    response = client.get(
+        "/api/unit_economics/marketplace-products/",
+        {"price_toggle": "true", "costprice_flag": "enter", "order_delivery_type": "fbs",
+         "ordering": "-mp_profitability__profitability"},
+    )
+
+    assert response.status_code == 200
+    assert [(item["id"], item["profitability"]) for item in response.data["data"]] == [
+        (ozon_product.id, 57.5), (wb_product.id, 45.0)]
+    assert not ProfitabilityMarketplaceProduct.objects.exists()
+
+
+@pytest.mark.django_db
+def test_marketplace_products_do_not_recalculate_unpriced_products(catalogue, monkeypatch):
+    user, wb_product, ozon_product = catalogue
+    ProductOzonPrice.objects.all().delete()
+    refreshed = []
+
+    def spy_refresh(mp_products=None, user_id=None):
+        refreshed.append(set(mp_products.values_list("id", flat=True)))
+        return refresh_profitability_snapshot(mp_products, user_id)
+
+    monkeypatch.setattr(views, "refresh_profitability_snapshot", spy_refresh)
+    client = APIClient()
+    client.force_authenticate(user)
+    params = {"price_toggle": "true", "costprice_flag": "enter", "order_delivery_type": "fbs"}
+
+    for _ in range(2):
+        response = client.get("/api/unit_economics/marketplace-products/", params)
+        assert {item["id"]: item["profitability"] for item in response.data["data"]} == {
+            wb_product.id: 45.0, ozon_product.id: None}
+
+    # Товар без цены получил пустой снимок и во второй раз не пересчитывается
+    assert refreshed == [{wb_product.id, ozon_product.id}, set()]
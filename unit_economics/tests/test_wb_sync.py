@@ -0,0 +1,50 @@
+import pytest
+
+from core.enums import MarketplaceChoices
+from unit_economics import tasks_wb
+from unit_economics.models import ImportWatermark, MarketplaceProduct, ProductPrice
+from unit_economics.tests.test_moy_sklad_sync import pages_of
+from unit_economics.tests.helpers import create_account, create_mp_product
+
+
+def wb_card(nm_id, updated_at):
+    return {
+        'nmID': nm_id, 'updatedAt': updated_at, 'title': f'Card {nm_id}', 'vendorCode': f'V{nm_id}',
+        'sizes': [{'skus': [str(nm_id)]}], 'subjectID': 10, 'subjectName': 'Категория',
+        'dimensions': {'width': 10, 'height': 10, 'length': 10},
+    }
+
+
+@pytest.mark.django_db
+def test_wb_sync_resumes_from_cursor_and_deactivates_only_on_full_resync(
+        monkeypatch, django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    moy_sklad_account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    wb_account = create_account(user, MarketplaceChoices.WILDBERRIES)
+    wb_account.authorization_fields = {'token': 'token'}
+    wb_account.save()
+    product = ProductPrice.objects.create(
+        account=moy_sklad_account, name='Product', vendor='Vendor', barcode=['1', '2'], product_type='product')
+    create_mp_product(wb_account, product, '1')
+    create_mp_product(wb_account, product, '2')
+
+    cursors = []
+    responses = [[wb_card(1, '2024-05-01T10:00:00Z')], [wb_card(2, '2024-05-02T10:00:00Z')]]
+
+    def article_pages(token, cursor=None):
+        cursors.append(cursor)
+        return pages_of(responses.pop(0))
+
+    monkeypatch.setattr(tasks_wb, 'wb_article_data_pages', article_pages)
+
+    tasks_wb.wb_products_data_to_db()
+    active = dict(MarketplaceProduct.objects.values_list('sku', 'is_active'))
+    assert active == {'1': True, '2': False}
+
+    tasks_wb.wb_products_data_to_db()
+    active = dict(MarketplaceProduct.objects.values_list('sku', 'is_active'))
+    assert active == {'1': True, '2': True}
+
+    assert cursors == [None, {'updatedAt': '2024-05-01T10:00:00Z', 'nmID': 1}]
+    watermark = ImportWatermark.objects.get(account=wb_account, source=tasks_wb.WB_CARDS_SOURCE)
+    assert watermark.value == {'updatedAt': '2024-05-02T10:00:00Z', 'nmID': 2}
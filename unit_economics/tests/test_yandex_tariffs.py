@@ -0,0 +1,55 @@
+import pytest
+
+from core.enums import MarketplaceChoices
+from unit_economics import tasks_yandex
+from unit_economics.models import (MarketplaceCategory, MarketplaceCommission,
+                                   MarketplaceLogistic, ProductForMarketplacePrice,
+                                   ProductPrice)
+from unit_economics.tests.helpers import create_account, create_mp_product
+
+
+def tariffs(fee, delivery):
+    return [{'type': 'FEE', 'amount': fee}, {'type': 'DELIVERY_TO_CUSTOMER', 'amount': delivery}]
+
+
+@pytest.mark.django_db
+def test_yandex_comission_logistic_dedups_offers(
+        monkeypatch, django_user_model, test_user_name, test_user_password):
+    user = django_user_model.objects.create_user(email=test_user_name, password=test_user_password)
+    moy_sklad_account = create_account(user, MarketplaceChoices.MOY_SKLAD)
+    yandex_account = create_account(user, MarketplaceChoices.YANDEX_MARKET)
+    yandex_account.authorization_fields = {'token': 'token'}
+    yandex_account.save()
+    category = MarketplaceCategory.objects.create(
+        platform=yandex_account.platform, category_number=7, category_name='Категория')
+
+    mp_products = []
+    for sku, price, weight in (('1', 1000, 1.5), ('2', 1000, 1.5), ('3', 2000, 1.5), ('4', 1000, 0)):
+        product = ProductPrice.objects.create(
+            account=moy_sklad_account, name=sku, vendor=sku, barcode=[sku], product_type='product')
+        ProductForMarketplacePrice.objects.create(product=product, yandex_price=price)
+        mp_product = create_mp_product(yandex_account, product, sku)
+        mp_product.category = category
+        mp_product.width, mp_product.height, mp_product.length, mp_product.weight = 10, 20, 30, weight
+        mp_product.save()
+        mp_products.append(mp_product)
+
+    calls = []
+
+    def comission_calculate(token, logistic_type, offers_list):
+        calls.append((logistic_type, [offer['price'] for offer in offers_list]))
+        fee = {'EXPRESS': 0.3, 'FBS': 0.1, 'FBY': 0.2}[logistic_type]
+        return [{'offer': offer, 'tariffs': tariffs(offer['price'] * fee, 100)} for offer in offers_list]
+
+    monkeypatch.setattr(tasks_yandex, 'yandex_comission_calculate', comission_calculate)
+
+    tasks_yandex.yandex_comission_logistic_add_data_to_db()
+
+    # Одинаковые товары 1 и 2 - одно предложение, товар без веса не запрашивается
+    assert sorted(calls) == [('EXPRESS', [1000, 2000]), ('FBS', [1000, 2000]), ('FBY', [1000, 2000])]
+    for mp_product in mp_products[:3]:
+        comission = MarketplaceCommission.objects.get(marketplace_product=mp_product)
+        assert (comission.fbs_commission, comission.fbo_commission, comission.fbs_express_commission) == (
+            pytest.approx(10), pytest.approx(20), pytest.approx(30))
+        assert MarketplaceLogistic.objects.get(marketplace_product=mp_product).cost_logistic == 100
+    assert not MarketplaceCommission.objects.filter(marketplace_product=mp_products[3]).exists()
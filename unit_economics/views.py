@@ -2,13 +2,12 @@ import asyncio
 from datetime import datetime
 import logging
 import tempfile
-from openpyxl.styles import Alignment, Border, Side
-from django.http import FileResponse, HttpResponse, JsonResponse
-from openpyxl import Workbook
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 import requests
 from django.db import transaction
 from django.db.models import Count, Prefetch, Q, Case, When, Value, BooleanField, Sum, F
 from django.utils import timezone
+from django.utils.http import content_disposition_header
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.filters import OrderingFilter, SearchFilter
@@ -24,14 +23,16 @@ from analyticalplatform.settings import (ADMINS_CHATID_LIST, OZON_ID, TELEGRAM_T
 from core.enums import MarketplaceChoices
 from core.models import Account, Platform, User
 from core.serializers import ProductsExportSerializer
+from unit_economics.excel_export import EXPORT_CHUNK_SIZE, file_blocks, write_marketplace_products_workbook
 from unit_economics.integrations import (
     add_marketplace_product_to_db,
     calculate_mp_price_with_incoming_profitability,
     calculate_mp_price_with_profitability,
     calculate_mp_profitability_with_incoming_price, profitability_calculate,
-    profitability_calculate_only,
     save_overheds_for_mp_product, calculate_quarantine_mp_products,
     send_message_async, update_price_info_from_user_request)
+from unit_economics.manager import profitability_groups_count
+from unit_economics.pagination import KeysetPagination
 from unit_economics.models import (MarketplaceAction, MarketplaceCommission,
                                    MarketplaceProduct,
                                    MarketplaceProductInAction,
@@ -40,6 +41,7 @@ from unit_economics.models import (MarketplaceAction, MarketplaceCommission,
                                    ProfitabilityMarketplaceProduct, StoreOverhead)
 from unit_economics.periodic_tasks import (action_article_price_to_db,
                                            moy_sklad_costprice_add_to_db)
+from unit_economics.profitability import refresh_profitability_snapshot
 from unit_economics.serializers import (
     AccountSelectSerializer, AccountSerializer, BrandSerializer,
     MarketplaceActionSerializer, MarketplaceCommissionSerializer,
@@ -275,6 +277,8 @@ class MarketplaceProductViewSet(viewsets.GenericViewSet):
        + поля для сортировки 'profit', 'profitability' пример запроса
        GET /api/marketplace-products/?ordering=mp_profitability__profit
        (или -profit для сортировки по убыванию)
+       + постраничная выдача по ключу: limit - размер страницы,
+       cursor - значение next_cursor из ответа для следующей страницы
     """
     permission_classes = [IsAuthenticated]
     serializer_class = MarketplaceProductSerializer
@@ -326,7 +330,7 @@ class MarketplaceProductViewSet(viewsets.GenericViewSet):
         if top_selection_product_name:
             products_list = top_selection_product_name.split(',')
             queryset = queryset.filter(product__in=products_list)
-        self.all_product_count = len(queryset)
+        self.all_product_count = queryset.count()
         if quarantine:
             percent = 20
             if self.quarantine_percent:
@@ -353,14 +357,32 @@ class MarketplaceProductViewSet(viewsets.GenericViewSet):
                 queryset = queryset.filter(
                     Q(product__price_product__rrc__gt=F('product__ozon_price_product__ozon_price') * great) | Q(product__price_product__rrc__lt=F('product__ozon_price_product__ozon_price')* less)
                 )
-        # Добавляем prefetch_related для акции
-        queryset = queryset.prefetch_related(
+        return queryset.order_by('id')
+
+    @staticmethod
+    def with_serializer_relations(queryset):
+        """
+        Загружает связанные данные для MarketplaceProductSerializer,
+        чтобы число запросов на страницу не зависело от числа товаров.
+        Активные акции и цены Озон загружаются в атрибуты active_actions и ozon_prices
+        """
+        return queryset.select_related(
+            'platform', 'account', 'product__price_product', 'product__costprice_product',
+            'marketproduct_comission', 'marketproduct_logistic', 'mp_profitability',
+            'mp_product_profit_price'
+        ).prefetch_related(
             Prefetch('product_in_action',
-                     queryset=MarketplaceProductInAction.objects.select_related('action'))
+                     queryset=MarketplaceProductInAction.objects.filter(
+                         action__date_finish__gte=timezone.now().date()).select_related('action'),
+                     to_attr='active_actions'),
+            Prefetch('product__ozon_price_product', to_attr='ozon_prices'),
         )
-        return queryset.order_by('id')
 
-    def list(self, request, *args, **kwargs):
+    def table_queryset(self, request):
+        """
+        Товары таблицы с фильтрами, пересчетами и связанными данными для сериализатора.
+        Возвращает (queryset, поле сортировки)
+        """
         queryset = self.filter_queryset(self.get_queryset())
         profitability_group = request.query_params.get('profitability_group')
         calculate_product_price = request.query_params.get(
@@ -370,20 +392,17 @@ class MarketplaceProductViewSet(viewsets.GenericViewSet):
         price_toggle = request.query_params.get('price_toggle')
         order_delivery_type = request.query_params.get('order_delivery_type')
 
+        # Прибыль и рентабельность по текущим ценам берутся из снимка ProfitabilitySnapshot.
+        # Пересчитываются только товары, для которых снимка еще нет
+        use_snapshot = bool(profitability_group or price_toggle)
+        if use_snapshot:
+            refresh_profitability_snapshot(queryset.filter(profitability_snapshots__isnull=True))
+            queryset = queryset.with_profitability_snapshot(costprice_flag, order_delivery_type)
+
         if profitability_group:
             # Срабатывает, когда нажимают на бар диаграммы, чтобы отфильтровать по нему товары
-            result = profitability_calculate(
-                request.user.id, profitability_group=profitability_group, costprice_flag=costprice_flag, order_delivery_type=order_delivery_type)
-            queryset = queryset.filter(
-                id__in=[p.id for p in result['filtered_products']])
-        
-        if price_toggle:
-            # Срабатывает, когда переключатель ЦЕНА в положении МОЙ СКЛАД
-            result = profitability_calculate_only(
-                queryset, costprice_flag=costprice_flag, order_delivery_type=order_delivery_type)
-            queryset = MarketplaceProduct.objects.filter(
-                id__in=[p.id for p in result])
-           
+            queryset = queryset.profitability_group(profitability_group, field='snapshot_profitability')
+
         # Фильтр для Пересчета цены на основании входящей рентабельности. Сохраняет цену и рентабельность
         if calculate_product_price:
             # Срабатывает, когда переключатель ЦЕНА в положении ПО УРОВНЮ РЕНТАБЕЛЬНОСТИ
@@ -391,6 +410,7 @@ class MarketplaceProductViewSet(viewsets.GenericViewSet):
                 float(calculate_product_price), queryset, costprice_flag=costprice_flag, order_delivery_type=order_delivery_type)
             queryset = MarketplaceProduct.objects.filter(
                 id__in=[p.id for p in updated_products])
+            use_snapshot = False
 
         # Фильтр по id акции
         if action_id:
@@ -411,20 +431,23 @@ class MarketplaceProductViewSet(viewsets.GenericViewSet):
                 queryset, costprice_flag=costprice_flag, order_delivery_type=order_delivery_type)
             queryset = MarketplaceProduct.objects.filter(
                 id__in=[p.id for p in updated_profitability])
+            use_snapshot = False
 
         # Получение параметра сортировки из запроса
         ordering = request.query_params.get('ordering', None)
-        if ordering:
-            queryset = queryset.order_by(ordering)
-        else:
-            queryset = queryset.order_by('id')
-        self.excel_serializer = self.get_serializer(queryset, many=True)
-        page = self.paginate_queryset(queryset)
-        serializer = self.get_serializer(queryset, many=True)
+        if ordering and use_snapshot:
+            ordering = ordering.replace('mp_profitability__', 'snapshot_')
+        return self.with_serializer_relations(queryset), ordering
+
+    def list(self, request, *args, **kwargs):
+        queryset, ordering = self.table_queryset(request)
+        page, next_cursor = KeysetPagination().paginate_queryset(queryset, request, ordering)
+        serializer = self.get_serializer(page, many=True)
         response_data = {
-            'quarantine_count': len(calculate_quarantine_mp_products(self.quarantine_percent, queryset)),
+            'quarantine_count': calculate_quarantine_mp_products(self.quarantine_percent, queryset).count(),
             'all_products_count': self.all_product_count,
             'data_count': len(serializer.data),
+            'next_cursor': next_cursor,
             'data': serializer.data,
         }
 
@@ -440,9 +463,12 @@ class MarketplaceProductViewSet(viewsets.GenericViewSet):
         # return Response(serializer.data)
     
     def post(self, request, *args, **kwargs):
-        
-        self.list(request)
-        serialized_data = self.excel_serializer.data
+        """
+        Выгрузка таблицы товаров в Excel с теми же фильтрами, что и GET.
+        Товары читаются из базы пачками, файл отдается потоком
+        """
+        queryset, ordering = self.table_queryset(request)
+        serializer = self.get_serializer()
 
         price_toggle = self.request.query_params.get('price_toggle', '')
         top_selection_platform_id = self.request.query_params.get(
@@ -460,146 +486,43 @@ class MarketplaceProductViewSet(viewsets.GenericViewSet):
         elif table_platform_id:
             platform_ids = table_platform_id.split(',')
 
-        if price_toggle:
-            price_toggle = price_toggle
-        if costprice_flag:
-             costprice_flag = costprice_flag
         platform_name = ''
         if platform_ids:
-            for platform_id in platform_ids:
-                platform_name += f'{Platform.objects.get(id=int(platform_id)).name} '
+            platform_names = dict(Platform.objects.filter(id__in=platform_ids).values_list('id', 'name'))
+            platform_name = ''.join(f'{platform_names[int(platform_id)]} ' for platform_id in platform_ids)
         overheads = ''
         account_name = ''
         if account_ids:
             account_ids = account_ids.split(',')
+            account_names = dict(Account.objects.filter(id__in=account_ids).values_list('id', 'name'))
             if len(account_ids) == 1:
                 overheads_data = StoreOverhead.objects.filter(account__id=account_ids[0]).aggregate(
-                overhead_sum=Sum('overhead'))
+                    overhead_sum=Sum('overhead'))
                 overheads = overheads_data['overhead_sum']
-                account_name = Account.objects.get(id=int(account_ids[0])).name
+                account_name = account_names[int(account_ids[0])]
             else:
-                for account_id in account_ids:
-                    account_name += f'{Account.objects.get(id=int(account_id)).name} '
-                
-        wb = Workbook()
-        ws = wb.active
-        ws.cell(row=1, column=1, value=f'Marketpalce: {platform_name}')
-        ws.cell(row=2, column=1, value=f'Магазин: {account_name}')
-        ws.cell(row=3, column=1, value=f'Накладные расходы: {overheads}')
-        ws.cell(row=4, column=1, value=f'Тип ФФ: {ff_type}')
-    
-        table_headers = (
-            "Название на маркетплейсе",
-            "Название на 'Мой склад'",
-            "Артикул на маркетплейсе",
-            "Артикул на 'Мой склад'",
-            "SKU на маркетплейсе",
-            "SKU на 'Мой склад'",
-
-            "Баркод",
-            "Бренд",
-            "РРЦ",
-            "Цена",
-
-            "Себестоимость",
-            "Комиссия",
-            "Логистика",
-            "Прибыль/убыток",
-            "Рентабельность",
+                account_name = ''.join(f'{account_names[int(account_id)]} ' for account_id in account_ids)
+
+        title_lines = (
+            f'Marketpalce: {platform_name}',
+            f'Магазин: {account_name}',
+            f'Накладные расходы: {overheads}',
+            f'Тип ФФ: {ff_type}',
         )
-        
-        for col, header in enumerate(table_headers, start=1):
-            ws.cell(row=5, column=col, value=header)
-    
-        for row, data in enumerate(serialized_data, start=6):
-            marketplace_prod_obj = MarketplaceProduct.objects.get(id=data['id'])
-            commission = 0
-            platform_id = marketplace_prod_obj.platform.id
-            if not price_toggle and costprice_flag == 'table':
-                price = data['usual_price']
-            elif not price_toggle and costprice_flag == 'enter':
-                price = data['profit_price']
-            else:
-                price = data['price']
-            # print(data)
-            if data['commission']:
-                commission = data['commission']['fbs_commission']
-                if ff_type == 'fbs':
-                    commission = data['commission']['fbs_commission']
-                elif ff_type == 'fbo':
-                    commission = data['commission']['fbo_commission']
-                elif ff_type == 'dbs':
-                    commission = data['commission']['dbs_commission']
-                elif ff_type == 'fbs_express':
-                    commission = data['commission']['fbs_express_commission']
-                
-            if data['logistic_cost']:
-                if platform_id == 4 and ff_type == 'fbs':
-                    logistic_cost = data['logistic_cost']['cost_logistic_fbs']
-                elif platform_id == 4 and ff_type == 'fbo':
-                    logistic_cost = data['logistic_cost']['cost_logistic_fbo']
-                else:
-                    logistic_cost = data['logistic_cost']['cost_logistic']
-            else:
-                logistic_cost = 0
-            if costprice_flag == 'enter':
-                costprice = data['posting_costprice']
-            else:
-                costprice = data['cost_price']
-
-            ws.cell(row=row, column=1, value=marketplace_prod_obj.name)
-            ws.cell(row=row, column=2, value=marketplace_prod_obj.product.name)
-            ws.cell(row=row, column=3, value=marketplace_prod_obj.seller_article)
-            ws.cell(row=row, column=4, value=marketplace_prod_obj.product.vendor)
-            ws.cell(row=row, column=5, value=marketplace_prod_obj.sku)
-            ws.cell(row=row, column=6, value=marketplace_prod_obj.product.code)
-
-            ws.cell(row=row, column=7, value=data['barcode'])
-            ws.cell(row=row, column=8, value=data['brand'])
-            ws.cell(row=row, column=9, value=data['rrc'])
-            ws.cell(row=row, column=10, value=price)
-
-            ws.cell(row=row, column=11, value=costprice)
-            ws.cell(row=row, column=12, value=(commission*price)/100)
-            ws.cell(row=row, column=13, value=logistic_cost)
-            ws.cell(row=row, column=14, value=data['profit'])
-            ws.cell(row=row, column=15, value=data['profitability'])
-        
-        al = Alignment(horizontal="center",
-                   vertical="center")
-        thin = Side(border_style="thin", color="000000")
-
-        ws.column_dimensions['A'].width = 23
-        ws.column_dimensions['B'].width = 20
-        ws.column_dimensions['C'].width = 18
-        ws.column_dimensions['D'].width = 18
-        ws.column_dimensions['E'].width = 18
-        ws.column_dimensions['F'].width = 18
-
-        ws.column_dimensions['G'].width = 18
-        ws.column_dimensions['H'].width = 18
-        ws.column_dimensions['I'].width = 18
-        ws.column_dimensions['J'].width = 18
-
-        ws.column_dimensions['K'].width = 18
-        ws.column_dimensions['L'].width = 18
-        ws.column_dimensions['M'].width = 18
-        ws.column_dimensions['N'].width = 18
-        ws.column_dimensions['O'].width = 18
-
-        for i in range(len(serialized_data)+1):
-            for c in ws[f'A{i+5}:O{i+5}']:
-                for i in range(15):
-                    c[i].border = Border(top=thin, left=thin,
-                                         bottom=thin, right=thin)
-                    c[i].alignment = al
-    
-        temp_file = tempfile.mktemp(prefix=f"Сводная таблица {datetime.now().strftime('%Y-%m-%d ')}", suffix=".xlsx")
+        mp_products = queryset.order_by(ordering or 'id').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        temp_file = tempfile.TemporaryFile(suffix='.xlsx')
         try:
-            wb.save(temp_file)
+            write_marketplace_products_workbook(
+                temp_file, title_lines, mp_products, serializer, price_toggle, costprice_flag, ff_type)
         except Exception:
-            return FileResponse()
-        return FileResponse(open(temp_file, "rb"), as_attachment=True)
+            temp_file.close()
+            raise
+        response = StreamingHttpResponse(
+            file_blocks(temp_file),
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        response['Content-Disposition'] = content_disposition_header(
+            True, f"Сводная таблица {datetime.now().strftime('%Y-%m-%d')}.xlsx")
+        return response
 
 
 class ProfitabilityAPIView(GenericAPIView):
@@ -657,19 +580,7 @@ class ProfitabilityAPIView(GenericAPIView):
 
         try:
             print('len(queryset)', len(queryset))
-            result = queryset.aggregate(
-                count_above_20=Count('id', filter=Q(profitability__gt=20)),
-                count_between_10_and_20=Count('id', filter=Q(
-                    profitability__lte=20) & Q(profitability__gt=10)),
-                count_between_0_and_10=Count('id', filter=Q(
-                    profitability__lte=10) & Q(profitability__gt=0)),
-                count_between_0_and_minus_10=Count('id', filter=Q(
-                    profitability__lte=0) & Q(profitability__gt=-10)),
-                count_between_minus_10_and_minus_20=Count('id', filter=Q(
-                    profitability__lte=-10) & Q(profitability__gt=-20)),
-                count_below_minus_20=Count(
-                    'id', filter=Q(profitability__lte=-20)),
-            )
+            result = profitability_groups_count(queryset)
             all_situations = len(queryset)
             product_situations = len(product_situations)
             minus_situations = result['count_between_0_and_minus_10'] + result['count_between_minus_10_and_minus_20'] + result['count_below_minus_20']